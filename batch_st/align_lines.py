@@ -0,0 +1,339 @@
+import os
+import re
+import sys
+import time
+import array
+import bisect
+
+from caption_store import format_tag
+
+# Half width of the window searched around a line's expected position
+ALIGN_BAND = int(os.environ.get("REVERT_ALIGN_BAND", 50))
+# A gap between two anchors with more DP cells than this is not aligned by content;
+# its fixed lines are written back by their tags instead
+MAX_GAP_CELLS = int(os.environ.get("REVERT_ALIGN_MAX_GAP_CELLS", 200000))
+# A fixed line may cover (merge) or be split from up to this many lines
+MAX_GROUP = 3
+# Similarity of a line to be taken as a fixed point of the alignment
+ANCHOR_SIMILARITY = 0.8
+# Below this similarity a line is not mapped at all (the original text is restored)
+MIN_SIMILARITY = 0.3
+# Shorter lines ("はい", "うん") repeat too often to be anchors outside their own tag
+MIN_ANCHOR_CHARS = 4
+# A proportional split point moves to punctuation this close to it
+SNAP_CHARS = 3
+SNAP_PUNCTUATION = set("、。，．,.！？!? 　")
+TAG_PATTERN = re.compile(r"^(\d+)-(.*)$")
+
+def load_tagged_lines(path):
+    """
+    Returns [(tag number or None, text), ...] for every non-empty line of a _strip.txt / _fixed.txt, in file order.
+    """
+    lines = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            match = TAG_PATTERN.match(line)
+            if match:
+                lines.append((int(match.group(1)), match.group(2)))
+            else:
+                lines.append((None, line))
+    return lines
+
+def ngrams(text):
+    """
+    Character bigrams of text, ignoring whitespace.
+    """
+    text = ''.join(text.split())
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def similarity(a, b):
+    """
+    Dice coefficient of two n-gram sets.
+    """
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+def longest_chain(pairs):
+    """
+    Longest subsequence of pairs (in ascending first element) whose second element strictly increases.
+    """
+    tails = []
+    tail_index = []
+    previous = [None] * len(pairs)
+    for k, (_, i) in enumerate(pairs):
+        position = bisect.bisect_left(tails, i)
+        if position == len(tails):
+            tails.append(i)
+            tail_index.append(k)
+        else:
+            tails[position] = i
+            tail_index[position] = k
+        previous[k] = tail_index[position - 1] if position else None
+
+    chain = []
+    k = tail_index[-1] if tail_index else None
+    while k is not None:
+        chain.append(pairs[k])
+        k = previous[k]
+    return chain[::-1]
+
+def split_proportionally(text, lengths):
+    """
+    Splits text into len(lengths) pieces in proportion to lengths (the original lines it replaces),
+    moving each split point to nearby punctuation. An empty original line gets an empty piece
+    (unless every one is empty).
+    """
+    weighted = [index for index, length in enumerate(lengths) if length > 0]
+    if 0 < len(weighted) < len(lengths):
+        pieces = [''] * len(lengths)
+        for index, piece in zip(weighted, split_proportionally(text, [lengths[index] for index in weighted])):
+            pieces[index] = piece
+        return pieces
+
+    # Every line empty: they share the text equally
+    total = sum(max(length, 1) for length in lengths)
+    pieces = []
+    start = 0
+    covered = 0
+    for index, length in enumerate(lengths[:-1]):
+        covered += max(length, 1)
+        cut = min(max(round(len(text) * covered / total), start), len(text))
+        for distance in range(SNAP_CHARS + 1):
+            if 0 < cut - distance and text[cut - distance - 1] in SNAP_PUNCTUATION:
+                cut -= distance
+                break
+            if 0 < cut + distance < len(text) and text[cut + distance - 1] in SNAP_PUNCTUATION:
+                cut += distance
+                break
+        # Every piece keeps at least one character while there are characters left
+        cut = max(start + 1, min(cut, len(text) - (len(lengths) - index - 1)))
+        cut = min(max(cut, start), len(text))
+        pieces.append(text[start:cut].strip())
+        start = cut
+    pieces.append(text[start:].strip())
+    return pieces
+
+class LineAligner:
+    """
+    Aligns the lines of a _fixed.txt to the lines of its _strip.txt by content, for output whose tags
+    can no longer be trusted (merged, split or renumbered lines).
+    1. Anchors: lines that match their own tag, the line after the previous anchor,
+       or a unique line within ALIGN_BAND of the tag, kept in order
+    2. Between two anchors: banded DP over the lines, where a fixed line maps to one strip line,
+       covers up to MAX_GROUP strip lines (merge) or several fixed lines make up one strip line (split)
+    Similarity is the Dice coefficient of character bigrams.
+    """
+
+    def __init__(self, strip_lines, fixed_lines, band=ALIGN_BAND):
+        self.strip_tags = [tag for tag, _ in strip_lines]
+        self.strip_texts = [text for _, text in strip_lines]
+        self.fixed_tags = [tag for tag, _ in fixed_lines]
+        self.fixed_texts = [text for _, text in fixed_lines]
+        self.strip_grams = [ngrams(text) for text in self.strip_texts]
+        self.fixed_grams = [ngrams(text) for text in self.fixed_texts]
+        self.band = band
+        self.group_grams = {}
+        self.stats = {'anchors': 0, 'matched': 0, 'merged': 0, 'split': 0, 'by_tag': 0, 'unassigned': 0, 'dropped': 0}
+
+    def _grams(self, side, start, end):
+        # n-grams of the joined lines [start, end) of one side, cached
+        key = (side, start, end)
+        if key not in self.group_grams:
+            texts = self.strip_texts if side == 'strip' else self.fixed_texts
+            self.group_grams[key] = ngrams(''.join(texts[start:end]))
+        return self.group_grams[key]
+
+    def anchors(self):
+        """
+        Returns [(fixed index, strip index), ...], increasing on both sides.
+        """
+        position = {tag: i for i, tag in enumerate(self.strip_tags) if tag is not None}
+        n = len(self.strip_texts)
+        m = len(self.fixed_texts)
+        candidates = []
+        for j, tag in enumerate(self.fixed_tags):
+            expected = position.get(tag)
+            if expected is not None and similarity(self.strip_grams[expected], self.fixed_grams[j]) >= ANCHOR_SIMILARITY:
+                candidates.append((j, expected))
+                continue
+            # Renumbered lines keep the offset of the previous anchor
+            if candidates:
+                following = candidates[-1][1] + j - candidates[-1][0]
+                if following < n and similarity(self.strip_grams[following], self.fixed_grams[j]) >= ANCHOR_SIMILARITY:
+                    candidates.append((j, following))
+                    continue
+            if len(self.fixed_grams[j]) < MIN_ANCHOR_CHARS - 1:
+                continue
+
+            # Drifted or untagged: the best line around the expected position, if it is unique
+            center = expected if expected is not None else j * n // max(m, 1)
+            best = 0.0
+            best_i = None
+            tie = False
+            for i in range(max(0, center - self.band), min(n, center + self.band + 1)):
+                score = similarity(self.strip_grams[i], self.fixed_grams[j])
+                if score > best:
+                    best, best_i, tie = score, i, False
+                elif score == best and score > 0:
+                    tie = True
+            if best >= ANCHOR_SIMILARITY and not tie:
+                candidates.append((j, best_i))
+        return longest_chain(candidates)
+
+    def _gap_by_tag(self, i0, a, j0, b):
+        """
+        Maps the fixed lines [j0, j0+b) whose tag is a strip line in [i0, i0+a) to that line, in tag order.
+        Used for gaps too large for the DP.
+        """
+        position = {self.strip_tags[i]: i for i in range(i0, i0 + a) if self.strip_tags[i] is not None}
+        groups = []
+        last = i0 - 1
+        for j in range(j0, j0 + b):
+            i = position.get(self.fixed_tags[j])
+            if i is not None and i > last:
+                groups.append(([i], [j]))
+                last = i
+        return groups
+
+    def _align_gap(self, i0, a, j0, b):
+        """
+        Banded DP over strip lines [i0, i0+a) and fixed lines [j0, j0+b).
+        Returns [(strip indices, fixed indices), ...] of the mapped groups.
+        A gap with more than MAX_GAP_CELLS cells is mapped by tag instead (_gap_by_tag).
+        """
+        if a == 0 or b == 0:
+            return []
+        # The band follows the diagonal of the gap, wide enough for its length difference
+        width = max(self.band, abs(a - b) + MAX_GROUP)
+        if (a + 1) * min(b + 1, 2 * width + 1) > MAX_GAP_CELLS:
+            self.stats['by_tag'] += 1
+            return self._gap_by_tag(i0, a, j0, b)
+
+        # One array row per strip line over its band [low[i], low[i] + len(score[i])):
+        # score, and the step back to the previous cell (back_i, back_j)
+        low = []
+        score = []
+        back_i = []
+        back_j = []
+        unreachable = float('-inf')
+
+        def get(i, j):
+            if i < 0 or j < low[i] or j >= low[i] + len(score[i]):
+                return unreachable
+            return score[i][j - low[i]]
+
+        for i in range(a + 1):
+            center = i * b / a
+            row_low = max(0, int(center - width))
+            row_high = min(b, int(center + width))
+            row = array.array('d', [unreachable]) * (row_high - row_low + 1)
+            row_back_i = array.array('b', [0]) * len(row)
+            row_back_j = array.array('b', [0]) * len(row)
+            low.append(row_low)
+            score.append(row)
+            back_i.append(row_back_i)
+            back_j.append(row_back_j)
+            for j in range(row_low, row_high + 1):
+                if i == 0 and j == 0:
+                    row[0] = 0.0
+                    continue
+                best, step = unreachable, None
+                # Unmapped strip line (restored) / unmapped fixed line (dropped)
+                for di, dj in ((1, 0), (0, 1)):
+                    previous = get(i - di, j - dj) if j - dj >= 0 else unreachable
+                    if previous > best:
+                        best, step = previous, (di, dj)
+                if j >= 1:
+                    # One fixed line for k strip lines (k > 1: merged by the model)
+                    for k in range(1, min(MAX_GROUP, i) + 1):
+                        previous = get(i - k, j - 1)
+                        if previous == unreachable:
+                            continue
+                        s = similarity(self._grams('strip', i0 + i - k, i0 + i), self.fixed_grams[j0 + j - 1])
+                        if s >= MIN_SIMILARITY and previous + s * (k + 1) / 2 > best:
+                            best, step = previous + s * (k + 1) / 2, (k, 1)
+                if i >= 1:
+                    # l fixed lines for one strip line (split by the model)
+                    for l in range(2, min(MAX_GROUP, j) + 1):
+                        previous = get(i - 1, j - l)
+                        if previous == unreachable:
+                            continue
+                        s = similarity(self.strip_grams[i0 + i - 1], self._grams('fixed', j0 + j - l, j0 + j))
+                        if s >= MIN_SIMILARITY and previous + s * (l + 1) / 2 > best:
+                            best, step = previous + s * (l + 1) / 2, (1, l)
+                if step is not None:
+                    row[j - row_low] = best
+                    row_back_i[j - row_low], row_back_j[j - row_low] = step
+
+        groups = []
+        i, j = a, b
+        while (i, j) != (0, 0):
+            di, dj = back_i[i][j - low[i]], back_j[i][j - low[i]]
+            if di and dj:
+                groups.append((list(range(i0 + i - di, i0 + i)), list(range(j0 + j - dj, j0 + j))))
+            i, j = i - di, j - dj
+        return groups[::-1]
+
+    def align(self):
+        """
+        Returns {strip tag: text} for every strip line the fixed lines could be mapped to.
+        """
+        n = len(self.strip_texts)
+        m = len(self.fixed_texts)
+        anchors = self.anchors()
+        self.stats['anchors'] = len(anchors)
+        groups = [([i], [j]) for j, i in anchors]
+
+        boundaries = [(-1, -1)] + anchors + [(m, n)]
+        for (j0, i0), (j1, i1) in zip(boundaries, boundaries[1:]):
+            groups.extend(self._align_gap(i0 + 1, i1 - i0 - 1, j0 + 1, j1 - j0 - 1))
+
+        mapping = {}
+        used_fixed = 0
+        for strip_indices, fixed_indices in groups:
+            used_fixed += len(fixed_indices)
+            if len(strip_indices) > 1:
+                # Merged line: split it over the captions in proportion to their original length
+                pieces = split_proportionally(self.fixed_texts[fixed_indices[0]],
+                                              [len(self.strip_texts[i]) for i in strip_indices])
+                self.stats['merged'] += 1
+            elif len(fixed_indices) > 1:
+                pieces = [''.join(self.fixed_texts[j] for j in fixed_indices)]
+                self.stats['split'] += 1
+            else:
+                pieces = [self.fixed_texts[fixed_indices[0]]]
+                self.stats['matched'] += 1
+            for i, piece in zip(strip_indices, pieces):
+                if self.strip_tags[i] is not None:
+                    mapping[self.strip_tags[i]] = piece
+        self.stats['matched'] -= len(anchors)
+        self.stats['unassigned'] = n - len(mapping)
+        self.stats['dropped'] = m - used_fixed
+        return mapping
+
+def align_files(strip_txt_path, fixed_txt_path, band=ALIGN_BAND):
+    """
+    Aligns a _fixed.txt to its _strip.txt. Returns ({tag: text}, stats); the tags are formatted as in the files (0001).
+    """
+    aligner = LineAligner(load_tagged_lines(strip_txt_path), load_tagged_lines(fixed_txt_path), band)
+    mapping = aligner.align()
+    return {format_tag(tag): text for tag, text in mapping.items()}, aligner.stats
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python align_lines.py <strip_txt> <fixed_txt>")
+        print("  Shows how the fixed lines align to the strip lines (no file is written).")
+    else:
+        start_time = time.time()
+        mapping, stats = align_files(sys.argv[1], sys.argv[2])
+        print(f"Aligned in {(time.time() - start_time) * 1000:.0f} ms: "
+              + ', '.join(f"{key}: {value}" for key, value in stats.items()))
+        if '--show' in sys.argv:
+            for tag, text in sorted(mapping.items()):
+                print(f"{tag}-{text}")
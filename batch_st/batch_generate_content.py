@@ -1,8 +1,19 @@
 import os
 import sys
 import glob
-import subprocess
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from generate_content import (
+    generate_content, create_client, GenerationTimeoutError,
+    prepare_job, ChunkPlanner, TruncatedResponseError, parse_response, get_safety_settings,
+    MODEL_NAME, GENERATION_CONFIG, CONFIDENCE_MODE, state_config,
+)
+from gemini_cache import get_default_cache
+from gemini_batch import BatchRunner, build_request
+from pipeline_state import open_state
+from to_strip import conf_path
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -10,6 +21,9 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # DEBUG, INFO, WARNING, ERROR, CRITICAL
 LOG_FILE = os.path.join(SCRIPT_DIR, "batch_generate_content.log")
 
+# Number of files processed at the same time (each file also sends its chunks concurrently)
+FILES_IN_FLIGHT = int(os.environ.get("FILES_IN_FLIGHT", 2))
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -20,7 +34,138 @@ logging.basicConfig(
     ]
 )
 
-def batch_generate_content(from_dir):
+def file_logger(input_file):
+    """
+    Returns a log function that prefixes every line with the file name,
+    like the output of the former generate_content.py subprocess.
+    """
+    prefix = os.path.basename(input_file)
+
+    def log(message):
+        for line in str(message).splitlines():
+            line = line.strip()
+            if line:
+                logging.info(f"[{prefix}] {line}")
+    return log
+
+def process_file(client, input_file, system_instruction_file, wordlist_file, overwrite=False):
+    """
+    Runs generate_content for one file and returns its exit code
+    (0: success, 1: error, 75: timeout) with the same meaning as the command line.
+    """
+    logging.info(f"Starting process for {input_file}")
+    try:
+        ok = generate_content(input_file, system_instruction_file, wordlist_file,
+                              client=client, log=file_logger(input_file), overwrite=overwrite)
+        return 0 if ok else 1
+    except GenerationTimeoutError:
+        return 75
+
+def check_file(state, config, input_file, system_instruction_file, wordlist_file):
+    """
+    Pipeline state check of the _fixed.txt of input_file. Its inputs are the _strip.txt, the system instruction,
+    the wordlist and, in CONFIDENCE_MODE, the _conf.jsonl.
+    """
+    basename = os.path.basename(input_file)[:-len("_strip.txt")]
+    output_file = os.path.join(os.path.dirname(input_file), f"{basename}_fixed.txt")
+    inputs = {'strip': input_file, 'system_instruction': system_instruction_file, 'wordlist': wordlist_file}
+    if CONFIDENCE_MODE:
+        inputs['conf'] = conf_path(input_file)
+    # Progress saved under other settings is discarded by ChunkProgress itself
+    return state.check('generate_content', basename, output_file, inputs, config)
+
+def batch_api_generate_content(client, strip_files, system_instruction_file, wordlist_file, overwrite=False):
+    """
+    Corrects every file through the Gemini Batch API: the chunks of all files go into one batch job,
+    and the results are fanned back out into each file's progress sidecar and _fixed.txt
+    with the same chunking and stitching as generate_content.
+    Returns {input_file: 'done' | 'failed'}.
+    """
+    cache = get_default_cache()
+    safety_settings = get_safety_settings()
+    jobs = []
+    requests = {}
+    # key -> (job, chunk, current_chunk_lines, cache_key)
+    pending = {}
+    cache_hits = 0
+    statuses = {}
+
+    for input_file in strip_files:
+        log = file_logger(input_file)
+        job = prepare_job(input_file, system_instruction_file, wordlist_file, log, overwrite)
+        if job is None:
+            statuses[input_file] = 'failed'
+            continue
+        jobs.append(job)
+
+        # Latency does not matter here, so every chunk uses the initial budget
+        # (or the boundaries of the last complete run, whose responses are in the cache)
+        planned = cache.get_plan(job.progress.input_hash) if cache is not None else None
+        planner = ChunkPlanner(job.lines, job.progress.load(log), planned=planned)
+        chunk_number = 0
+        while planner.has_next():
+            chunk, saved_lines = planner.next_chunk()
+            context_start, own_start, end = chunk
+            if saved_lines is not None:
+                job.results[own_start] = (chunk, saved_lines)
+                continue
+            current_chunk_lines = job.lines[context_start:end]
+            if job.is_clean(chunk):
+                job.results[own_start] = (chunk, current_chunk_lines)
+                job.skipped_lines += end - own_start
+                continue
+
+            chunk_number += 1
+            system_instruction = job.chunk_system_instruction(current_chunk_lines, chunk_number)
+            prompt = "\n".join(current_chunk_lines)
+            cache_key = None
+            if cache is not None:
+                cache_key = cache.key(MODEL_NAME, GENERATION_CONFIG, system_instruction, prompt)
+                cached_text = cache.get(cache_key)
+                if cached_text is not None:
+                    job.results[own_start] = (chunk, parse_response(cached_text, current_chunk_lines)[0])
+                    cache_hits += 1
+                    continue
+
+            key = f"{os.path.basename(input_file)}:{context_start}:{own_start}:{end}"
+            requests[key] = build_request(prompt, system_instruction, GENERATION_CONFIG, safety_settings)
+            pending[key] = (job, chunk, current_chunk_lines, cache_key)
+        log(f"Batch: {chunk_number} chunks to request")
+
+    logging.info(f"Batch: {len(requests)} requests from {len(jobs)} files ({cache_hits} answered from the cache)")
+
+    def on_result(key, text):
+        job, chunk, current_chunk_lines, cache_key = pending[key]
+        try:
+            fixed_chunk_lines, _ = parse_response(text, current_chunk_lines)
+        except TruncatedResponseError as e:
+            job.log(f"Batch: {key}: {e}")
+            return False
+        if cache_key is not None:
+            cache.put(cache_key, text, MODEL_NAME)
+        job.results[chunk[1]] = (chunk, fixed_chunk_lines)
+        # Persist right away, like the interactive path
+        job.progress.save(chunk, fixed_chunk_lines)
+        return True
+
+    failed = set()
+    if requests:
+        failed = BatchRunner(client, MODEL_NAME, log=file_logger("batch")).run(requests, on_result)
+
+    for job in jobs:
+        job_failed = [key for key in failed if pending[key][0] is job]
+        if job_failed:
+            logging.error(f"Error processing {job.input_file}: {len(job_failed)} chunks failed. Rerun to resubmit them.")
+            statuses[job.input_file] = 'failed'
+        else:
+            job.write_output()
+            if cache is not None:
+                cache.put_plan(job.progress.input_hash, job.chunks(), MODEL_NAME)
+            logging.info(f"Successfully processed {job.input_file}")
+            statuses[job.input_file] = 'done'
+    return statuses
+
+def batch_generate_content(from_dir, batch_api=False):
     # Check if from_dir exists
     if not os.path.isdir(from_dir):
         logging.error(f"Error: Directory {from_dir} not found.")
@@ -28,72 +173,91 @@ def batch_generate_content(from_dir):
 
     # Find all _strip.txt files in the from_dir
     strip_files = glob.glob(os.path.join(from_dir, "*_strip.txt"))
-    
+
     if not strip_files:
         logging.warning(f"No _strip.txt files found in {from_dir}")
         return
 
     logging.info(f"Found {len(strip_files)} _strip.txt files in {from_dir}")
 
-    # Get the directory where this script is located
-    generate_content_script = os.path.join(SCRIPT_DIR, "generate_content.py")
     system_instruction_file = os.path.join(SCRIPT_DIR, "system_instruction.txt")
     wordlist_file = os.path.join(SCRIPT_DIR, "wordlist.txt")
 
-    if not os.path.exists(generate_content_script):
-        logging.error(f"Error: generate_content.py not found at {generate_content_script}")
+    # Only the files whose _fixed.txt is missing or stale (see pipeline_state.py)
+    state = open_state(logging.warning)
+    config = state_config()
+    decisions = {}
+    for input_file in strip_files:
+        decision = check_file(state, config, input_file, system_instruction_file, wordlist_file)
+        if decision.run:
+            decisions[input_file] = decision
+        else:
+            logging.info(f"Skip: {decision.output} {decision.reason}.")
+    if not decisions:
+        logging.info("Nothing to correct.")
+        state.close()
+        return
+
+    # One client (and connection pool) shared by every file
+    client = create_client(file_logger("batch"))
+    if client is None:
+        state.close()
         return
 
-    for input_file in strip_files:
-        logging.info(f"Processing: {input_file}")
-        try:
-            # Run generate_content.py as a subprocess
-            cmd = [
-                sys.executable, 
-                generate_content_script, 
-                input_file,
-                system_instruction_file,
-                wordlist_file
-            ]
-            
-            logging.info(f"Starting process for {input_file}")
-            
+    for input_file, decision in decisions.items():
+        logging.info(f"Processing: {input_file} ({decision.reason})")
+        state.begin(decision)
+
+    if batch_api:
+        # The files to run were picked by the pipeline state: a stale _fixed.txt is replaced once its new one is complete
+        statuses = batch_api_generate_content(client, list(decisions), system_instruction_file, wordlist_file, overwrite=True)
+        for input_file, decision in decisions.items():
+            state.finish(decision, statuses.get(input_file, 'failed'))
+        state.close()
+        return
+
+    logging.info(f"Processing up to {FILES_IN_FLIGHT} files at a time")
+
+    def run_file(input_file):
+        # The recorded time starts when a slot picks the file up, not when it is queued
+        decisions[input_file].started = time.time()
+        return process_file(client, input_file, system_instruction_file, wordlist_file, overwrite=True)
+
+    with ThreadPoolExecutor(max_workers=FILES_IN_FLIGHT) as executor:
+        futures = {}
+        for input_file in decisions:
+            future = executor.submit(run_file, input_file)
+            futures[future] = input_file
+
+        # A slow or timed-out file only occupies its own slot
+        for future in as_completed(futures):
+            input_file = futures[future]
+            status = 'failed'
             try:
-                # Use Popen to capture output in real-time
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT, # Redirect stderr to stdout
-                    text=True,
-                    encoding='utf-8',
-                    errors='replace'
-                )
-
-                # Read output line by line and log it
-                for line in process.stdout:
-                    line = line.strip()
-                    if line:
-                        logging.info(f"[{os.path.basename(input_file)}] {line}")
-
-                # Wait for process to complete
-                return_code = process.wait()
+                return_code = future.result()
 
                 if return_code != 0:
                     logging.error(f"Error processing {input_file}. Exit code: {return_code}.")
                     if return_code == 75:
                        logging.warning("  (Timeout occurred, skipping file)")
+                       status = 'timeout'
                 else:
                     logging.info(f"Successfully processed {input_file}")
+                    status = 'done'
 
             except Exception as e:
-                logging.error(f"Error executing subprocess for {input_file}: {e}")
-            
-        except Exception as e:
-            logging.error(f"Unexpected error processing {input_file}: {e}")
+                logging.error(f"Unexpected error processing {input_file}: {e}")
+            state.finish(decisions[input_file], status)
+    state.close()
+
+    cache = get_default_cache()
+    if cache is not None:
+        logging.info(cache.summary())
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python batch_generate_content.py <target_dir>")
+        print("Usage: python batch_generate_content.py <target_dir> [--batch]")
+        print("  --batch: submit every chunk through the Gemini Batch API (slower, cheaper, no rate limits)")
     else:
         target_dir = sys.argv[1]
-        batch_generate_content(target_dir)
+        batch_generate_content(target_dir, batch_api='--batch' in sys.argv)
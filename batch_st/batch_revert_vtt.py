@@ -1,12 +1,22 @@
 import os
 import sys
 import glob
-import subprocess
+import time
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from revert_vtt import revert_vtt, state_config
+from batch_worker import BATCH_WORKERS, run_captured
+from pipeline_state import open_state
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 def batch_revert_vtt(fixed_dir, vtt_dir):
+    """
+    Runs revert_vtt for every _fixed.txt in fixed_dir across BATCH_WORKERS processes.
+    A file is skipped if its _fixed.vtt is up to date in the pipeline state (see pipeline_state.py).
+    Returns the per-file results (see batch_worker.run_captured).
+    """
     # Check if directories exist
     if not os.path.isdir(fixed_dir):
         logging.error(f"Fixed directory {fixed_dir} not found.")
@@ -24,81 +34,86 @@ def batch_revert_vtt(fixed_dir, vtt_dir):
 
     logging.info(f"Found {len(fixed_files)} _fixed.txt files in {fixed_dir}")
 
-    # Get the directory where this script is located to find revert_vtt.py
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    revert_vtt_script = os.path.join(script_dir, "revert_vtt.py")
+    state = open_state(logging.warning)
+    config = state_config()
+    start_time = time.time()
+    statuses = {}
+    results = []
+    # Each file is reverted in a worker process (no interpreter startup per file)
+    with ProcessPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        futures = {}
+        for fixed_file in fixed_files:
+            # Infer basename from _fixed.txt filename
+            # example: video1_fixed.txt -> video1
+            filename = os.path.basename(fixed_file)
+            if not filename.endswith("_fixed.txt"):
+                continue
 
-    if not os.path.exists(revert_vtt_script):
-        logging.error(f"revert_vtt.py not found at {revert_vtt_script}")
-        return
+            basename = filename[:-10] # remove "_fixed.txt"
+
+            # Expected paths
+            strip_file = os.path.join(fixed_dir, f"{basename}_strip.txt")
+            vtt_file = os.path.join(vtt_dir, f"{basename}.vtt")
+
+            # Check existence
+            if not os.path.exists(strip_file):
+                logging.warning(f"Strip file {strip_file} not found. Skipping {basename}...")
+                continue
+
+            if not os.path.exists(vtt_file):
+                logging.warning(f"VTT file {vtt_file} not found. Skipping {basename}...")
+                continue
+
+            # revert_vtt writes {basename}_fixed.vtt next to the _fixed.txt
+            output_vtt = os.path.join(os.path.dirname(os.path.abspath(fixed_file)), f"{basename}_fixed.vtt")
 
-    for fixed_file in fixed_files:
-        # Infer basename from _fixed.txt filename
-        # example: video1_fixed.txt -> video1
-        filename = os.path.basename(fixed_file)
-        if not filename.endswith("_fixed.txt"):
-            continue
-            
-        basename = filename[:-10] # remove "_fixed.txt"
-        
-        # Expected paths
-        strip_file = os.path.join(fixed_dir, f"{basename}_strip.txt")
-        vtt_file = os.path.join(vtt_dir, f"{basename}.vtt")
-        
-        # Check existence
-        if not os.path.exists(strip_file):
-            logging.warning(f"Strip file {strip_file} not found. Skipping {basename}...")
-            continue
-            
-        if not os.path.exists(vtt_file):
-            logging.warning(f"VTT file {vtt_file} not found. Skipping {basename}...")
-            continue
-            
-        # Output check (revert_vtt.py saves to {basename}_fixed.vtt in CWD)
-        # We will run subprocess with cwd=vtt_dir, so output will be in vtt_dir
-        output_vtt = os.path.join(vtt_dir, f"{basename}_fixed.vtt")
-        
-        if os.path.exists(output_vtt):
-            logging.info(f"Skip: {output_vtt} already exists.")
-            continue
-            
-        logging.info(f"Processing: {basename}")
-        
-        try:
-            # Run revert_vtt.py as a subprocess
-            # Usage: python revert_vtt.py <original_vtt> <fixed_txt> [strip_txt]
-            
-            # Use absolute paths
+            decision = state.check('revert_vtt', basename, output_vtt,
+                                   {'vtt': vtt_file, 'fixed': fixed_file, 'strip': strip_file}, config)
+            if not decision.run:
+                logging.info(f"Skip: {output_vtt} {decision.reason}.")
+                continue
+
+            logging.info(f"Processing: {basename} ({decision.reason})")
+            state.begin(decision)
+            # revert_vtt(<original_vtt>, <fixed_txt>, [strip_txt]) with absolute paths
             vtt_abs_path = os.path.abspath(vtt_file)
             fixed_abs_path = os.path.abspath(fixed_file)
             strip_abs_path = os.path.abspath(strip_file)
-            
-            cmd = [
-                sys.executable,
-                revert_vtt_script,
-                vtt_abs_path,
-                fixed_abs_path,
-                strip_abs_path
-            ]
-            
-            result = subprocess.run(
-                cmd,
-                cwd=vtt_dir, # execute in vtt directory so output is saved there
-                capture_output=True, # Capture output for logging
-                text=True,
-                check=False
-            )
-            
-            if result.stdout:
-                logging.info(f"Output for {basename}:\n{result.stdout.strip()}")
-            if result.stderr:
-                logging.error(f"Error output for {basename}:\n{result.stderr.strip()}")
-
-            if result.returncode != 0:
-                logging.error(f"Error processing {basename}. Exit code: {result.returncode}.")
-                
-        except Exception as e:
-            logging.error(f"Unexpected error processing {basename}: {e}")
+            # A stale _fixed.vtt is only replaced once the new one is complete
+            future = executor.submit(run_captured, revert_vtt, vtt_abs_path, fixed_abs_path, strip_abs_path, True)
+            futures[future] = (basename, decision)
+
+        for future in as_completed(futures):
+            basename, decision = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. killed by the OOM killer)
+                logging.error(f"Unexpected error processing {basename}: {e}")
+                result = {'returncode': None, 'status': 'error', 'message': str(e), 'output': ''}
+
+            result['file'] = basename
+            results.append(result)
+            status = result.get('status', 'error')
+            statuses[status] = statuses.get(status, 0) + 1
+
+            if result['output'] and result['returncode'] == 0:
+                logging.info(f"Output for {basename}:\n{result['output'].strip()}")
+            elif result['output']:
+                # Traceback of an exception raised by revert_vtt
+                logging.error(f"Error output for {basename}:\n{result['output'].strip()}")
+
+            if result['returncode']:
+                logging.error(f"Error processing {basename}. Exit code: {result['returncode']}.")
+            state.finish(decision, 'done' if status == 'ok' else status,
+                         message=result.get('message'), elapsed=result.get('elapsed'))
+
+    if futures:
+        summary = ', '.join(f"{status}: {count}" for status, count in sorted(statuses.items()))
+        logging.info(f"Processed {len(futures)} files in {time.time() - start_time:.1f} seconds ({summary}) with {BATCH_WORKERS} workers")
+    state.close()
+    # Per-file results: file, status, counts, elapsed, output
+    return results
 
 if __name__ == "__main__":
     # Configure logging
@@ -1,9 +1,19 @@
 import os
 import sys
 import glob
-import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from to_strip import to_chunk, state_config
+from batch_worker import BATCH_WORKERS, run_captured
+from pipeline_state import open_state
 
 def batch_to_strip(from_dir, to_dir):
+    """
+    Runs to_chunk for every VTT in from_dir across BATCH_WORKERS processes.
+    A VTT is skipped if its _strip.txt is up to date in the pipeline state (see pipeline_state.py).
+    Returns the per-file results (see batch_worker.run_captured).
+    """
     # Check if from_dir exists
     if not os.path.isdir(from_dir):
         print(f"Error: Source directory {from_dir} not found.")
@@ -27,43 +37,58 @@ def batch_to_strip(from_dir, to_dir):
 
     print(f"Found {len(vtt_files)} vtt files in {from_dir}")
 
-    # Get the directory where this script is located to find to_strip.py
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    to_strip_script = os.path.join(script_dir, "to_strip.py")
-
-    if not os.path.exists(to_strip_script):
-        print(f"Error: to_strip.py not found at {to_strip_script}")
-        return
-
-    for vtt_file in vtt_files:
-        basename = os.path.splitext(os.path.basename(vtt_file))[0]
-        # output file name check (to_strip.py generates {basename}_strip.txt)
-        output_filename = f"{basename}_strip.txt"
-        output_file_path = os.path.join(to_dir, output_filename)
+    state = open_state()
+    config = state_config()
+    start_time = time.time()
+    statuses = {}
+    results = []
+    # Each file is converted in a worker process (no interpreter startup per file)
+    with ProcessPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        futures = {}
+        for vtt_file in vtt_files:
+            basename = os.path.splitext(os.path.basename(vtt_file))[0]
+            # output file name check (to_strip.py generates {basename}_strip.txt)
+            output_filename = f"{basename}_strip.txt"
+            output_file_path = os.path.join(to_dir, output_filename)
 
-        if os.path.exists(output_file_path):
-            print(f"Skip: {output_file_path} already exists.")
-            continue
+            decision = state.check('to_strip', basename, output_file_path, {'vtt': vtt_file}, config)
+            if not decision.run:
+                print(f"Skip: {output_file_path} {decision.reason}.")
+                continue
 
-        print(f"Processing: {vtt_file}")
-        
-        try:
-            # Run to_strip.py as a subprocess
+            print(f"Processing: {vtt_file} ({decision.reason})")
+            state.begin(decision)
             # Pass absolute path of vtt file and output file
             vtt_abs_path = os.path.abspath(vtt_file)
             output_abs_path = os.path.abspath(output_file_path)
-            
-            result = subprocess.run(
-                [sys.executable, to_strip_script, vtt_abs_path, output_abs_path],
-                capture_output=False,
-                check=False
-            )
+            future = executor.submit(run_captured, to_chunk, vtt_abs_path, output_abs_path)
+            futures[future] = (vtt_file, decision)
+
+        for future in as_completed(futures):
+            vtt_file, decision = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. killed by the OOM killer)
+                print(f"Unexpected error processing {vtt_file}: {e}")
+                result = {'returncode': None, 'status': 'error', 'message': str(e)}
+
+            result['file'] = vtt_file
+            results.append(result)
+            print(result.get('output', ''), end='')
+            status = result.get('status', 'error')
+            statuses[status] = statuses.get(status, 0) + 1
+            if result['returncode']:
+                print(f"Error processing {vtt_file}. Exit code: {result['returncode']}. Skipping...")
+            state.finish(decision, 'done' if status == 'ok' else status,
+                         message=result.get('message'), elapsed=result.get('elapsed'))
 
-            if result.returncode != 0:
-                print(f"Error processing {vtt_file}. Exit code: {result.returncode}. Skipping...")
-            
-        except Exception as e:
-            print(f"Unexpected error processing {vtt_file}: {e}")
+    if futures:
+        summary = ', '.join(f"{status}: {count}" for status, count in sorted(statuses.items()))
+        print(f"Processed {len(futures)} files in {time.time() - start_time:.1f} seconds ({summary}) with {BATCH_WORKERS} workers")
+    state.close()
+    # Per-file results: file, status, counts, elapsed, output
+    return results
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
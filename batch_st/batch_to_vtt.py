@@ -1,68 +1,412 @@
 import os
 import sys
+import gc
 import glob
-import subprocess
+import json
+import time
+import queue
+import multiprocessing
 
-def batch_to_vtt(mp3_dir, vtt_dir):
-    if not os.path.isdir(mp3_dir):
-        print(f"Error: Directory {mp3_dir} not found.")
+import numpy as np
+
+from to_vtt import (
+    MODEL_NAME, SAMPLE_RATE, load_model, transcribe, get_audio_duration,
+    pcm_cache_path, load_pcm, split_on_silence, journal_path, journal_header, transcribe_to_journal, commit_journals,
+    state_config
+)
+from pipeline_state import open_state
+
+# Inputs are decoded by ffmpeg, so any of these can be transcribed directly.
+# When the same basename exists with several extensions, the earlier one wins
+# (the original mp4 is preferred over a re-encoded mp3).
+AUDIO_EXTENSIONS = ['.mp4', '.mkv', '.webm', '.m4a', '.wav', '.flac', '.mp3']
+
+# Decoded PCM cache (.npy, memory-mapped) so retries and reruns skip decoding
+PCM_CACHE_DIR = os.getenv("PCM_CACHE_DIR")
+
+# Used when no worker config file is given: one worker with the default device settings
+DEFAULT_WORKERS = [{}]
+
+# VAD split mode: long streams are cut at silence and their spans are transcribed in parallel
+VAD_SPLIT = os.getenv("VAD_SPLIT", "0") == "1"
+VAD_SPLIT_MIN_SECONDS = float(os.getenv("VAD_SPLIT_MIN_SECONDS", 30 * 60))
+VAD_SPLIT_PARTS = int(os.getenv("VAD_SPLIT_PARTS", 0)) # 0: number of workers with the model that splits the file
+# How long an idle worker waits on the shared queue before looking at its model's span queue again
+SPAN_POLL_SECONDS = 1
+
+def load_worker_configs(config_file):
+    """
+    Reads a JSON list of worker settings, one object per worker process.
+    Example:
+        [
+            {"name": "gpu0", "device": "cuda", "device_index": 0, "compute_type": "float16"},
+            {"name": "cpu0", "device": "cpu", "compute_type": "int8", "cpu_threads": 8, "model": "medium"}
+        ]
+    "model" defaults to large-v3. Other keys are passed to faster_whisper.WhisperModel.
+    """
+    with open(config_file, 'r', encoding='utf-8') as f:
+        configs = json.load(f)
+    if not isinstance(configs, list) or not configs:
+        raise ValueError(f"{config_file} must contain a non-empty JSON list")
+    return configs
+
+def worker_name(index, config):
+    return config.get('name', f"worker{index}")
+
+def worker_model(config):
+    return config.get('model', MODEL_NAME)
+
+def transcribe_worker(index, config, task_queue, span_queue, result_queue):
+    """
+    Worker process: loads its own model once, then takes jobs from span_queue (spans for its model)
+    or task_queue (shared by every worker) until it receives None. Every event is reported to result_queue.
+
+    Job kinds:
+        file:  transcribe a whole file to its VTT
+        split: decode a file to a .npy PCM file (the PCM cache if enabled) and cut it into spans at silence
+               (job['parts'] is {model: number of spans})
+        span:  transcribe one span of a decoded PCM file into its own journal.
+               All spans of a file go to the span queue of the model that split it, so they are not mixed.
+    """
+    model_options = dict(config)
+    model_options.pop('name', None)
+    model_name = model_options.pop('model', MODEL_NAME)
+
+    load_start = time.time()
+    try:
+        model = load_model(model_name, **model_options)
+    except Exception as e:
+        result_queue.put(('load_error', index, str(e)))
         return
+    result_queue.put(('ready', index, time.time() - load_start))
+
+    while True:
+        try:
+            job = span_queue.get_nowait()
+        except queue.Empty:
+            try:
+                job = task_queue.get(timeout=SPAN_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        if job is None:
+            break
+        result_queue.put(('start', index, job['id']))
+
+        start_time = time.time()
+        ok = False
+        message = None
+        payload = None
+        duration = None
+        try:
+            if job['kind'] == 'file':
+                ok = transcribe(model, job['audio'], job['vtt'], job['cache'], model_name)
+                duration = get_audio_duration(job['audio'])
+            elif job['kind'] == 'split':
+                # Reuses the .npy if it is left over from an interrupted run
+                audio = load_pcm(job['audio'], job['pcm'])
+                payload = split_on_silence(np.asarray(audio), job['parts'][model_name])
+                ok = True
+            elif job['kind'] == 'span':
+                audio = np.load(job['pcm'], mmap_mode='r')
+                payload = transcribe_to_journal(model, audio, job['journal'], job['start'], job['end'],
+                                                journal_header(job['audio'], model_name))
+                duration = (job['end'] - job['start']) / SAMPLE_RATE
+                ok = True
+        except Exception as e:
+            # OOM (RuntimeError "out of memory") or any decode error only skips this job
+            message = str(e)
+            gc.collect()
+        elapsed_time = time.time() - start_time
+        result_queue.put(('done', index, job['id'], ok, elapsed_time, duration, message, payload))
+
+def find_audio_files(audio_dir):
+    """
+    Returns one source per basename, picked by AUDIO_EXTENSIONS order.
+    """
+    sources = {}
+    for extension in AUDIO_EXTENSIONS:
+        for audio_file in sorted(glob.glob(os.path.join(audio_dir, f"*{extension}"))):
+            basename = os.path.splitext(os.path.basename(audio_file))[0]
+            sources.setdefault(basename, audio_file)
+    return [sources[basename] for basename in sorted(sources)]
+
+def batch_to_vtt(audio_dir, vtt_dir, worker_configs=None):
+    if not os.path.isdir(audio_dir):
+        print(f"Error: Directory {audio_dir} not found.")
+        return
+
+    if worker_configs is None:
+        worker_configs = DEFAULT_WORKERS
 
     # Create output directory if it doesn't exist
     if not os.path.exists(vtt_dir):
         os.makedirs(vtt_dir)
         print(f"Created output directory: {vtt_dir}")
 
-    # Find all mp3 files in the target directory
-    mp3_files = glob.glob(os.path.join(mp3_dir, "*.mp3"))
-    
-    if not mp3_files:
-        print(f"No mp3 files found in {mp3_dir}")
-        return
-
-    print(f"Found {len(mp3_files)} mp3 files in {mp3_dir}")
-
-    # Get the directory where this script is located to find to_vtt.py
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    to_vtt_script = os.path.join(script_dir, "to_vtt.py")
+    # Find all audio/video files in the target directory
+    audio_files = find_audio_files(audio_dir)
 
-    if not os.path.exists(to_vtt_script):
-        print(f"Error: to_vtt.py not found at {to_vtt_script}")
+    if not audio_files:
+        print(f"No audio files found in {audio_dir}")
         return
 
-    for mp3_file in mp3_files:
-        basename = os.path.splitext(os.path.basename(mp3_file))[0]
+    print(f"Found {len(audio_files)} audio files in {audio_dir}")
+
+    # Collect the files that still need a VTT before paying for the model load
+    # (missing, or stale in the pipeline state: see pipeline_state.py).
+    # A VTT is up to date if it was transcribed by any of the workers' models;
+    # otherwise it is compared with the first worker's model for the reason.
+    state = open_state()
+    models = list(dict.fromkeys(worker_model(config) for config in worker_configs))
+    targets = []
+    decisions = {}
+    for audio_file in audio_files:
+        basename = os.path.splitext(os.path.basename(audio_file))[0]
         # vtt file is saved to the specified vtt_directory
         vtt_file = os.path.join(vtt_dir, f"{basename}.vtt")
 
-        if os.path.exists(vtt_file):
-            print(f"Skip: {vtt_file} already exists.")
+        for model_name in models:
+            decision = state.check('to_vtt', basename, vtt_file, {'audio': audio_file}, state_config(model_name))
+            if not decision.run:
+                break
+        else:
+            decision = state.check('to_vtt', basename, vtt_file, {'audio': audio_file}, state_config(models[0]))
+        if not decision.run:
+            print(f"Skip: {vtt_file} {decision.reason}.")
             continue
+        if decision.reason != "new":
+            print(f"Transcribing again: {vtt_file} ({decision.reason})")
+        state.begin(decision)
+        targets.append((os.path.abspath(audio_file), os.path.abspath(vtt_file)))
+        decisions[os.path.abspath(vtt_file)] = decision
+
+    if not targets:
+        print("Nothing to transcribe.")
+        state.close()
+        return
+
+    # A file is split into as many spans as there are workers with the model that splits it
+    split_parts = {model_name: VAD_SPLIT_PARTS or sum(worker_model(config) == model_name for config in worker_configs)
+                   for model_name in models}
+
+    # Each worker is a separate process holding its own model.
+    # Jobs are pulled from a shared queue, so whichever worker is free takes the next one;
+    # spans are pulled from the queue of their model.
+    # spawn is required for CUDA in child processes.
+    ctx = multiprocessing.get_context('spawn')
+    task_queue = ctx.Queue()
+    span_queues = {model_name: ctx.Queue() for model_name in models}
+    result_queue = ctx.Queue()
+
+    jobs = {}
+    done_jobs = set()
+    streams = {}
+    pending = 0
+    file_counts = {'ok': 0, 'error': 0}
 
-        print(f"Processing: {mp3_file} -> {vtt_file}")
-        
+    def submit(job):
+        nonlocal pending
+        job['id'] = len(jobs)
+        jobs[job['id']] = job
+        (span_queues[job['model']] if job['kind'] == 'span' else task_queue).put(job)
+        pending += 1
+
+    for audio_file, vtt_file in targets:
+        cache_file = pcm_cache_path(audio_file, PCM_CACHE_DIR) if PCM_CACHE_DIR else None
+        if VAD_SPLIT and max(split_parts.values()) > 1:
+            duration = get_audio_duration(audio_file)
+            if duration and duration >= VAD_SPLIT_MIN_SECONDS:
+                pcm_file = cache_file or os.path.join(os.path.dirname(vtt_file), f".{os.path.basename(vtt_file)}.pcm.npy")
+                streams[vtt_file] = {'audio': audio_file, 'pcm': pcm_file, 'cached': cache_file is not None,
+                                     'count': None, 'spans': None, 'model': None,
+                                     'results': {}, 'failed': False, 'start_time': time.time()}
+                submit({'kind': 'split', 'audio': audio_file, 'vtt': vtt_file, 'pcm': pcm_file, 'parts': split_parts})
+                continue
+        submit({'kind': 'file', 'audio': audio_file, 'vtt': vtt_file, 'cache': cache_file})
+
+    stats = []
+    for index, config in enumerate(worker_configs):
+        stats.append({
+            'name': worker_name(index, config),
+            'config': config,
+            'load_time': None,
+            'jobs': 0,
+            'errors': 0,
+            'audio_seconds': 0.0,
+            'processing_seconds': 0.0,
+        })
+
+    print(f"Starting {len(worker_configs)} worker(s) for {len(targets)} file(s)...")
+    wall_start = time.time()
+    processes = []
+    for index, config in enumerate(worker_configs):
+        process = ctx.Process(
+            target=transcribe_worker,
+            args=(index, config, task_queue, span_queues[worker_model(config)], result_queue),
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+
+    current = {}
+    finished = set()
+
+    def finish_stream(vtt_file):
+        stream = streams.pop(vtt_file)
+        if stream['model'] is not None:
+            decisions[vtt_file].config = state_config(stream['model'])
         try:
-            # Run to_vtt.py as a subprocess
-            mp3_abs_path = os.path.abspath(mp3_file)
-            vtt_abs_path = os.path.abspath(vtt_file)
-            
-            result = subprocess.run(
-                [sys.executable, to_vtt_script, mp3_abs_path, vtt_abs_path],
-                cwd=mp3_dir, # cwd allows to_vtt.py to access local resources if needed, though arguments are absolute
-                capture_output=False,
-                check=False
-            )
-
-            if result.returncode != 0:
-                print(f"Error processing {mp3_file}. Exit code: {result.returncode}. Skipping...")
-            
+            if not stream['failed']:
+                journal_files = [journal_path(vtt_file, span) for span in stream['spans']]
+                # The whole PCM, for the silence suppression stable-ts applies to the stitched segments
+                segment_count = commit_journals(journal_files, vtt_file, np.load(stream['pcm'], mmap_mode='r'))
+                elapsed_time = time.time() - stream['start_time']
+                print(f"Stitched {segment_count} segments from {stream['count']} spans: {vtt_file} ({elapsed_time:.2f} seconds)")
+                file_counts['ok'] += 1
+                state.finish(decisions[vtt_file], 'done')
+            else:
+                # Span journals are kept, so a rerun only decodes what is missing
+                print(f"Error processing {stream['audio']}: one or more spans failed. Skipping...")
+                file_counts['error'] += 1
+                state.finish(decisions[vtt_file], 'failed', message="one or more spans failed")
         except Exception as e:
-            print(f"Unexpected error processing {mp3_file}: {e}")
+            print(f"Error writing {vtt_file}: {e}. Skipping...")
+            file_counts['error'] += 1
+            state.finish(decisions[vtt_file], 'failed', message=str(e))
+        finally:
+            if not stream['cached'] and os.path.exists(stream['pcm']):
+                os.remove(stream['pcm'])
+
+    def handle(message):
+        nonlocal pending
+        kind, index = message[0], message[1]
+        name = stats[index]['name']
+        if kind == 'ready':
+            stats[index]['load_time'] = message[2]
+            print(f"[{name}] Model loaded in {message[2]:.2f} seconds")
+        elif kind == 'load_error':
+            print(f"[{name}] Error loading model: {message[2]}")
+        elif kind == 'start':
+            job = jobs[message[2]]
+            current[index] = job['id']
+            label = f" (span {job['index'] + 1}/{job['count']})" if job['kind'] == 'span' else ""
+            print(f"[{name}] Processing {job['kind']}: {job['audio']}{label}")
+        elif kind == 'done':
+            _, _, job_id, ok, elapsed_time, duration, error, payload = message
+            job = jobs[job_id]
+            current.pop(index, None)
+            done_jobs.add(job_id)
+            pending -= 1
+
+            if ok:
+                stats[index]['jobs'] += 1
+                if duration:
+                    stats[index]['audio_seconds'] += duration
+                    stats[index]['processing_seconds'] += elapsed_time
+            else:
+                stats[index]['errors'] += 1
+                print(f"[{name}] Error processing {job['kind']} {job['audio']}: {error}. Skipping...")
+            print(f"[{name}] Processing time: {elapsed_time:.2f} seconds")
+
+            if job['kind'] == 'file':
+                # Recorded with the model of the worker that transcribed it
+                decisions[job['vtt']].config = state_config(worker_model(stats[index]['config']))
+                file_counts['ok' if ok else 'error'] += 1
+                state.finish(decisions[job['vtt']], 'done' if ok else 'failed', message=error, elapsed=elapsed_time)
+            elif job['kind'] == 'split':
+                stream = streams[job['vtt']]
+                if ok:
+                    stream['count'] = len(payload)
+                    stream['spans'] = payload
+                    stream['model'] = worker_model(stats[index]['config'])
+                    print(f"[{name}] Split {job['audio']} into {len(payload)} spans at silence (model {stream['model']})")
+                    for span_index, (start, end) in enumerate(payload):
+                        submit({'kind': 'span', 'model': stream['model'], 'audio': job['audio'], 'vtt': job['vtt'], 'pcm': job['pcm'],
+                                'journal': journal_path(job['vtt'], (start, end)),
+                                'index': span_index, 'count': len(payload), 'start': start, 'end': end})
+                else:
+                    stream['failed'] = True
+                    finish_stream(job['vtt'])
+            elif job['kind'] == 'span':
+                stream = streams.get(job['vtt'])
+                if stream is not None:
+                    if ok:
+                        stream['results'][job['index']] = payload
+                    else:
+                        stream['failed'] = True
+                        stream['results'][job['index']] = None
+                    if len(stream['results']) == stream['count']:
+                        finish_stream(job['vtt'])
+
+            if pending == 0:
+                # All work done: release the workers
+                for _ in processes:
+                    task_queue.put(None)
+
+    while len(finished) < len(processes):
+        try:
+            handle(result_queue.get(timeout=5))
+        except queue.Empty:
+            for index, process in enumerate(processes):
+                if index not in finished and not process.is_alive():
+                    finished.add(index)
+                    # A worker that died mid-job (e.g. killed by the OOM killer) loses only that job
+                    if index in current:
+                        handle(('done', index, current[index], False, 0.0, None,
+                                f"worker exited with code {process.exitcode}", None))
+                    # Spans waiting for a model no live worker has are failed, not waited for
+                    model_name = worker_model(worker_configs[index])
+                    if not any(worker_model(worker_configs[other]) == model_name and other not in finished
+                               for other in range(len(processes))):
+                        for job_id, job in list(jobs.items()):
+                            if job['kind'] == 'span' and job['model'] == model_name and job_id not in done_jobs:
+                                handle(('done', index, job_id, False, 0.0, None,
+                                        f"no worker left with model {model_name}", None))
+
+    # Drain events that arrived after the last liveness check
+    while True:
+        try:
+            handle(result_queue.get_nowait())
+        except queue.Empty:
+            break
+
+    for process in processes:
+        process.join()
+
+    # Streams whose spans never ran because every worker failed to load or died
+    for vtt_file in list(streams):
+        streams[vtt_file]['failed'] = True
+        finish_stream(vtt_file)
+
+    state.close()
+    wall_time = time.time() - wall_start
+    remaining = len(targets) - file_counts['ok'] - file_counts['error']
+
+    print("=" * 50)
+    print("Summary:")
+    print(f"  Transcribed: {file_counts['ok']}")
+    print(f"  Errors:      {file_counts['error']}")
+    if remaining > 0:
+        print(f"  Not processed: {remaining}")
+    total_audio = 0.0
+    for worker in stats:
+        config = worker['config']
+        load_time = f"{worker['load_time']:.2f}s" if worker['load_time'] is not None else "failed"
+        rtf = (worker['processing_seconds'] / worker['audio_seconds']) if worker['audio_seconds'] else 0.0
+        total_audio += worker['audio_seconds']
+        print(f"  [{worker['name']}] model={worker_model(config)} "
+              f"device={config.get('device', 'auto')} compute_type={config.get('compute_type', 'default')}")
+        print(f"      Jobs: {worker['jobs']}, Errors: {worker['errors']}, Model load time: {load_time}")
+        print(f"      Audio: {worker['audio_seconds']:.0f}s, Transcription time: {worker['processing_seconds']:.0f}s, RTF: {rtf:.3f}")
+    print(f"  Wall time: {wall_time:.2f} seconds")
+    if wall_time > 0:
+        print(f"  Throughput: {total_audio / wall_time:.2f} seconds of audio per second")
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Usage: python batch_to_vtt.py <mp3_directory> <vtt_directory>")
+        print("Usage: python batch_to_vtt.py <audio_directory> <vtt_directory> [workers.json]")
     else:
-        mp3_dir = sys.argv[1]
+        audio_dir = sys.argv[1]
         vtt_dir = sys.argv[2]
-        batch_to_vtt(mp3_dir, vtt_dir)
+        worker_configs = load_worker_configs(sys.argv[3]) if len(sys.argv) > 3 else None
+        batch_to_vtt(audio_dir, vtt_dir, worker_configs)
@@ -0,0 +1,28 @@
+import io
+import os
+import time
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+# Worker processes of batch_to_strip / batch_revert_vtt (default: one per CPU core)
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", os.cpu_count() or 1))
+
+def run_captured(func, *args):
+    """
+    Calls func(*args) in a worker process with its stdout/stderr captured, and returns a per-file result:
+    the dict func returned (status and counts) plus 'returncode', 'elapsed' and 'output'.
+    An exception is isolated to this file: returncode 1 and the traceback in 'output',
+    as the former `python to_strip.py ...` subprocess exited.
+    """
+    output = io.StringIO()
+    start_time = time.time()
+    result = {'returncode': 0}
+    with redirect_stdout(output), redirect_stderr(output):
+        try:
+            result.update(func(*args) or {})
+        except Exception as e:
+            traceback.print_exc()
+            result.update(returncode=1, status='error', message=str(e))
+    result['elapsed'] = time.time() - start_time
+    result['output'] = output.getvalue()
+    return result
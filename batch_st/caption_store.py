@@ -0,0 +1,346 @@
+import os
+import re
+import sys
+import json
+import mmap
+import array
+import struct
+import hashlib
+import tempfile
+
+from vtt_stream import format_timestamp_ms
+
+# Layout: MAGIC, header length (uint32 LE), JSON header, padding to 8 bytes, then the columns:
+#   start_ms / end_ms: int64[count]
+#   text:{variant}:offsets: uint64[count + 1] into text:{variant}:data (UTF-8)
+#   text:{variant}:present: bitmap (LSB first) of the captions the variant has a text for, even an empty one
+MAGIC = b"UTSUCAP1"
+# CAPTION_STORE=0: to_strip does not write the store (the text files are used alone)
+CAPTION_STORE = os.environ.get("CAPTION_STORE", "1") != "0"
+STORE_SUFFIX = "_captions.bin"
+VERSION = 2
+ALIGNMENT = 8
+TAG_PATTERN = re.compile(r"^(\d+)-(.*)$")
+
+def format_tag(number):
+    """
+    Tag of the number-th (1-based) caption: 0001 ... 9999, then 10000 ...
+    Every stage writes tags through this and reads them back as int, so they cannot drift apart.
+    """
+    return f"{number:04d}"
+
+def store_path(path):
+    """
+    Caption store of a video: {base}_captions.bin next to its .vtt / _strip.txt / _fixed.txt.
+    """
+    base = os.path.splitext(path)[0]
+    for suffix in ('_strip', '_fixed', '_captions'):
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+            break
+    return base + STORE_SUFFIX
+
+def file_signature(path):
+    """
+    (size, mtime_ns) of a file, recorded with a variant to tell whether the text file was edited since.
+    """
+    stat = os.stat(path)
+    return {'source': os.path.basename(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+class CaptionStoreWriter:
+    """
+    Writes a caption store one caption at a time. The texts are spooled to temp files,
+    only the integer columns (24 bytes per caption and variant) stay in memory.
+    The store is written to a temp file and renamed on close(), so it is either complete or absent.
+    """
+
+    def __init__(self, path, variants=('original',), metadata=None, variant_metadata=None):
+        self.path = path
+        self.variants = list(variants)
+        self.metadata = metadata or {}
+        self.variant_metadata = variant_metadata or {}
+        self.start_ms = array.array('q')
+        self.end_ms = array.array('q')
+        self.offsets = {variant: array.array('Q', [0]) for variant in self.variants}
+        self.present = {variant: bytearray() for variant in self.variants}
+        directory = os.path.dirname(os.path.abspath(path))
+        self.blobs = {variant: tempfile.TemporaryFile(dir=directory) for variant in self.variants}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, start_ms, end_ms, texts):
+        """
+        Appends one caption. texts is {variant: text}; a variant missing or None has no text for it
+        (stored as '' and marked absent, unlike a present empty text).
+        """
+        index = len(self.start_ms)
+        self.start_ms.append(start_ms)
+        self.end_ms.append(end_ms)
+        for variant in self.variants:
+            text = texts.get(variant)
+            present = self.present[variant]
+            if index % 8 == 0:
+                present.append(0)
+            if text is not None:
+                present[-1] |= 1 << (index % 8)
+            data = (text or '').encode('utf-8')
+            self.blobs[variant].write(data)
+            self.offsets[variant].append(self.offsets[variant][-1] + len(data))
+
+    def abort(self):
+        for blob in self.blobs.values():
+            blob.close()
+
+    def close(self):
+        columns = [('start_ms', self.start_ms.itemsize * len(self.start_ms)),
+                   ('end_ms', self.end_ms.itemsize * len(self.end_ms))]
+        for variant in self.variants:
+            columns.append((f"text:{variant}:offsets", self.offsets[variant].itemsize * len(self.offsets[variant])))
+            columns.append((f"text:{variant}:data", self.offsets[variant][-1]))
+            columns.append((f"text:{variant}:present", len(self.present[variant])))
+
+        # Offsets are relative to the start of the data section
+        layout = {}
+        position = 0
+        for name, length in columns:
+            layout[name] = [position, length]
+            position += length + (-length % ALIGNMENT)
+        header = json.dumps({
+            'version': VERSION,
+            'count': len(self.start_ms),
+            'byteorder': sys.byteorder,
+            'columns': layout,
+            'variants': {variant: self.variant_metadata.get(variant, {}) for variant in self.variants},
+            'metadata': self.metadata,
+        }, ensure_ascii=False).encode('utf-8')
+        header += b' ' * (-(len(MAGIC) + 4 + len(header)) % ALIGNMENT)
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for name, length in columns:
+                if name == 'start_ms':
+                    f.write(self.start_ms.tobytes())
+                elif name == 'end_ms':
+                    f.write(self.end_ms.tobytes())
+                elif name.endswith(':offsets'):
+                    f.write(self.offsets[name.split(':')[1]].tobytes())
+                elif name.endswith(':present'):
+                    f.write(self.present[name.split(':')[1]])
+                else:
+                    blob = self.blobs[name.split(':')[1]]
+                    blob.seek(0)
+                    while True:
+                        data = blob.read(1024 * 1024)
+                        if not data:
+                            break
+                        f.write(data)
+                f.write(b'\0' * (-length % ALIGNMENT))
+        os.replace(temp_path, self.path)
+        self.abort()
+
+class CaptionStore:
+    """
+    Read access to a caption store through a memory map: any caption's timing or text is read
+    without parsing the rest of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a caption store")
+        header_length = struct.unpack('<I', self._mmap[len(MAGIC):len(MAGIC) + 4])[0]
+        data_start = len(MAGIC) + 4 + header_length
+        header = json.loads(self._mmap[len(MAGIC) + 4:data_start].decode('utf-8'))
+        if header['version'] > VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path}: unsupported caption store version {header['version']}")
+
+        self.count = header['count']
+        self.variants = header['variants']
+        self.metadata = header['metadata']
+        view = memoryview(self._mmap)
+        self._views = [view]
+
+        def column(name, typecode=None):
+            offset, length = header['columns'][name]
+            data = view[data_start + offset:data_start + offset + length]
+            self._views.append(data)
+            if typecode is None:
+                return data
+            if header['byteorder'] != sys.byteorder:
+                # Written on a machine of the other byte order: convert instead of mapping
+                values = array.array(typecode, data.tobytes())
+                values.byteswap()
+                return values
+            values = data.cast(typecode)
+            self._views.append(values)
+            return values
+
+        self.start_ms = column('start_ms', 'q')
+        self.end_ms = column('end_ms', 'q')
+        self._offsets = {variant: column(f"text:{variant}:offsets", 'Q') for variant in self.variants}
+        self._data = {variant: column(f"text:{variant}:data") for variant in self.variants}
+        # Version 1 stores have no presence bitmap: there a variant has the captions with a non-empty text
+        self._present = {variant: column(f"text:{variant}:present") if f"text:{variant}:present" in header['columns'] else None
+                         for variant in self.variants}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def text(self, variant, index):
+        """
+        Text of the index-th (0-based) caption in variant ('' if the variant has none for it).
+        """
+        offsets = self._offsets[variant]
+        return str(self._data[variant][offsets[index]:offsets[index + 1]], 'utf-8')
+
+    def has(self, variant, index):
+        """
+        True if variant has a text (possibly empty) for the index-th caption.
+        """
+        present = self._present[variant]
+        if present is None:
+            offsets = self._offsets[variant]
+            return offsets[index + 1] > offsets[index]
+        return bool(present[index // 8] & (1 << (index % 8)))
+
+    def get(self, variant, tag):
+        """
+        Text of the caption tagged tag ('0001'), '' for a present empty text,
+        or None if there is none (like dict.get on a tagged file).
+        """
+        index = int(tag) - 1
+        if not 0 <= index < self.count or not self.has(variant, index):
+            return None
+        return self.text(variant, index)
+
+    def texts(self, variant):
+        for index in range(self.count):
+            yield self.text(variant, index)
+
+    def tagged_lines(self, variant):
+        """
+        The variant as _strip.txt / _fixed.txt lines (NNNN-text), skipping captions the variant has no text for.
+        """
+        for index in range(self.count):
+            if self.has(variant, index):
+                yield f"{format_tag(index + 1)}-{self.text(variant, index)}"
+
+    def is_fresh(self, variant, path):
+        """
+        True if variant was stored from path and the file has not changed since:
+        same size and mtime, or, for a variant recorded with its sha256 (the original written by to_strip), same content.
+        """
+        recorded = self.variants.get(variant)
+        if not recorded or not os.path.exists(path):
+            return False
+        current = file_signature(path)
+        if recorded.get('size') != current['size']:
+            return False
+        if 'sha256' in recorded:
+            return recorded['sha256'] == file_sha256(path)
+        return recorded.get('mtime_ns') == current['mtime_ns']
+
+def add_variant(path, variant, texts, variant_metadata=None):
+    """
+    Rewrites the store at path with one more (or a replaced) text variant.
+    texts is a list of count texts (None where the variant has no text, '' for an empty one).
+    """
+    with CaptionStore(path) as store:
+        if len(texts) != store.count:
+            raise ValueError(f"{path}: {len(texts)} texts for {store.count} captions")
+        variants = [name for name in store.variants if name != variant] + [variant]
+        all_metadata = {name: store.variants[name] for name in variants if name != variant}
+        all_metadata[variant] = variant_metadata or {}
+        with CaptionStoreWriter(path, variants, store.metadata, all_metadata) as writer:
+            for index in range(store.count):
+                row = {name: store.text(name, index) if store.has(name, index) else None for name in variants if name != variant}
+                row[variant] = texts[index]
+                writer.add(store.start_ms[index], store.end_ms[index], row)
+
+def add_tagged_variant(path, variant, tagged_lines, source_file=None):
+    """
+    Stores tagged lines (NNNN-text, e.g. the lines of a _fixed.txt) as a variant, each under the caption of its tag.
+    Lines are matched like revert_vtt reads the file: a tag with nothing after it is stored as a present empty text,
+    lines without a tag or with a tag outside the store are ignored. Returns the number of texts stored.
+    """
+    with CaptionStore(path) as store:
+        count = store.count
+    texts = [None] * count
+    stored = 0
+    for line in tagged_lines:
+        match = TAG_PATTERN.match(line.rstrip('\n'))
+        if match and 1 <= int(match.group(1)) <= count:
+            texts[int(match.group(1)) - 1] = match.group(2)
+            stored += 1
+    add_variant(path, variant, texts, file_signature(source_file) if source_file else None)
+    return stored
+
+def export_vtt(store, variant, output_file):
+    """
+    Writes a VTT from the store; captions variant has no text for fall back to the original text.
+    """
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write("WEBVTT\n\n")
+        for index in range(store.count):
+            text = store.text(variant if store.has(variant, index) else 'original', index)
+            f.write(f"{format_timestamp_ms(store.start_ms[index])} --> {format_timestamp_ms(store.end_ms[index])}\n{text}\n\n")
+
+if __name__ == "__main__":
+    usage = "Usage: python caption_store.py info <store> | export-vtt <store> <variant> <vtt_file> | export-text <store> <variant> <txt_file>"
+    if len(sys.argv) < 3:
+        print(usage)
+        sys.exit(1)
+
+    command = sys.argv[1]
+    with CaptionStore(sys.argv[2]) as store:
+        if command == "info":
+            print(f"{store.path}: {store.count} captions, {os.path.getsize(store.path) / 1024:.0f} KB")
+            for name, recorded in store.variants.items():
+                filled = sum(1 for index in range(store.count) if store.has(name, index))
+                print(f"  {name}: {filled} texts {recorded or ''}")
+        elif command == "export-vtt" and len(sys.argv) > 4:
+            export_vtt(store, sys.argv[3], sys.argv[4])
+            print(f"Saved to {sys.argv[4]}")
+        elif command == "export-text" and len(sys.argv) > 4:
+            with open(sys.argv[4], 'w', encoding='utf-8') as f:
+                f.write('\n'.join(store.tagged_lines(sys.argv[3])))
+            print(f"Saved to {sys.argv[4]}")
+        else:
+            print(usage)
+            sys.exit(1)
@@ -1,48 +1,139 @@
-import glob
-import subprocess
-import os # osモジュールを追加
-
-video_dir = os.environ.get("VIDEOFILES_DIR")
-videos = glob.glob(f"{video_dir}/*.mp4")
-
-# --- 変換後のMP3を保存するフォルダを作成 ---
-output_dir = os.environ.get("AUDIOS_DIR")
-os.makedirs(output_dir, exist_ok=True)
-# -------------------------------------
-
-print(f"--- {len(videos)}件のファイルを変換します ---")
-
-for src in videos:
-    # 出力ファイル名を生成（フォルダ名部分も変更）
-    base_name = os.path.basename(src) # "audios/video1.mp4" -> "video1.mp4"
-    file_name = os.path.splitext(base_name)[0] # "video1.mp4" -> "video1"
-    dest = os.path.join(output_dir, f"{file_name}.mp3") # "audios_mp3/video1.mp3"
-
-    if os.path.exists(dest):
-        print(f"スキップ: {dest} (すでに存在します)")
-        continue
-    
-    print(f"変換中: {src} -> {dest}")
-
-    # ffmpegコマンドの引数リスト
-    command = [
-        'ffmpeg',
-        '-i', src,         # 入力ファイル
-        '-vn',             # ビデオなし
-        '-c:a', 'libmp3lame', # オーディオコーデック: MP3
-        '-b:a', '64k',     # ビットレート: 64kbps
-        '-ac', '1',        # チャンネル: 1 (モノラル)
-        '-ar', '16000',    # サンプルレート: 16000 Hz (16kHz)
-        '-y',              # 警告なしで上書き
-        dest               # 出力ファイル
-    ]
-    
-    # コマンドを実行
-    cp = subprocess.run(command)
-    
-    if cp.returncode == 0:
-        print(f"成功: {dest}")
-    else:
-        print(f"失敗: {src}")
-
-print("--- すべての処理が完了しました ---")
\ No newline at end of file
+import glob
+import subprocess
+import os # osモジュールを追加
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 同時に実行するffmpegの数 (ffmpegはほぼシングルスレッドなので既定はCPUコア数)
+CONV_AUDIO_WORKERS = int(os.environ.get("CONV_AUDIO_WORKERS", os.cpu_count() or 1))
+# 変換後の長さと元ファイルの長さの許容差 (秒)
+DURATION_TOLERANCE = float(os.environ.get("DURATION_TOLERANCE", 1.0))
+
+def probe_duration(path, entries, select_streams=None):
+    command = ['ffprobe', '-v', 'error']
+    if select_streams:
+        command += ['-select_streams', select_streams]
+    command += [
+        '-show_entries', entries,
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        path
+    ]
+    try:
+        cp = subprocess.run(command, capture_output=True, text=True, check=False)
+        return float(cp.stdout.strip().splitlines()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+def get_duration(path):
+    """
+    ffprobeで再生時間(秒)を取得する。取得できない場合はNone
+    音声ストリームの長さを優先する (MP4は映像トラックが音声より長いことがあり、コンテナの長さは音声と一致しない)。
+    音声ストリームの長さが取得できない場合はコンテナの長さを使う
+    """
+    duration = probe_duration(path, 'stream=duration', 'a:0')
+    if duration is None:
+        duration = probe_duration(path, 'format=duration')
+    return duration
+
+def convert_audio(src, dest):
+    """
+    srcをMP3に変換してdestに保存する。
+    一時ファイル(dest.part)に書き出し、長さを元ファイルと比較してからリネームするため、
+    中断や失敗で壊れたdestが残ることはない。
+    戻り値: (成功したか, 変換後の長さ(秒), エラーメッセージ)
+    """
+    temp = f"{dest}.part"
+
+    # ffmpegコマンドの引数リスト
+    command = [
+        'ffmpeg',
+        '-nostdin',
+        '-v', 'error',     # 並列実行で出力が混ざらないようにエラーのみ表示
+        '-i', src,         # 入力ファイル
+        '-vn',             # ビデオなし
+        '-c:a', 'libmp3lame', # オーディオコーデック: MP3
+        '-b:a', '64k',     # ビットレート: 64kbps
+        '-ac', '1',        # チャンネル: 1 (モノラル)
+        '-ar', '16000',    # サンプルレート: 16000 Hz (16kHz)
+        '-f', 'mp3',       # 一時ファイルの拡張子から推測できないため明示
+        '-y',              # 警告なしで上書き
+        temp               # 出力ファイル(一時)
+    ]
+
+    # コマンドを実行
+    cp = subprocess.run(command, capture_output=True, text=True, errors='replace')
+
+    if cp.returncode != 0:
+        if os.path.exists(temp):
+            os.remove(temp)
+        return False, None, cp.stderr.strip()
+
+    # 変換後の長さを元ファイルと比較する
+    src_duration = get_duration(src)
+    dest_duration = get_duration(temp)
+    if src_duration is None or dest_duration is None or abs(src_duration - dest_duration) > DURATION_TOLERANCE:
+        os.remove(temp)
+        return False, dest_duration, f"長さが一致しません (元: {src_duration}秒, 変換後: {dest_duration}秒)"
+
+    os.replace(temp, dest)
+    return True, dest_duration, None
+
+def conv_audio(video_dir, output_dir, workers=CONV_AUDIO_WORKERS):
+    videos = glob.glob(f"{video_dir}/*.mp4")
+
+    # --- 変換後のMP3を保存するフォルダを作成 ---
+    os.makedirs(output_dir, exist_ok=True)
+    # -------------------------------------
+
+    print(f"--- {len(videos)}件のファイルを変換します (並列数: {workers}) ---")
+
+    jobs = []
+    for src in videos:
+        # 出力ファイル名を生成（フォルダ名部分も変更）
+        base_name = os.path.basename(src) # "audios/video1.mp4" -> "video1.mp4"
+        file_name = os.path.splitext(base_name)[0] # "video1.mp4" -> "video1"
+        dest = os.path.join(output_dir, f"{file_name}.mp3") # "audios_mp3/video1.mp3"
+
+        if os.path.exists(dest):
+            print(f"スキップ: {dest} (すでに存在します)")
+            continue
+
+        jobs.append((src, dest))
+
+    success_count = 0
+    error_count = 0
+    total_duration = 0.0
+    start_time = time.time()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for src, dest in jobs:
+            print(f"変換中: {src} -> {dest}")
+            futures[executor.submit(convert_audio, src, dest)] = (src, dest)
+
+        for future in as_completed(futures):
+            src, dest = futures[future]
+            try:
+                ok, duration, message = future.result()
+            except Exception as e:
+                ok, duration, message = False, None, str(e)
+
+            if ok:
+                print(f"成功: {dest}")
+                success_count += 1
+                total_duration += duration
+            else:
+                print(f"失敗: {src} {message}")
+                error_count += 1
+
+    elapsed_time = time.time() - start_time
+    print(f"成功: {success_count}件, 失敗: {error_count}件")
+    print(f"音声の長さ: {total_duration:.0f}秒, 処理時間: {elapsed_time:.2f}秒")
+    if elapsed_time > 0:
+        print(f"スループット: {total_duration / elapsed_time:.2f} 音声秒/秒")
+    print("--- すべての処理が完了しました ---")
+
+if __name__ == "__main__":
+    video_dir = os.environ.get("VIDEOFILES_DIR")
+    output_dir = os.environ.get("AUDIOS_DIR")
+    conv_audio(video_dir, output_dir)
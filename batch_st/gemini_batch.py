@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import hashlib
+from google.genai import types
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Job files, results and the state of the running job are kept here
+BATCH_DIR = os.environ.get("GEMINI_BATCH_DIR", os.path.join(SCRIPT_DIR, ".gemini_batch"))
+BATCH_POLL_SECONDS = float(os.environ.get("BATCH_POLL_SECONDS", 60))
+# Submissions per run: the first one plus resubmissions of the failed items
+BATCH_MAX_ROUNDS = int(os.environ.get("BATCH_MAX_ROUNDS", 3))
+
+SUCCEEDED_STATE = 'JOB_STATE_SUCCEEDED'
+TERMINAL_STATES = {SUCCEEDED_STATE, 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+
+def build_request(prompt, system_instruction, generation_config, safety_settings):
+    """
+    One GenerateContentRequest of a batch job file, in the REST JSON form.
+    safety_settings are the types.SafetySetting used by the interactive requests.
+    """
+    return {
+        'contents': [{'role': 'user', 'parts': [{'text': prompt}]}],
+        'system_instruction': {'parts': [{'text': system_instruction}]},
+        'generation_config': generation_config,
+        'safety_settings': [setting.model_dump(mode='json', exclude_none=True) for setting in safety_settings],
+    }
+
+def request_digest(request):
+    """
+    Digest of one request, recorded with the job in flight so a resumed job only answers the requests it was sent.
+    """
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def response_text(record):
+    """
+    Returns the text of one line of a batch result file.
+    Raises ValueError for an item that failed, has no text or stopped at MAX_TOKENS.
+    """
+    if record.get('error') or 'response' not in record:
+        raise ValueError(f"item failed: {record.get('error') or record.get('status')}")
+    candidates = record['response'].get('candidates') or []
+    if not candidates:
+        raise ValueError(f"no candidates: {record['response'].get('promptFeedback')}")
+    parts = (candidates[0].get('content') or {}).get('parts') or []
+    text = ''.join(part.get('text', '') for part in parts)
+    # Cut off at the output token limit: failed, like a truncated interactive response
+    if candidates[0].get('finishReason') == 'MAX_TOKENS':
+        raise ValueError(f"truncated at the output token limit ({len(text)} chars)")
+    if not text:
+        raise ValueError(f"empty response (finishReason: {candidates[0].get('finishReason')})")
+    return text
+
+class BatchRunner:
+    """
+    Submits requests through the Gemini Batch API, polls the job and collects the results.
+    The job in flight is recorded in {work_dir}/state.json, so a restarted run resumes polling it
+    instead of paying for the same requests twice.
+    Works against any endpoint the client points to (GEMINI_BASE_URL), or any object with the same
+    files / batches methods (see utility/check_gemini_batch.py for an in-process stand-in).
+    """
+
+    def __init__(self, client, model, work_dir=BATCH_DIR, log=print):
+        self.client = client
+        self.model = model
+        self.work_dir = work_dir
+        self.log = log
+        self.state_file = os.path.join(work_dir, "state.json")
+
+    def _load_state(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self, state):
+        temp_file = f"{self.state_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(temp_file, self.state_file)
+
+    def submit(self, requests):
+        """
+        Writes {key: request} to a JSONL job file, uploads it and creates the batch job.
+        Returns the job name.
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        job_file = os.path.join(self.work_dir, f"batch-{stamp}.jsonl")
+        # A resubmission can follow within the same second
+        number = 1
+        while os.path.exists(job_file):
+            number += 1
+            job_file = os.path.join(self.work_dir, f"batch-{stamp}-{number}.jsonl")
+        with open(job_file, 'w', encoding='utf-8') as f:
+            for key, request in requests.items():
+                f.write(json.dumps({'key': key, 'request': request}, ensure_ascii=False) + '\n')
+
+        self.log(f"Batch: Uploading {job_file} ({len(requests)} requests, {os.path.getsize(job_file) / 1024 / 1024:.1f} MB)...")
+        uploaded = self.client.files.upload(
+            file=job_file,
+            config=types.UploadFileConfig(display_name=os.path.basename(job_file), mime_type='jsonl'),
+        )
+        job = self.client.batches.create(
+            model=self.model,
+            src=uploaded.name,
+            config={'display_name': f"generate_content-{stamp}"},
+        )
+        self._save_state({'job': job.name, 'keys': {key: request_digest(request) for key, request in requests.items()}})
+        self.log(f"Batch: Created job {job.name}")
+        return job.name
+
+    def wait(self, name):
+        """
+        Polls the job every BATCH_POLL_SECONDS until it reaches a terminal state and returns it.
+        """
+        start_time = time.time()
+        while True:
+            job = self.client.batches.get(name=name)
+            state = job.state.name
+            if state in TERMINAL_STATES:
+                self.log(f"Batch: Job {name} finished with {state} ({time.time() - start_time:.0f} seconds)")
+                return job
+            self.log(f"Batch: Job {name} is {state} ({time.time() - start_time:.0f} seconds)")
+            time.sleep(BATCH_POLL_SECONDS)
+
+    def collect(self, job):
+        """
+        Returns {key: response text or ValueError} for every item of a finished job.
+        """
+        results = {}
+        if job.state.name != SUCCEEDED_STATE:
+            self.log(f"Batch: Job {job.name} did not succeed: {getattr(job, 'error', None)}")
+            return results
+
+        content = self.client.files.download(file=job.dest.file_name)
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        # Keep the raw results next to the job file
+        with open(os.path.join(self.work_dir, f"{job.name.split('/')[-1]}.results.jsonl"), 'w', encoding='utf-8') as f:
+            f.write(content)
+
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            try:
+                results[record['key']] = response_text(record)
+            except ValueError as e:
+                results[record['key']] = e
+        return results
+
+    def run(self, requests, on_result):
+        """
+        Submits requests ({key: request}), waits and passes every successful result to on_result(key, text).
+        on_result returns False to reject a response (e.g. truncated).
+        Failed, missing and rejected items are resubmitted, up to BATCH_MAX_ROUNDS submissions.
+        Returns the set of keys that never succeeded.
+        """
+        pending = dict(requests)
+        state = self._load_state()
+        round_number = 0
+        while pending and round_number < BATCH_MAX_ROUNDS:
+            if state is not None and state.get('job'):
+                # A job submitted by an interrupted run is already paid for: collect it (not counted as a round)
+                # and take the results of the requests that are still pending and unchanged
+                name = state['job']
+                saved = state.get('keys') or {}
+                if isinstance(saved, list):
+                    # Written before the request digests were recorded
+                    saved = dict.fromkeys(saved)
+                submitted = {key: pending[key] for key, digest in saved.items()
+                             if key in pending and digest in (None, request_digest(pending[key]))}
+                if not submitted:
+                    self.log(f"Batch: Dropping job {name}: none of its requests is pending")
+                    os.remove(self.state_file)
+                    state = None
+                    continue
+                self.log(f"Batch: Resuming job {name} ({len(submitted)} of its {len(saved)} requests still pending)")
+            else:
+                round_number += 1
+                if round_number > 1:
+                    self.log(f"Batch: Resubmitting {len(pending)} failed or missing requests")
+                submitted = dict(pending)
+                name = self.submit(submitted)
+            state = None
+
+            job = self.wait(name)
+            results = self.collect(job)
+            succeeded = 0
+            for key in submitted:
+                result = results.get(key)
+                if result is None:
+                    if job.state.name == SUCCEEDED_STATE:
+                        self.log(f"Batch: {key}: missing from the results")
+                elif isinstance(result, Exception):
+                    self.log(f"Batch: {key}: {result}")
+                elif on_result(key, result):
+                    del pending[key]
+                    succeeded += 1
+            if os.path.exists(self.state_file):
+                os.remove(self.state_file)
+            self.log(f"Batch: {succeeded}/{len(submitted)} requests succeeded")
+        return set(pending)
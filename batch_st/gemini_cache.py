@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# GEMINI_CACHE=0 disables the cache
+CACHE_ENABLED = os.environ.get("GEMINI_CACHE", "1") != "0"
+CACHE_DIR = os.environ.get("GEMINI_CACHE_DIR", os.path.join(SCRIPT_DIR, ".gemini_cache"))
+CACHE_MAX_MB = float(os.environ.get("GEMINI_CACHE_MAX_MB", 1024))
+# Bump to invalidate every response produced with an older prompt
+PROMPT_VERSION = os.environ.get("PROMPT_VERSION", "1")
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of Gemini responses.
+    The key is a SHA-256 of (model, generation config, system instruction, contents, prompt version),
+    so an identical request is answered from disk without a network call.
+    Least recently used entries are evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_MB * 1024 * 1024, prompt_version=PROMPT_VERSION):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.prompt_version = prompt_version
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = None
+        self.lock = threading.Lock()
+
+    def key(self, model, config, system_instruction, contents):
+        payload = json.dumps({
+            'model': model,
+            'config': config,
+            'system_instruction': system_instruction,
+            'contents': contents,
+            'prompt_version': self.prompt_version,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            # Reading refreshes the entry for LRU eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def _write(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self.total_bytes += os.path.getsize(path)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def get(self, key):
+        """
+        Returns the cached response text, or None.
+        """
+        entry = self._read(key)
+        with self.lock:
+            if entry is None or 'text' not in entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry['text']
+
+    def put(self, key, text, model):
+        self._write(key, {
+            'model': model,
+            'prompt_version': self.prompt_version,
+            'created': time.time(),
+            'text': text,
+        })
+
+    def plan_key(self, input_hash):
+        return hashlib.sha256(json.dumps({'plan': input_hash, 'prompt_version': self.prompt_version}).encode('utf-8')).hexdigest()
+
+    def get_plan(self, input_hash):
+        """
+        Returns the chunk boundaries [[context_start, own_start, end], ...] saved by put_plan for an input, or None.
+        Not counted as a hit or miss.
+        """
+        entry = self._read(self.plan_key(input_hash))
+        return entry.get('plan') if entry else None
+
+    def put_plan(self, input_hash, chunks, model):
+        """
+        Saves the chunk boundaries a completed run used for an input (input_hash: see ChunkProgress).
+        The chunk sizes adapt to the response speed, so a rerun reuses these instead of planning again;
+        otherwise its prompts, and with them the response keys, would differ.
+        """
+        self._write(self.plan_key(input_hash), {
+            'model': model,
+            'prompt_version': self.prompt_version,
+            'created': time.time(),
+            'plan': [list(chunk) for chunk in chunks],
+        })
+
+    def _entries(self):
+        """
+        Yields (path, size, mtime) of every cache entry.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        for sub_dir in os.listdir(self.cache_dir):
+            sub_path = os.path.join(self.cache_dir, sub_dir)
+            if not os.path.isdir(sub_path):
+                continue
+            for name in os.listdir(sub_path):
+                if name.endswith('.json'):
+                    path = os.path.join(sub_path, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def _evict(self):
+        # Remove the least recently used entries until 90% of the limit
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.total_bytes = total
+
+    def invalidate(self, model=None, prompt_version=None):
+        """
+        Removes entries matching model and/or prompt_version (every entry when both are None).
+        Returns the number of removed entries.
+        """
+        removed = 0
+        for path, _, _ in list(self._entries()):
+            if model is not None or prompt_version is not None:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    entry = {}
+                if model is not None and entry.get('model') != model:
+                    continue
+                if prompt_version is not None and entry.get('prompt_version') != prompt_version:
+                    continue
+            os.remove(path)
+            removed += 1
+        with self.lock:
+            self.total_bytes = None
+        return removed
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def summary(self):
+        return f"Cache: {self.hits} hits / {self.hits + self.misses} lookups ({self.hit_ratio():.1%})"
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    """
+    Returns the process-wide cache, or None when GEMINI_CACHE=0.
+    """
+    global _default_cache
+    if not CACHE_ENABLED:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+        return _default_cache
+
+if __name__ == "__main__":
+    usage = "Usage: python gemini_cache.py stats | invalidate [--model MODEL] [--prompt-version VERSION]"
+    if len(sys.argv) < 2:
+        print(usage)
+        sys.exit(1)
+
+    cache = ResponseCache()
+    command = sys.argv[1]
+    if command == "stats":
+        entries = list(cache._entries())
+        print(f"Cache directory: {cache.cache_dir}")
+        print(f"Entries: {len(entries)}, Size: {sum(size for _, size, _ in entries) / 1024 / 1024:.1f} MB (max {CACHE_MAX_MB:.0f} MB)")
+    elif command == "invalidate":
+        args = sys.argv[2:]
+        model = args[args.index("--model") + 1] if "--model" in args else None
+        prompt_version = args[args.index("--prompt-version") + 1] if "--prompt-version" in args else None
+        removed = cache.invalidate(model=model, prompt_version=prompt_version)
+        print(f"Removed {removed} entries.")
+    else:
+        print(usage)
+        sys.exit(1)
@@ -0,0 +1,137 @@
+import os
+import re
+import time
+import random
+import threading
+
+# Attempts per request, including the first one
+RETRY_ATTEMPTS = int(os.environ.get("GEMINI_RETRY_ATTEMPTS", 6))
+# Each timeout costs a full TIMEOUT_SECONDS, so timeouts are retried less
+TIMEOUT_ATTEMPTS = int(os.environ.get("GEMINI_TIMEOUT_ATTEMPTS", 2))
+# Backoff: RETRY_BASE_SECONDS * 2^n with full jitter, at most RETRY_MAX_DELAY per wait
+RETRY_BASE_SECONDS = float(os.environ.get("GEMINI_RETRY_BASE_SECONDS", 2))
+RETRY_MAX_DELAY = float(os.environ.get("GEMINI_RETRY_MAX_DELAY", 120))
+# Total time one file (or run) may spend on retries (waits plus the retried requests)
+RETRY_BUDGET_SECONDS = float(os.environ.get("GEMINI_RETRY_BUDGET_SECONDS", 900))
+
+# 408 Request Timeout, 429 Resource Exhausted, 5xx server errors
+RETRYABLE_CODES = {408, 429, 500, 502, 503}
+# 504 Deadline Exceeded means the request itself took too long, like a client-side timeout
+TIMEOUT_CODES = {504}
+
+def error_code(e):
+    code = getattr(e, 'code', None) or getattr(e, 'status_code', None)
+    return code if isinstance(code, int) else None
+
+def is_timeout(e):
+    if error_code(e) in TIMEOUT_CODES or isinstance(e, TimeoutError) or 'Timeout' in type(e).__name__:
+        return True
+    # Using string matching for timeout detection as specific exception classes might vary
+    message = str(e).lower()
+    return "timeout" in message or "timed out" in message or "deadline" in message
+
+def classify_error(e):
+    """
+    Returns 'timeout', 'retryable' (rate limit, server or connection error) or 'fatal'.
+    """
+    if is_timeout(e):
+        return 'timeout'
+    code = error_code(e)
+    if code in RETRYABLE_CODES:
+        return 'retryable'
+    # Dropped connections (ConnectionError, httpx transport errors)
+    if isinstance(e, ConnectionError) or type(e).__name__ in ('ConnectError', 'RemoteProtocolError', 'ReadError'):
+        return 'retryable'
+    return 'fatal'
+
+def _find_retry_delay(details):
+    # google.rpc.RetryInfo can be nested anywhere in the error details: {"retryDelay": "17s"}
+    if isinstance(details, dict):
+        if 'retryDelay' in details:
+            return details['retryDelay']
+        values = details.values()
+    elif isinstance(details, list):
+        values = details
+    else:
+        return None
+    for value in values:
+        found = _find_retry_delay(value)
+        if found is not None:
+            return found
+    return None
+
+def retry_after(e):
+    """
+    Seconds the server asked us to wait (RetryInfo in the error details or a Retry-After header), or None.
+    """
+    delay = _find_retry_delay(getattr(e, 'details', None))
+    if delay is not None:
+        match = re.match(r"^\s*([\d.]+)s?\s*$", str(delay))
+        if match:
+            return float(match.group(1))
+
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers:
+        try:
+            return float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    return None
+
+class RetryBudget:
+    """
+    Total time allowed for retries, shared by every request of one file
+    (thread-safe, as chunks are sent concurrently).
+    """
+
+    def __init__(self, seconds=RETRY_BUDGET_SECONDS):
+        self.remaining = seconds
+        self.lock = threading.Lock()
+
+    def consume(self, seconds):
+        """
+        Reserves seconds of retry time. Returns False when the budget does not allow it.
+        """
+        with self.lock:
+            if seconds > self.remaining:
+                return False
+            self.remaining -= seconds
+            return True
+
+def call_with_retry(func, *args, budget=None, retry_timeouts=True, log=print, label="Request", **kwargs):
+    """
+    Calls func(*args, **kwargs), retrying rate limit (429), server (5xx) and connection errors
+    with exponential backoff and jitter, or after the delay the server asked for.
+    With retry_timeouts=False a timeout is raised right away, so the caller can split the request instead.
+    The last error is raised once RETRY_ATTEMPTS (TIMEOUT_ATTEMPTS for timeouts) or the budget are used up.
+    """
+    if budget is None:
+        budget = RetryBudget()
+    attempt = 0
+    timeouts = 0
+    while True:
+        start_time = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            kind = classify_error(e)
+            attempt += 1
+            timeouts += kind == 'timeout'
+            if kind == 'fatal' or attempt >= RETRY_ATTEMPTS:
+                raise
+            if kind == 'timeout' and (not retry_timeouts or timeouts >= TIMEOUT_ATTEMPTS):
+                raise
+
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_SECONDS * 2 ** attempt))
+            hint = retry_after(e)
+            if hint is not None:
+                delay = max(delay, hint)
+            # The first attempt is not a retry; later failed attempts count against the budget
+            spent = time.monotonic() - start_time if attempt > 1 else 0
+            if not budget.consume(spent + delay):
+                log(f"{label}: Retry budget exhausted ({kind}: {e}).")
+                raise
+
+            log(f"{label}: {kind} error ({e}). Retrying in {delay:.1f} seconds (attempt {attempt + 1}/{RETRY_ATTEMPTS})...")
+            time.sleep(delay)
@@ -1,69 +1,213 @@
 import os
+import re
 import sys
+import json
 import time
+import hashlib
+import bisect
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from google import genai
 from google.genai import types
 from google.genai.types import HttpOptions
 
-def generate_content(input_file, system_instruction_file='system_instruction.txt', wordlist_file='wordlist.txt'):
-    # Check if files exist
-    if not os.path.exists(input_file):
-        print(f"Error: Input file {input_file} not found.")
-        return
-    if not os.path.exists(system_instruction_file):
-        print(f"Error: System instruction file {system_instruction_file} not found.")
-        return
-    # Save output
-    basename = os.path.splitext(os.path.basename(input_file))[0]
-    if basename.endswith('_strip'):
-            basename = basename[:-6]
-    output_file = os.path.join(os.path.dirname(input_file), f"{basename}_fixed.txt")
-    if os.path.exists(output_file):
-        print(f"Error: Output file {output_file} already exists.")
-        return
+from gemini_cache import get_default_cache, PROMPT_VERSION
+from wordlist_filter import WORDLIST_FILTER, WORDLIST_TOP_N, get_index
+from gemini_retry import RetryBudget, call_with_retry, is_timeout
+from precorrect import PRECORRECT, Precorrector
+from caption_store import CaptionStore, STORE_SUFFIX, store_path, add_tagged_variant, format_tag
 
-    # wordlist might be optional or empty, but specified in requirements
-    wordlist_content = ""
-    if os.path.exists(wordlist_file):
-        with open(wordlist_file, 'r', encoding='utf-8') as f:
-            wordlist_content = f.read().strip()
-    else:
-        print(f"Warning: Wordlist file {wordlist_file} not found. Proceeding without it.")
+MODEL_NAME = "gemini-3-flash-preview"
+GENERATION_CONFIG = dict(
+    temperature=1.0,
+    top_p=0.95,
+    top_k=64,
+    response_mime_type="text/plain",
+)
+
+# Context lines repeated from the previous chunk. Chunks are stitched by tag, so this only affects quality.
+OVERLAP_LINES = int(os.environ.get("OVERLAP_LINES", 20))
+# Chunks are sized by an estimated token count instead of a fixed number of lines.
+# The budget starts at CHUNK_TOKENS and adapts so that a request takes about CHUNK_TARGET_SECONDS.
+CHUNK_TOKENS = int(os.environ.get("CHUNK_TOKENS", 40000))
+MAX_CHUNK_TOKENS = int(os.environ.get("MAX_CHUNK_TOKENS", 60000))
+MIN_CHUNK_TOKENS = 2000
+CHUNK_TARGET_SECONDS = float(os.environ.get("CHUNK_TARGET_SECONDS", 120))
+# A chunk that times out or comes back truncated is split in two, down to this many lines
+MIN_CHUNK_LINES = 100
+# Japanese text is roughly one token per character
+TOKENS_PER_CHAR = 1.0
+# Maximum number of chunk requests in flight at once
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 4))
+
+# full: the model echoes every line of the chunk
+# diff: the model returns only the lines it changed, followed by DIFF_END_SENTINEL
+RESPONSE_MODE = os.environ.get("RESPONSE_MODE", "full")
+DIFF_END_SENTINEL = "###END###"
+DIFF_INSTRUCTION = f"""
+### 出力形式 (差分モード)
+※ この指示は「行構造の完全維持」より優先します。
+1. 修正した行だけを、行番号（xxxx-）付きで1行ずつ出力してください。
+2. 修正のない行は出力しないでください。
+3. 最後に必ず「{DIFF_END_SENTINEL}」だけの行を出力してください。修正がない場合もこの行だけを出力してください。
+"""
+TAG_PATTERN = re.compile(r"^(\d+)-")
+
+# SKIP_CLEAN_CHUNKS=1: chunks without a suspicious line (a wordlist term matching only by its reading)
+# are not sent; their pre-corrected lines are used as they are
+SKIP_CLEAN_CHUNKS = os.environ.get("SKIP_CLEAN_CHUNKS", "0") == "1"
+
+# CONFIDENCE_MODE=1: only low-confidence lines ({basename}_conf.jsonl written by to_strip)
+# are sent, each with CONFIDENCE_CONTEXT lines around it; the other lines are kept unchanged
+CONFIDENCE_MODE = os.environ.get("CONFIDENCE_MODE", "0") == "1"
+CONFIDENCE_CONTEXT = int(os.environ.get("CONFIDENCE_CONTEXT", 3))
+# A line is low-confidence if any of Whisper's metrics crosses its threshold
+CONFIDENCE_LOGPROB = float(os.environ.get("CONFIDENCE_LOGPROB", -0.5))
+CONFIDENCE_NO_SPEECH = float(os.environ.get("CONFIDENCE_NO_SPEECH", 0.6))
+CONFIDENCE_COMPRESSION = float(os.environ.get("CONFIDENCE_COMPRESSION", 2.4))
+
+# Bump when existing _fixed.txt files have to be corrected again (see pipeline_state.py).
+# A changed system_instruction.txt / wordlist.txt is detected by its hash; PROMPT_VERSION also counts.
+STATE_VERSION = 1
+
+def state_config():
+    """
+    Settings that change the correction of a file, recorded with its _fixed.txt in the pipeline state.
+    Chunk sizes and concurrency only change how the work is split, so they are left out.
+    """
+    config = {
+        'version': STATE_VERSION,
+        'model': MODEL_NAME,
+        'generation_config': GENERATION_CONFIG,
+        'prompt_version': PROMPT_VERSION,
+        'response_mode': RESPONSE_MODE,
+        'precorrect': PRECORRECT,
+        'skip_clean_chunks': SKIP_CLEAN_CHUNKS,
+        'wordlist_top_n': WORDLIST_TOP_N if WORDLIST_FILTER else None,
+        'confidence': None,
+    }
+    if CONFIDENCE_MODE:
+        config['confidence'] = [CONFIDENCE_CONTEXT, CONFIDENCE_LOGPROB, CONFIDENCE_NO_SPEECH, CONFIDENCE_COMPRESSION]
+    return config
+
+def estimate_tokens(line):
+    # +1 for the newline
+    return len(line) * TOKENS_PER_CHAR + 1
+
+class ChunkPlanner:
+    """
+    Plans chunks lazily, one at a time, so that later chunks use the budget learned from earlier ones.
+    A chunk is (context_start, own_start, end): lines[own_start:end] are the lines it is responsible for,
+    lines[context_start:own_start] are up to OVERLAP_LINES lines of context repeated from the previous chunk.
+    Chunks completed by an earlier run (saved) are reused, and new chunks are planned only in the gaps.
+    Chunks of an earlier complete run (planned, see ResponseCache.get_plan) keep their boundaries,
+    so their requests are the same and are answered from the cache; the budget only shapes the rest.
+    """
+
+    def __init__(self, lines, saved=None, budget=CHUNK_TOKENS, planned=None):
+        self.total_lines = len(lines)
+        # cumulative[i]: estimated tokens of lines[:i]
+        self.cumulative = [0] + list(itertools.accumulate(estimate_tokens(line) for line in lines))
+        self.budget = budget
+        self.saved = saved or {}
+        self.saved_starts = sorted(self.saved)
+        self.planned = {chunk[1]: tuple(chunk) for chunk in planned or []}
+        self.next_start = 0
+        self.retry = deque()
+
+    def tokens(self, chunk):
+        context_start, _, end = chunk
+        return self.cumulative[end] - self.cumulative[context_start]
+
+    def has_next(self):
+        return bool(self.retry) or self.next_start < self.total_lines
+
+    def next_chunk(self):
+        """
+        Returns (chunk, saved response lines or None).
+        """
+        if self.retry:
+            return self.retry.popleft(), None
+
+        own_start = self.next_start
+        if own_start in self.saved:
+            chunk, saved_lines = self.saved[own_start]
+            self.next_start = chunk[2]
+            return chunk, saved_lines
+
+        # Stop at the next chunk saved by an earlier run
+        position = bisect.bisect_right(self.saved_starts, own_start)
+        limit = self.saved_starts[position] if position < len(self.saved_starts) else self.total_lines
+
+        planned = self.planned.get(own_start)
+        if planned is not None and planned[0] <= own_start < planned[2] <= limit:
+            self.next_start = planned[2]
+            return planned, None
+
+        context_start = max(0, own_start - OVERLAP_LINES)
+        end = bisect.bisect_right(self.cumulative, self.cumulative[context_start] + self.budget) - 1
+        end = min(max(end, own_start + MIN_CHUNK_LINES), limit)
+        self.next_start = end
+        return (context_start, own_start, end), None
+
+    def can_split(self, chunk):
+        _, own_start, end = chunk
+        return end - own_start >= 2 * MIN_CHUNK_LINES
+
+    def split(self, chunk):
+        """
+        Queues the two halves of a chunk that timed out or was truncated, ahead of any new chunk,
+        and lowers the budget for the chunks planned after it. Returns False if it is too small to split.
+        """
+        context_start, own_start, end = chunk
+        if not self.can_split(chunk):
+            return False
+        middle = own_start + (end - own_start) // 2
+        self.retry.appendleft((max(0, middle - OVERLAP_LINES), middle, end))
+        self.retry.appendleft((context_start, own_start, middle))
+        self.budget = max(MIN_CHUNK_TOKENS, min(self.budget, self.tokens(chunk) / 2))
+        return True
+
+    def record(self, chunk, elapsed):
+        """
+        Adapts the budget to the observed speed of a completed request:
+        a fast chunk lets the next ones grow, a slow one makes them smaller (at most x1.5 / x0.5 per step).
+        """
+        if elapsed <= 0:
+            return
+        ideal = self.tokens(chunk) / elapsed * CHUNK_TARGET_SECONDS
+        budget = min(max(ideal, self.budget * 0.5), self.budget * 1.5)
+        self.budget = min(max(budget, MIN_CHUNK_TOKENS), MAX_CHUNK_TOKENS)
 
-    # Get API Key
+class GenerationTimeoutError(Exception):
+    """A Gemini request timed out. The command line exits with code 75 on this error."""
+
+def create_client(log=print):
+    """
+    Creates the Gemini client. One client (and its connection pool) can be shared
+    by every file and chunk of a batch. Returns None if GEMINI_API_KEY is not set.
+    """
     api_key = os.environ.get("GEMINI_API_KEY")
     if not api_key:
-        print("Error: GEMINI_API_KEY environment variable is not set.")
-        return
+        log("Error: GEMINI_API_KEY environment variable is not set.")
+        return None
 
     TIMEOUT_SECONDS = os.environ.get("TIMEOUT_SECONDS")
     if not TIMEOUT_SECONDS:
-        print("Warning: TIMEOUT_SECONDS environment variable is not set. Defaulting to 5 minutes.")
+        log("Warning: TIMEOUT_SECONDS environment variable is not set. Defaulting to 5 minutes.")
         TIMEOUT_SECONDS = 5 * 60 * 1000 # 5 minutes
 
-    # Read Input Content
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            # Assumes input file has lines properly separated. 
-            # If input file is previously generated by to_chunk.py, it might contain blank lines.
-            lines = [line.rstrip('\n') for line in f if line.strip()]
-    except Exception as e:
-        print(f"Error reading input file: {e}")
-        return
+    # GEMINI_BASE_URL points the client to another endpoint (e.g. a local stand-in server for testing)
+    base_url = os.environ.get("GEMINI_BASE_URL")
+    if base_url:
+        log(f"Using Gemini endpoint {base_url}")
 
-    # Read System Instruction
-    try:
-        with open(system_instruction_file, 'r', encoding='utf-8') as f:
-            system_instruction = f.read()
-    except Exception as e:
-        print(f"Error reading system instruction file: {e}")
-        return
+    log("Initializing Gemini Client...")
+    return genai.Client(api_key=api_key, http_options=HttpOptions(timeout=int(TIMEOUT_SECONDS), base_url=base_url))
 
-    print("Initializing Gemini Client...")
-    client = genai.Client(api_key=api_key, http_options=HttpOptions(timeout=TIMEOUT_SECONDS))
-
-    # Safety settings
-    safety_settings = [
+def get_safety_settings():
+    return [
         types.SafetySetting(
             category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
             threshold=types.HarmBlockThreshold.BLOCK_NONE,
@@ -82,112 +226,611 @@ def generate_content(input_file, system_instruction_file='system_instruction.txt
         ),
     ]
 
-    LINES_PER_CHUNK = 2000
-    OVERLAP_LINES = 50
+def build_system_instruction(system_instruction, wordlist_content):
+    """
+    System instruction of one chunk: the instruction file followed by the (filtered) wordlist,
+    and the output format in diff mode.
+    """
+    if RESPONSE_MODE == "diff":
+        wordlist_content = f"{wordlist_content}\n{DIFF_INSTRUCTION}"
+    return f"""
+{system_instruction}
+
+{wordlist_content}
+"""
+
+class TruncatedResponseError(Exception):
+    """
+    A response stopped before the end of its chunk (full mode, lines holds what was returned)
+    or ended without DIFF_END_SENTINEL (diff mode).
+    """
+
+    def __init__(self, message, lines=None):
+        super().__init__(message)
+        self.lines = lines
+
+def merge_changed_lines(current_chunk_lines, response_lines):
+    """
+    Applies the changed lines of a diff-mode response to the chunk, matching them by tag (NNNN-).
+    Returns (complete fixed chunk lines, number of changed lines).
+    Raises TruncatedResponseError when the sentinel is missing, so a cut-off response
+    is never mistaken for "nothing to change".
+    """
+    response_lines = [line.strip() for line in response_lines if line.strip()]
+    if not response_lines or response_lines[-1] != DIFF_END_SENTINEL:
+        raise TruncatedResponseError(f"Response ended without {DIFF_END_SENTINEL} ({len(response_lines)} lines)")
+
+    changed = {}
+    for line in response_lines[:-1]:
+        match = TAG_PATTERN.match(line)
+        if match:
+            changed[match.group(1)] = line
+
+    fixed_chunk_lines = []
+    changed_count = 0
+    for line in current_chunk_lines:
+        match = TAG_PATTERN.match(line)
+        if match and match.group(1) in changed:
+            fixed_chunk_lines.append(changed[match.group(1)])
+            changed_count += changed[match.group(1)] != line
+        else:
+            fixed_chunk_lines.append(line)
+    return fixed_chunk_lines, changed_count
+
+def is_low_confidence(record):
+    # Lines without metrics are treated as low-confidence
+    if record is None or None in (record.get('avg_logprob'), record.get('no_speech_prob'), record.get('compression_ratio')):
+        return True
+    return (record['avg_logprob'] < CONFIDENCE_LOGPROB
+            or record['no_speech_prob'] > CONFIDENCE_NO_SPEECH
+            or record['compression_ratio'] > CONFIDENCE_COMPRESSION)
+
+def select_low_confidence(lines, conf_file, log=print):
+    """
+    Returns (indices of the lines to send, indices of the low-confidence lines),
+    or None when conf_file does not exist.
+    Lines to send are the low-confidence lines and CONFIDENCE_CONTEXT lines on each side of them.
+    """
+    if not os.path.exists(conf_file):
+        log(f"Warning: Confidence file {conf_file} not found. Sending every line.")
+        return None
+
+    records = {}
+    with open(conf_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            records[int(record['tag'])] = record
+
+    low_confidence = set()
+    for index, line in enumerate(lines):
+        match = TAG_PATTERN.match(line)
+        if not match or is_low_confidence(records.get(int(match.group(1)))):
+            low_confidence.add(index)
+
+    send = set()
+    for index in low_confidence:
+        send.update(range(max(0, index - CONFIDENCE_CONTEXT), min(len(lines), index + CONFIDENCE_CONTEXT + 1)))
+    return sorted(send), low_confidence
+
+def stitch_chunk(lines, chunk, fixed_chunk_lines, chunk_number, log=print):
+    """
+    Returns the response lines a chunk is responsible for (lines[own_start:end]), matched by tag (NNNN-)
+    and in input order. Lines tagged in the context part belong to the previous chunk and are dropped,
+    as are untagged lines. Missing and duplicate tags are reported.
+    """
+    context_start, own_start, end = chunk
+    expected = []
+    for line in lines[own_start:end]:
+        match = TAG_PATTERN.match(line)
+        if not match:
+            break
+        expected.append(int(match.group(1)))
+
+    if len(expected) < end - own_start:
+        # Input without tags: fall back to dropping the context lines by position
+        overlap = own_start - context_start
+        if len(fixed_chunk_lines) > overlap:
+            return fixed_chunk_lines[overlap:]
+        log(f"  Chunk {chunk_number}: Warning: Response shorter than overlap length ({len(fixed_chunk_lines)} < {overlap}). Keeping all.")
+        return fixed_chunk_lines
+
+    by_tag = {}
+    duplicates = []
+    untagged = 0
+    for line in fixed_chunk_lines:
+        match = TAG_PATTERN.match(line.strip())
+        if not match:
+            untagged += line.strip() != ""
+            continue
+        tag = int(match.group(1))
+        if tag in by_tag:
+            duplicates.append(tag)
+            continue
+        by_tag[tag] = line
+
+    stitched = [by_tag[tag] for tag in expected if tag in by_tag]
+    missing = [tag for tag in expected if tag not in by_tag]
+    if missing or duplicates or untagged:
+        details = []
+        if missing:
+            details.append(f"missing {len(missing)} tags ({', '.join(format_tag(tag) for tag in missing[:10])}{', ...' if len(missing) > 10 else ''})")
+        if duplicates:
+            details.append(f"duplicate {len(duplicates)} tags ({', '.join(format_tag(tag) for tag in duplicates[:10])}{', ...' if len(duplicates) > 10 else ''})")
+        if untagged:
+            details.append(f"dropped {untagged} untagged lines")
+        log(f"  Chunk {chunk_number}: Warning: {'; '.join(details)}")
+    return stitched
+
+class ChunkProgress:
+    """
+    Sidecar file ({basename}_fixed.progress.jsonl) holding every chunk response as soon as it returns,
+    so a rerun after an error or timeout only requests the missing chunks.
+    The first line records a hash of the input lines and the settings they were corrected with
+    (model, generation config, system instruction, wordlist...); progress for a different input or settings is discarded.
+    """
+
+    def __init__(self, path, lines, settings=None):
+        self.path = path
+        payload = json.dumps({'lines': "\n".join(lines), 'settings': settings}, sort_keys=True, ensure_ascii=False)
+        self.input_hash = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def load(self, log=print):
+        """
+        Returns {own_start: ((context_start, own_start, end), response lines)} of the chunks completed by earlier runs.
+        A record cut off by a crash is removed so new records can be appended.
+        """
+        results = {}
+        if not os.path.exists(self.path):
+            return results
+
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            for number, raw in enumerate(f):
+                try:
+                    record = json.loads(raw) if raw.endswith(b'\n') else None
+                except ValueError:
+                    record = None
+                if record is None:
+                    break
+                if number == 0:
+                    if record.get('input') != self.input_hash:
+                        log(f"Warning: {self.path} belongs to a different input or settings. Starting over.")
+                        self.remove()
+                        return {}
+                else:
+                    if 'own' not in record:
+                        log(f"Warning: {self.path} has a record without its chunk bounds. Starting over.")
+                        self.remove()
+                        return {}
+                    own_start = record['own']
+                    results[own_start] = ((record['start'], own_start, record['end']), record['lines'])
+                valid_size += len(raw)
+
+        if valid_size == 0:
+            self.remove()
+        elif valid_size < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_size)
+        return results
+
+    def save(self, chunk, fixed_chunk_lines):
+        is_new = not os.path.exists(self.path)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            if is_new:
+                f.write(json.dumps({'input': self.input_hash}) + '\n')
+            context_start, own_start, end = chunk
+            record = {'start': context_start, 'own': own_start, 'end': end, 'lines': fixed_chunk_lines}
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# A full-mode response is cut off when none of the last TRAILING_TAGS tags of its chunk came back.
+# Interior lines the model merged or dropped are left to stitch_chunk, which reports them.
+TRAILING_TAGS = 3
+
+def response_finish_reason(response):
+    """
+    Finish reason of the first candidate of a response (e.g. "STOP", "MAX_TOKENS"), or None.
+    """
+    candidates = getattr(response, 'candidates', None) or []
+    reason = getattr(candidates[0], 'finish_reason', None) if candidates else None
+    return getattr(reason, 'name', reason)
+
+def is_truncated(fixed_chunk_lines, current_chunk_lines):
+    """
+    True if a full-mode response stops before the end of its chunk: the trailing tags are missing,
+    or, for input without tags, fewer lines came back than were sent.
+    """
+    expected = [match.group(1) for match in map(TAG_PATTERN.match, current_chunk_lines) if match]
+    if len(expected) < len(current_chunk_lines):
+        return len(fixed_chunk_lines) < len(current_chunk_lines)
+    returned = {match.group(1) for match in (TAG_PATTERN.match(line.strip()) for line in fixed_chunk_lines) if match}
+    return not any(tag in returned for tag in expected[-TRAILING_TAGS:])
+
+def parse_response(fixed_text, current_chunk_lines, finish_reason=None):
+    """
+    Turns a response into the fixed lines of the chunk.
+    In diff mode the changed lines are merged back, so the chunk is returned complete either way.
+    Returns (fixed chunk lines, number of changed lines in diff mode or None).
+    Raises TruncatedResponseError for a response that stopped at the output token limit (MAX_TOKENS),
+    a full response missing the end of its chunk or a diff without the sentinel.
+    """
+    # Split response back into lines to handle overlap
+    fixed_chunk_lines = fixed_text.strip().split('\n')
+    if finish_reason == "MAX_TOKENS":
+        raise TruncatedResponseError(f"Response stopped at the output token limit ({len(fixed_chunk_lines)} lines)",
+                                     None if RESPONSE_MODE == "diff" else fixed_chunk_lines)
+    if RESPONSE_MODE == "diff":
+        return merge_changed_lines(current_chunk_lines, fixed_chunk_lines)
+    if is_truncated(fixed_chunk_lines, current_chunk_lines):
+        raise TruncatedResponseError(f"Response ends before the chunk does ({len(fixed_chunk_lines)} of {len(current_chunk_lines)} lines)", fixed_chunk_lines)
+    return fixed_chunk_lines, None
+
+def request_chunk(client, current_chunk_lines, system_instruction, safety_settings, chunk_number, log=print, cache=None,
+                  retry_budget=None, retry_timeouts=False):
+    """
+    Sends one chunk to Gemini and returns (response split into lines, whether it came from the cache).
+    With cache, an identical earlier request is answered from disk without a network call.
+    Rate limit and server errors are retried (see gemini_retry); timeouts only with retry_timeouts,
+    since a chunk that can still be split is better split than sent again.
+    """
+    prompt = "\n".join(current_chunk_lines)
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(MODEL_NAME, GENERATION_CONFIG, system_instruction, prompt)
+        cached_text = cache.get(cache_key)
+        if cached_text is not None:
+            log(f"Chunk {chunk_number}: Cache hit.")
+            fixed_chunk_lines, _ = parse_response(cached_text, current_chunk_lines)
+            return fixed_chunk_lines, True
+
+    log(f"Chunk {chunk_number}: Request sent...")
+    start_time = time.time()  # 計測開始
+    try:
+        response = call_with_retry(
+            client.models.generate_content,
+            model=MODEL_NAME,
+            contents=prompt,
+            config=types.GenerateContentConfig(
+                system_instruction=system_instruction,
+                safety_settings=safety_settings,
+                **GENERATION_CONFIG
+            ),
+            budget=retry_budget, retry_timeouts=retry_timeouts, log=log, label=f"Chunk {chunk_number}"
+        )
+
+        fixed_text = response.text or ""
+        # A truncated response raises here, so only complete responses are cached
+        fixed_chunk_lines, changed_count = parse_response(fixed_text, current_chunk_lines, response_finish_reason(response))
+        if changed_count is not None:
+            log(f"Chunk {chunk_number}: {changed_count} of {len(current_chunk_lines)} lines changed ({len(fixed_text)} chars returned).")
+        if cache_key is not None:
+            cache.put(cache_key, fixed_text, MODEL_NAME)
+        return fixed_chunk_lines, False
+    finally:
+        # 成功・失敗に関わらず時間を表示
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        log(f"Chunk {chunk_number}: Processing time: {elapsed_time:.2f} seconds")
+
+class CorrectionJob:
+    """
+    One *_strip.txt prepared for correction (see prepare_job): the lines to send, the wordlist,
+    the progress sidecar and the chunk results collected so far.
+    Shared by generate_content (interactive requests) and gemini_batch (Batch API).
+    """
+
+    def __init__(self, input_file, output_file, lines, system_instruction, wordlist_index, wordlist_content, log=print):
+        self.input_file = input_file
+        self.output_file = output_file
+        self.lines = lines
+        self.system_instruction = system_instruction
+        self.wordlist_index = wordlist_index
+        self.wordlist_content = wordlist_content
+        self.log = log
+        # Set in confidence mode: every line of the file and the indices of the low-confidence ones
+        self.all_lines = None
+        self.low_confidence = None
+        self.progress = None
+        # {own_start: (chunk, fixed chunk lines)}
+        self.results = {}
+        self.skipped_lines = 0
+
+    def is_clean(self, chunk):
+        """
+        True if SKIP_CLEAN_CHUNKS is set and none of the lines the chunk owns is suspicious on its own.
+        """
+        _, own_start, end = chunk
+        return (SKIP_CLEAN_CHUNKS and self.wordlist_index is not None
+                and not any(True for _ in self.wordlist_index.suspicious_lines(self.lines[own_start:end])))
+
+    def chunk_system_instruction(self, current_chunk_lines, chunk_number):
+        wordlist_content = self.wordlist_content
+        if WORDLIST_FILTER and self.wordlist_index is not None:
+            terms = self.wordlist_index.select("\n".join(current_chunk_lines), WORDLIST_TOP_N)
+            wordlist_content = self.wordlist_index.render(terms)
+            self.log(f"Chunk {chunk_number}: Wordlist: {len(terms)}/{len(self.wordlist_index.terms)} terms")
+        return build_system_instruction(self.system_instruction, wordlist_content)
+
+    def chunks(self):
+        """
+        Boundaries of the completed chunks, in order.
+        """
+        return [self.results[own_start][0] for own_start in sorted(self.results)]
+
+    def write_output(self):
+        """
+        Stitches the chunk results in order, writes the output file and removes the progress sidecar.
+        Returns the number of lines written.
+        """
+        log = self.log
+        lines = self.lines
+        fixed_lines_all = []
+        for chunk_index, own_start in enumerate(sorted(self.results)):
+            chunk, fixed_chunk_lines = self.results[own_start]
+            fixed_lines_all.extend(stitch_chunk(lines, chunk, fixed_chunk_lines, chunk_index + 1, log))
+        if self.all_lines is not None:
+            # Take the response only for low-confidence lines; context and high-confidence lines stay as they were
+            fixed_by_tag = {}
+            for line in fixed_lines_all:
+                match = TAG_PATTERN.match(line.strip())
+                if match:
+                    fixed_by_tag[int(match.group(1))] = line
+            fixed_lines_all = []
+            for index, line in enumerate(self.all_lines):
+                match = TAG_PATTERN.match(line)
+                if index in self.low_confidence and match:
+                    line = fixed_by_tag.get(int(match.group(1)), line)
+                fixed_lines_all.append(line)
+            lines = self.all_lines
+        missing_total = len(lines) - len(fixed_lines_all)
+        if missing_total > 0:
+            log(f"Warning: {missing_total} lines missing from the responses (revert_vtt restores them from the strip file).")
+
+        temp_file = f"{self.output_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write("\n".join(fixed_lines_all))
+        os.replace(temp_file, self.output_file)
+        self.progress.remove()
+
+        # Keep the caption store written by to_strip in step with _fixed.txt
+        store_file = store_path(self.input_file)
+        if os.path.exists(store_file):
+            try:
+                stored = add_tagged_variant(store_file, 'fixed', fixed_lines_all, self.output_file)
+                log(f"Stored {stored} fixed lines in {store_file}")
+            except (OSError, ValueError) as e:
+                log(f"Warning: Could not update {store_file}: {e}")
+
+        log(f"Saved fixed text to {self.output_file} (Total lines: {len(fixed_lines_all)})")
+        if self.skipped_lines:
+            log(f"Skipped clean lines: {self.skipped_lines}/{len(lines)} ({self.skipped_lines / len(lines):.0%})")
+        return len(fixed_lines_all)
+
+def prepare_job(input_file, system_instruction_file='system_instruction.txt', wordlist_file='wordlist.txt', log=print,
+                overwrite=False):
+    """
+    Reads and pre-corrects input_file (*_strip.txt) and returns a CorrectionJob,
+    or None (after logging why) if it cannot be processed.
+    overwrite: an existing _fixed.txt is replaced once the new one is complete (stale in the pipeline state)
+    instead of being an error.
+    """
+    # Check if files exist
+    if not os.path.exists(input_file):
+        log(f"Error: Input file {input_file} not found.")
+        return None
+    if not os.path.exists(system_instruction_file):
+        log(f"Error: System instruction file {system_instruction_file} not found.")
+        return None
+    # Save output
+    basename = os.path.splitext(os.path.basename(input_file))[0]
+    if basename.endswith('_strip'):
+            basename = basename[:-6]
+    # A caption store (*_captions.bin) can be given instead of the _strip.txt
+    from_store = input_file.endswith(STORE_SUFFIX)
+    if from_store:
+        basename = os.path.basename(input_file)[:-len(STORE_SUFFIX)]
+    output_file = os.path.join(os.path.dirname(input_file), f"{basename}_fixed.txt")
+    if os.path.exists(output_file) and not overwrite:
+        log(f"Error: Output file {output_file} already exists.")
+        return None
+
+    # wordlist might be optional or empty, but specified in requirements
+    wordlist_content = ""
+    wordlist_index = None
+    wordlist_hash = None
+    if os.path.exists(wordlist_file):
+        with open(wordlist_file, 'rb') as f:
+            wordlist_hash = hashlib.sha256(f.read()).hexdigest()
+        if WORDLIST_FILTER or SKIP_CLEAN_CHUNKS:
+            # Only the terms relevant to each chunk are sent with it
+            wordlist_index = get_index(wordlist_file)
+        if not WORDLIST_FILTER:
+            with open(wordlist_file, 'r', encoding='utf-8') as f:
+                wordlist_content = f.read().strip()
+    else:
+        log(f"Warning: Wordlist file {wordlist_file} not found. Proceeding without it.")
+
+    # Read Input Content
+    try:
+        if from_store:
+            with CaptionStore(input_file) as store:
+                lines = list(store.tagged_lines('original'))
+        else:
+            with open(input_file, 'r', encoding='utf-8') as f:
+                # Assumes input file has lines properly separated. 
+                # If input file is previously generated by to_chunk.py, it might contain blank lines.
+                lines = [line.rstrip('\n') for line in f if line.strip()]
+    except Exception as e:
+        log(f"Error reading input file: {e}")
+        return None
+
+    # Read System Instruction
+    try:
+        with open(system_instruction_file, 'r', encoding='utf-8') as f:
+            system_instruction = f.read()
+    except Exception as e:
+        log(f"Error reading system instruction file: {e}")
+        return None
+
+    # Known misrecognitions (頻出誤変換パターン) are fixed locally before any request
+    if PRECORRECT:
+        lines, changes = Precorrector.from_file(system_instruction_file).apply(lines)
+        if changes:
+            log(f"Pre-correction: {len(changes)} lines changed by known patterns")
+            for _, line, new_line in changes:
+                log(f"  {line} -> {new_line}")
+
+    job = CorrectionJob(input_file, output_file, lines, system_instruction, wordlist_index, wordlist_content, log)
+
+    # In confidence mode, only the selected lines go through the chunks
+    if CONFIDENCE_MODE:
+        selection = select_low_confidence(lines, os.path.join(os.path.dirname(input_file), f"{basename}_conf.jsonl"), log)
+        if selection is not None:
+            send_indices, job.low_confidence = selection
+            log(f"Confidence mode: {len(job.low_confidence)} low-confidence lines, sending {len(send_indices)}/{len(lines)} lines with context.")
+            job.all_lines = lines
+            job.lines = [lines[index] for index in send_indices]
+
+    # Chunks completed by an earlier run are not requested again
+    # (as long as they were corrected with the same model, prompt and wordlist)
+    settings = {
+        'config': state_config(),
+        'system_instruction': hashlib.sha256(system_instruction.encode('utf-8')).hexdigest(),
+        'wordlist': wordlist_hash,
+    }
+    job.progress = ChunkProgress(os.path.join(os.path.dirname(input_file), f"{basename}_fixed.progress.jsonl"),
+                                 job.lines, settings)
+    return job
+
+def generate_content(input_file, system_instruction_file='system_instruction.txt', wordlist_file='wordlist.txt',
+                     client=None, log=print, cache=None, overwrite=False):
+    """
+    Corrects input_file (*_strip.txt or *_captions.bin) with Gemini and writes {basename}_fixed.txt.
+    client: shared Gemini client (created here if None)
+    log: function receiving every progress message (print by default)
+    cache: response cache (the default cache from gemini_cache if None)
+    overwrite: replace an existing _fixed.txt when the new one is complete
+    Returns True when the fixed file was written.
+    Raises GenerationTimeoutError when a request times out.
+    """
+    job = prepare_job(input_file, system_instruction_file, wordlist_file, log, overwrite)
+    if job is None:
+        return False
+    lines = job.lines
+    results = job.results
+
+    if client is None:
+        client = create_client(log)
+        if client is None:
+            return False
+
+    # Safety settings
+    safety_settings = get_safety_settings()
+
+    if cache is None:
+        cache = get_default_cache()
 
     total_lines = len(lines)
-    print(f"Total lines to process: {total_lines}")
+    log(f"Total lines to process: {total_lines}")
+    if RESPONSE_MODE == "diff":
+        log("Response mode: diff (only changed lines are returned)")
 
-    fixed_lines_all = []
-    
-    start_index = 0
-    chunk_count = 0
+    # Chunks carry their own overlap context, so they do not depend on each other's output
+    # and can be sent concurrently.
+    progress = job.progress
+    planned = cache.get_plan(progress.input_hash) if cache is not None else None
+    planner = ChunkPlanner(lines, progress.load(log), planned=planned)
+    if planner.saved:
+        log(f"Resuming: {len(planner.saved)} chunks already completed in {progress.path}")
+    if planned:
+        log(f"Reusing the {len(planned)} chunk boundaries of the last complete run")
 
-    system_instruction = f"""
-{system_instruction}
+    log(f"Sending chunks of about {planner.budget:.0f} tokens (max {MAX_IN_FLIGHT} in flight)...")
 
-{wordlist_content}
-"""
+    cache_hits = 0
+    chunk_count = 0
+    # Waiting time between retries is capped per file
+    retry_budget = RetryBudget()
+    failure = None
+    executor = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT)
+    try:
+        futures = {}
+        while True:
+            # Plan the next chunk only when a slot is free, with the budget learned so far
+            while failure is None and len(futures) < MAX_IN_FLIGHT and planner.has_next():
+                chunk, saved_lines = planner.next_chunk()
+                context_start, own_start, end = chunk
+                if saved_lines is not None:
+                    results[own_start] = (chunk, saved_lines)
+                    continue
+                current_chunk_lines = lines[context_start:end]
+                if job.is_clean(chunk):
+                    log(f"Lines {own_start+1} to {end}: No suspicious lines. Skipped.")
+                    results[own_start] = (chunk, current_chunk_lines)
+                    job.skipped_lines += end - own_start
+                    continue
+                chunk_count += 1
+                chunk_system_instruction = job.chunk_system_instruction(current_chunk_lines, chunk_count)
+                future = executor.submit(request_chunk, client, current_chunk_lines, chunk_system_instruction, safety_settings, chunk_count, log, cache,
+                                         retry_budget, not planner.can_split(chunk))
+                futures[future] = (chunk, chunk_count, time.time())
+                log(f"Processing Chunk {chunk_count}: Lines {context_start+1} to {end} ({len(current_chunk_lines)} lines, ~{planner.tokens(chunk):.0f} tokens)...")
 
-    while start_index < total_lines:
-        chunk_count += 1
-        end_index = min(start_index + LINES_PER_CHUNK, total_lines)
-        
-        current_chunk_lines = lines[start_index:end_index]
-        prompt = "\n".join(current_chunk_lines)
+            if not futures:
+                break
 
-        print(f"Processing Chunk {chunk_count}: Lines {start_index+1} to {end_index} ({len(current_chunk_lines)} lines)...")
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk, chunk_number, submitted = futures.pop(future)
+                try:
+                    fixed_chunk_lines, from_cache = future.result()
+                except Exception as e:
+                    truncated = isinstance(e, TruncatedResponseError)
+                    if (truncated or is_timeout(e)) and failure is None and planner.split(chunk):
+                        log(f"Chunk {chunk_number}: {e}. Splitting lines {chunk[1]+1} to {chunk[2]} in two and retrying (budget now ~{planner.budget:.0f} tokens).")
+                        continue
+                    if truncated and e.lines is not None:
+                        # Too small to split: keep what came back, revert_vtt restores the missing lines
+                        log(f"Chunk {chunk_number}: Warning: {e}. Truncating.")
+                        fixed_chunk_lines, from_cache = e.lines, False
+                    else:
+                        # Do not start new chunks, but keep the ones already in flight
+                        if failure is None:
+                            failure = e
+                        if is_timeout(e):
+                            log(f"Error: Request timed out for chunk {chunk_number}: {e}")
+                        else:
+                            log(f"Error during generation for chunk {chunk_number}: {e}")
+                        continue
 
-        print(f"Request sent...")
-        start_time = time.time()  # 計測開始
-        try:
-            response = client.models.generate_content(
-                model="gemini-3-flash-preview",
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    temperature=1.0,
-                    top_p=0.95,
-                    top_k=64,
-                    system_instruction=system_instruction,
-                    safety_settings=safety_settings,
-                    response_mime_type="text/plain",
-                )
-            )
-            
-            fixed_text = response.text
-            # Split response back into lines to handle overlap
-            fixed_chunk_lines = fixed_text.strip().split('\n')
-
-            if(len(fixed_chunk_lines) < len(current_chunk_lines)):
-                print(f"Warning: Response shorter than input ({len(fixed_chunk_lines)} < {len(current_chunk_lines)}). Truncating.")
-
-            # If not the first chunk, remove the overlap from the BEGINNING of the response
-            # because we fed the overlap as context at the beginning of this chunk.
-            if chunk_count > 1:
-                # We assume the model returns the text corresponding to the input.
-                # The first OVERLAP_LINES of the input were context (repeated from prev chunk).
-                # ideally the model output for these lines matches the previous output.
-                # We just drop them to avoid duplication.
-                if len(fixed_chunk_lines) > OVERLAP_LINES:
-                    print(f"  Dropping first {OVERLAP_LINES} lines of response (overlap).")
-                    fixed_chunk_lines = fixed_chunk_lines[OVERLAP_LINES:]
+                if from_cache:
+                    cache_hits += 1
                 else:
-                    # Fallback if response is weirdly short
-                    print(f"  Warning: Response shorter than overlap length ({len(fixed_chunk_lines)} < {OVERLAP_LINES}). Keeping all.")
-            
-            fixed_lines_all.extend(fixed_chunk_lines)
-
-        except Exception as e:
-            # Using string matching for timeout detection as specific exception classes might vary
-            if "timeout" in str(e).lower() or "deadline" in str(e).lower():
-                print(f"Error: Request timed out. Exiting with code 75.: {e}")
-                sys.exit(75)
-            
-            print(f"Error during generation for chunk {chunk_count}: {e}")
-            # Decide weather to ABORT, CONTINUE, or use original lines?
-            # For now, append original lines as fallback or stop? 
-            # Let's stop to be safe, or maybe just print error.
-            # Ideally we might want to retry. For now, just logging error and returning.
-            return
-        finally:
-            # 成功・失敗に関わらず時間を表示
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            print(f"Processing time: {elapsed_time:.2f} seconds")
-
-        # Prepare for next loop
-        # Next chunk starts at end of this chunk MINUS overlap
-        # But wait, the standard logic:
-        # If we want to process 0-3000, then 2950-5950...
-        # start_index for 2nd chunk should be 2950.
-        # Current end_index was 3000.
-        # So next start should be end_index - OVERLAP_LINES.
-        # BUT only if we haven't reached end.
-        
-        if end_index == total_lines:
-            break
+                    planner.record(chunk, time.time() - submitted)
+                results[chunk[1]] = (chunk, fixed_chunk_lines)
+                # Persist right away so the chunk survives a later failure
+                progress.save(chunk, fixed_chunk_lines)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
-        start_index = end_index - OVERLAP_LINES
-        
-        # Avoid infinite loop if overlap >= chunk size (not the case here)
-        if start_index >= end_index: 
-             start_index = end_index # Force progress if config is bad
+    if failure is not None:
+        # _fixed.txt is only assembled once every chunk exists
+        log(f"Saved {len(results)} chunks to {progress.path}. Rerun to request the rest.")
+        if is_timeout(failure):
+            raise GenerationTimeoutError(str(failure)) from failure
+        return False
 
-    
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write("\n".join(fixed_lines_all))
-        
-    print(f"Saved fixed text to {output_file} (Total lines: {len(fixed_lines_all)})")
+    job.write_output()
+    if cache is not None:
+        cache.put_plan(progress.input_hash, job.chunks(), MODEL_NAME)
+        log(f"Cache hits: {cache_hits}/{len(results)} chunks ({cache_hits / max(1, len(results)):.0%})")
+    return True
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -196,4 +839,8 @@ if __name__ == "__main__":
         input_file = sys.argv[1]
         system_instruction_file = sys.argv[2] if len(sys.argv) > 2 else 'batch_st/system_instruction.txt'
         wordlist_file = sys.argv[3] if len(sys.argv) > 3 else 'batch_st/wordlist.txt'
-        generate_content(input_file, system_instruction_file, wordlist_file)
+        try:
+            generate_content(input_file, system_instruction_file, wordlist_file)
+        except GenerationTimeoutError:
+            print("Error: Request timed out. Exiting with code 75.")
+            sys.exit(75)
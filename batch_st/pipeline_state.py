@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import importlib
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# PIPELINE_STATE=0: the batch scripts only check whether the output exists (the former behavior)
+PIPELINE_STATE = os.environ.get("PIPELINE_STATE", "1") != "0"
+STATE_DB = os.environ.get("PIPELINE_STATE_DB", os.path.join(SCRIPT_DIR, ".pipeline_state.sqlite3"))
+# Files larger than this (audio/video) are hashed from samples of their head, middle and tail
+HASH_FULL_MB = float(os.environ.get("PIPELINE_HASH_FULL_MB", 64))
+HASH_SAMPLE_BYTES = 1024 * 1024
+
+# Statuses of a finished run that stand until an input or the config changes.
+# skipped: the script declined the inputs (revert_vtt with too many restored lines) and wrote no output
+FINAL_STATUSES = ('done', 'skipped')
+
+# Stage -> module with state_config() (imported lazily by the stale command)
+STAGES = {
+    'to_vtt': 'to_vtt',
+    'to_strip': 'to_strip',
+    'generate_content': 'generate_content',
+    'revert_vtt': 'revert_vtt',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    stage TEXT NOT NULL,
+    output TEXT NOT NULL,
+    video TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    config TEXT NOT NULL,
+    output_hash TEXT,
+    status TEXT NOT NULL,
+    message TEXT,
+    started REAL,
+    finished REAL,
+    elapsed REAL,
+    PRIMARY KEY (stage, output)
+);
+"""
+
+def hash_file(path):
+    """
+    SHA-256 of a file. Files over HASH_FULL_MB are hashed from their size and three samples,
+    so a multi-GB recording is not read in full.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if size <= HASH_FULL_MB * 1024 * 1024:
+            while True:
+                data = f.read(HASH_SAMPLE_BYTES)
+                if not data:
+                    break
+                digest.update(data)
+            return digest.hexdigest()
+        digest.update(str(size).encode('ascii'))
+        for offset in (0, size // 2, size - HASH_SAMPLE_BYTES):
+            f.seek(offset)
+            digest.update(f.read(HASH_SAMPLE_BYTES))
+    return "sampled:" + digest.hexdigest()
+
+def config_json(config):
+    return json.dumps(config or {}, sort_keys=True, ensure_ascii=False)
+
+class StageCheck:
+    """
+    Decision for one output of a stage: run says whether the stage has to (re)produce it, reason why (or why not).
+    Holds the input hashes and config to record with the result.
+    """
+
+    def __init__(self, stage, video, output, inputs, hashes, config, run, reason):
+        self.stage = stage
+        self.video = video
+        self.output = output
+        self.inputs = inputs
+        self.hashes = hashes
+        self.config = config
+        self.run = run
+        self.reason = reason
+        self.started = None
+
+class PipelineState:
+    """
+    SQLite manifest of the pipeline: for every (stage, output) the input hashes, the config,
+    the output hash, the status and the timings of the last run.
+    File hashes are cached by (size, mtime_ns), so checking an unchanged file costs one stat.
+    Only the driver process opens the database; the workers never touch it.
+    """
+
+    def __init__(self, db_path=STATE_DB):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def file_hash(self, path):
+        """
+        Hash of the file at path, or None if it does not exist.
+        """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        row = self.db.execute("SELECT size, mtime_ns, hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        file_hash = hash_file(path)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                            (path, stat.st_size, stat.st_mtime_ns, file_hash))
+        return file_hash
+
+    def record(self, stage, output):
+        row = self.db.execute(
+            "SELECT video, inputs, config, output_hash, status, message, started, finished, elapsed "
+            "FROM stages WHERE stage = ? AND output = ?", (stage, os.path.abspath(output))).fetchone()
+        if row is None:
+            return None
+        keys = ('video', 'inputs', 'config', 'output_hash', 'status', 'message', 'started', 'finished', 'elapsed')
+        record = dict(zip(keys, row))
+        record['inputs'] = json.loads(record['inputs'])
+        record['config'] = json.loads(record['config'])
+        return record
+
+    def check(self, stage, video, output, inputs, config=None, adopt=True):
+        """
+        Decides whether output of stage is up to date with inputs ({name: path}) and config.
+        An output without a record (produced before the manifest existed) is adopted as done
+        with the current inputs; an output edited after its run is adopted as it is.
+        adopt=False only reports (the stale command).
+        """
+        output = os.path.abspath(output)
+        hashes = {name: self.file_hash(path) for name, path in inputs.items()}
+        decision = StageCheck(stage, video, output, {name: os.path.abspath(path) for name, path in inputs.items()},
+                              hashes, config or {}, True, None)
+        record = self.record(stage, output)
+        exists = os.path.exists(output)
+
+        if record is None:
+            if not exists:
+                decision.reason = "new"
+                return decision
+            decision.run = False
+            decision.reason = "adopted"
+            if adopt:
+                self._write(decision, 'done', output_hash=self.file_hash(output), message="adopted existing output")
+            return decision
+
+        if record['status'] == 'running':
+            # Interrupted (crash, kill): the previous output, if any, is still in place and gets replaced
+            decision.reason = "interrupted"
+        elif record['status'] not in FINAL_STATUSES:
+            decision.reason = f"last run {record['status']}"
+        elif record['status'] == 'done' and not exists:
+            decision.reason = "output missing"
+        else:
+            recorded = {name: value['hash'] for name, value in record['inputs'].items()}
+            changed = sorted(name for name in set(hashes) | set(recorded) if hashes.get(name) != recorded.get(name))
+            changed_config = sorted(key for key in set(decision.config) | set(record['config'])
+                                    if config_json(decision.config.get(key)) != config_json(record['config'].get(key)))
+            if changed:
+                decision.reason = f"input changed: {', '.join(changed)}"
+            elif config is not None and changed_config:
+                decision.reason = f"config changed: {', '.join(changed_config)}"
+            elif record['status'] == 'skipped':
+                decision.run = False
+                decision.reason = f"skipped by the last run ({record['message'] or 'inputs unchanged'})"
+            else:
+                decision.run = False
+                decision.reason = "up to date"
+                output_hash = self.file_hash(output)
+                if output_hash != record['output_hash']:
+                    decision.reason = "output edited (adopted)"
+                    if adopt:
+                        with self.db:
+                            self.db.execute("UPDATE stages SET output_hash = ? WHERE stage = ? AND output = ?",
+                                            (output_hash, stage, output))
+        return decision
+
+    def begin(self, decision):
+        """
+        Marks the stage as running. A stale output is left in place: the scripts write to a temp file
+        and replace it only on success, so an interrupted or failed run keeps the previous output.
+        """
+        decision.started = time.time()
+        self._write(decision, 'running')
+
+    def finish(self, decision, status, message=None, elapsed=None):
+        """
+        Records the result of a run. Only 'done' and 'skipped' (FINAL_STATUSES) stand until the inputs change;
+        any other status is run again.
+        """
+        output_hash = self.file_hash(decision.output) if status == 'done' else None
+        if elapsed is None and decision.started is not None:
+            elapsed = time.time() - decision.started
+        self._write(decision, status, output_hash=output_hash, message=message, elapsed=elapsed)
+
+    def _write(self, decision, status, output_hash=None, message=None, elapsed=None):
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO stages (stage, output, video, inputs, config, output_hash, status, message, started, finished, elapsed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (decision.stage, decision.output, decision.video,
+                 json.dumps({name: {'path': decision.inputs[name], 'hash': decision.hashes[name]} for name in decision.hashes},
+                            ensure_ascii=False),
+                 config_json(decision.config), output_hash, status, message,
+                 decision.started or now, None if status == 'running' else now, elapsed))
+
+    def records(self, stage=None):
+        """
+        Yields (stage, output, record) of every recorded output (of one stage).
+        """
+        query = "SELECT stage, output FROM stages"
+        params = ()
+        if stage:
+            query += " WHERE stage = ?"
+            params = (stage,)
+        for stage_name, output in self.db.execute(query + " ORDER BY stage, video", params).fetchall():
+            yield stage_name, output, self.record(stage_name, output)
+
+    def stale(self, configs=None):
+        """
+        Returns [(stage, video, reason), ...] of the recorded outputs that a run would rebuild:
+        checked against the current files and configs ({stage: config}, None to skip a stage's config),
+        plus the outputs made from a stale output, which will change once it is rebuilt.
+        """
+        configs = configs or {}
+        records = list(self.records())
+        reasons = {}
+        for stage, output, record in records:
+            inputs = {name: value['path'] for name, value in record['inputs'].items()}
+            decision = self.check(stage, record['video'], output, inputs, configs.get(stage), adopt=False)
+            if decision.run:
+                reasons[output] = decision.reason
+        # Downstream of a stale output (e.g. the _fixed.txt of a re-extracted _strip.txt)
+        changed = True
+        while changed:
+            changed = False
+            for stage, output, record in records:
+                if output in reasons:
+                    continue
+                upstream = [name for name, value in record['inputs'].items() if value['path'] in reasons]
+                if upstream:
+                    reasons[output] = f"upstream stale: {', '.join(sorted(upstream))}"
+                    changed = True
+        return [(stage, record['video'], reasons[output]) for stage, output, record in records if output in reasons]
+
+    def forget(self, stage, video=None):
+        """
+        Removes the records of a stage (of one video), so its outputs are adopted or rebuilt on the next run.
+        Returns the number of removed records.
+        """
+        with self.db:
+            if video is None:
+                cursor = self.db.execute("DELETE FROM stages WHERE stage = ?", (stage,))
+            else:
+                cursor = self.db.execute("DELETE FROM stages WHERE stage = ? AND video = ?", (stage, video))
+        return cursor.rowcount
+
+class NoState:
+    """
+    Stand-in for PipelineState when PIPELINE_STATE=0: an output is up to date if it exists.
+    """
+
+    def check(self, stage, video, output, inputs, config=None, adopt=True):
+        exists = os.path.exists(output)
+        return StageCheck(stage, video, os.path.abspath(output), inputs, {}, config or {},
+                          not exists, "already exists" if exists else "new")
+
+    def begin(self, decision):
+        decision.started = time.time()
+
+    def finish(self, decision, status, message=None, elapsed=None):
+        pass
+
+    def close(self):
+        pass
+
+def open_state(log=print):
+    """
+    Returns the PipelineState of STATE_DB, or a NoState if it is disabled or cannot be opened.
+    """
+    if not PIPELINE_STATE:
+        return NoState()
+    try:
+        return PipelineState()
+    except sqlite3.Error as e:
+        log(f"Warning: Could not open the pipeline state {STATE_DB}: {e}. Checking output files only.")
+        return NoState()
+
+def current_config(stage):
+    """
+    state_config() of the stage's script, or None if the script cannot be imported here
+    (e.g. to_vtt without stable_whisper).
+    """
+    try:
+        return importlib.import_module(STAGES[stage]).state_config()
+    except ImportError:
+        return None
+
+if __name__ == "__main__":
+    usage = "Usage: python pipeline_state.py stale [stage] | status | forget <stage> [video]"
+    if len(sys.argv) < 2:
+        print(usage)
+        sys.exit(1)
+
+    command = sys.argv[1]
+    state = PipelineState()
+    if command == "stale":
+        stage_filter = sys.argv[2] if len(sys.argv) > 2 else None
+        configs = {}
+        for stage in STAGES:
+            configs[stage] = current_config(stage)
+            if configs[stage] is None:
+                print(f"Note: the config of {stage} is not compared (its script cannot be imported here)")
+        stale = [item for item in state.stale(configs) if stage_filter in (None, item[0])]
+        for stage, video, reason in stale:
+            print(f"{stage:<17} {video}: {reason}")
+        total = sum(1 for stage, _, _ in state.records(stage_filter))
+        print(f"{len(stale)} of {total} recorded outputs are stale (outputs not recorded yet are not listed)")
+    elif command == "status":
+        summary = state.db.execute(
+            "SELECT stage, status, COUNT(*), SUM(elapsed) FROM stages GROUP BY stage, status ORDER BY stage, status").fetchall()
+        for stage, status, count, elapsed in summary:
+            print(f"{stage:<17} {status:<8} {count:6d} files {elapsed or 0:10.0f} seconds")
+    elif command == "forget" and len(sys.argv) > 2:
+        removed = state.forget(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+        print(f"Removed {removed} records.")
+    else:
+        print(usage)
+        sys.exit(1)
+    state.close()
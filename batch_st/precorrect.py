@@ -0,0 +1,78 @@
+import os
+import re
+import sys
+
+# PRECORRECT=0 disables the local pre-correction
+PRECORRECT = os.environ.get("PRECORRECT", "1") != "0"
+PATTERN_SECTION = "### 頻出誤変換パターン"
+PATTERN_LINE = re.compile(r"^\s*-\s*(.+?)\s*->\s*(.+?)\s*$")
+TAG_PATTERN = re.compile(r"^(\d+-)(.*)$")
+
+def load_patterns(system_instruction_file):
+    """
+    Reads the "頻出誤変換パターン" section of system_instruction.txt and returns [(wrong, correct), ...].
+    """
+    patterns = []
+    in_section = False
+    with open(system_instruction_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('###'):
+                in_section = line.startswith(PATTERN_SECTION)
+                continue
+            if in_section:
+                match = PATTERN_LINE.match(line)
+                if match:
+                    patterns.append((match.group(1), match.group(2)))
+    return patterns
+
+class Precorrector:
+    """
+    Replaces every known misrecognition in one pass.
+    The patterns are compiled into a single regex alternation, longest first,
+    so an overlapping shorter pattern never wins over a longer one.
+    """
+
+    def __init__(self, patterns):
+        self.replacements = dict(patterns)
+        words = sorted(self.replacements, key=len, reverse=True)
+        self.regex = re.compile('|'.join(re.escape(word) for word in words)) if words else None
+
+    @classmethod
+    def from_file(cls, system_instruction_file):
+        return cls(load_patterns(system_instruction_file))
+
+    def correct(self, text):
+        if self.regex is None:
+            return text
+        return self.regex.sub(lambda match: self.replacements[match.group(0)], text)
+
+    def apply(self, lines):
+        """
+        Corrects the text after the tag (NNNN-) of every line.
+        Returns (corrected lines, [(index, original line, corrected line), ...] of the changed lines).
+        """
+        corrected = []
+        changes = []
+        for index, line in enumerate(lines):
+            match = TAG_PATTERN.match(line)
+            new_line = match.group(1) + self.correct(match.group(2)) if match else self.correct(line)
+            if new_line != line:
+                changes.append((index, line, new_line))
+            corrected.append(new_line)
+        return corrected, changes
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python precorrect.py <input_text_file> [system_instruction_file]")
+        print("  Shows the lines the pre-correction would change (the file is not modified).")
+    else:
+        input_file = sys.argv[1]
+        system_instruction_file = sys.argv[2] if len(sys.argv) > 2 else 'batch_st/system_instruction.txt'
+        precorrector = Precorrector.from_file(system_instruction_file)
+        print(f"Loaded {len(precorrector.replacements)} patterns from {system_instruction_file}")
+        with open(input_file, 'r', encoding='utf-8') as f:
+            lines = [line.rstrip('\n') for line in f if line.strip()]
+        _, changes = precorrector.apply(lines)
+        for _, line, new_line in changes:
+            print(f"{line} -> {new_line}")
+        print(f"{len(changes)} of {len(lines)} lines changed.")
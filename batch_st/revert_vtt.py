@@ -1,9 +1,20 @@
-import webvtt
 import sys
 import os
 import re
+import time
 
-RESTORED_COUNT_THRESHOLD = os.getenv("RESTORED_COUNT_THRESHOLD", 100)
+from vtt_stream import rewrite_captions
+from align_lines import align_files, ngrams, similarity, MIN_SIMILARITY
+from caption_store import CaptionStore, store_path, format_tag
+
+RESTORED_COUNT_THRESHOLD = int(os.getenv("RESTORED_COUNT_THRESHOLD", 100))
+# REVERT_ALIGN=0 disables the content alignment when too many lines have to be restored
+REVERT_ALIGN = os.environ.get("REVERT_ALIGN", "1") != "0"
+# Bump when existing _fixed.vtt files have to be written again (see pipeline_state.py)
+STATE_VERSION = 1
+
+def state_config():
+    return {'version': STATE_VERSION, 'align': REVERT_ALIGN, 'threshold': RESTORED_COUNT_THRESHOLD}
 
 def parse_tagged_file(path):
     """
@@ -31,86 +42,235 @@ def parse_tagged_file(path):
         return None
     return mapping
 
-def revert_vtt(original_vtt_path, fixed_txt_path, strip_txt_path=None):
+class TaggedFileReader:
+    """
+    Looks up the lines of a tagged file by tag while reading it once from the top,
+    so only the current line is held in memory. Tags must be asked in ascending order (as the VTT is read).
+    A file whose tags are not in ascending order (checked in a first pass) is loaded with parse_tagged_file instead.
+    """
+    pattern = re.compile(r"^(\d+)\-(.*)")
+
+    def __init__(self, path):
+        self.pending = None
+        self.mapping = None
+        self.file = open(path, 'r', encoding='utf-8')
+        if not self._is_ascending():
+            # e.g. a hand-edited file: fall back to the whole file
+            self.close()
+            self.mapping = parse_tagged_file(path) or {}
+            return
+        self.file.seek(0)
+
+    def _is_ascending(self):
+        last_number = 0
+        while True:
+            line = self._next()
+            if line is None:
+                return True
+            if line[0] < last_number:
+                return False
+            last_number = line[0]
+
+    def _next(self):
+        for line in self.file:
+            match = self.pattern.match(line.rstrip('\n'))
+            if match:
+                return int(match.group(1)), match.group(2)
+        return None
+
+    def get(self, tag):
+        """
+        Content of the line tagged tag, or None. A duplicated tag returns its last line, like parse_tagged_file.
+        """
+        if self.mapping is not None:
+            return self.mapping.get(tag)
+        number = int(tag)
+        found = None
+        while True:
+            if self.pending is None:
+                self.pending = self._next()
+                if self.pending is None:
+                    return found
+            if self.pending[0] > number:
+                return found
+            if self.pending[0] == number:
+                found = self.pending[1]
+            self.pending = None
+
+    def close(self):
+        self.file.close()
+
+class StoreTexts:
+    """
+    One text variant of a caption store, looked up by tag like TaggedFileReader.
+    """
+
+    def __init__(self, store, variant):
+        self.store = store
+        self.variant = variant
+
+    def get(self, tag):
+        return self.store.get(self.variant, tag)
+
+    def close(self):
+        pass
+
+def open_store(store_file, fixed_txt_path, strip_txt_path):
+    """
+    Opens the caption store if its 'original' variant was written with strip_txt_path and its 'fixed' variant
+    stored from fixed_txt_path, both as they are now. Returns None otherwise (the text files are read instead).
+    """
+    if not os.path.exists(store_file):
+        return None
+    try:
+        store = CaptionStore(store_file)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Ignoring {store_file}: {e}")
+        return None
+    if store.is_fresh('original', strip_txt_path) and store.is_fresh('fixed', fixed_txt_path):
+        return store
+    store.close()
+    return None
+
+def revert_vtt(original_vtt_path, fixed_txt_path, strip_txt_path=None, overwrite=False):
+    """
+    Writes the fixed text back into the captions of original_vtt_path as {basename}_fixed.vtt next to fixed_txt_path.
+    When more than RESTORED_COUNT_THRESHOLD lines are missing by tag or drifted (no longer resemble the line
+    with their tag), the fixed lines are aligned to the strip lines
+    by content (align_lines.py) and written back again.
+    overwrite: an existing _fixed.vtt is replaced once the new one is complete (stale in the pipeline state).
+    Returns {'status': 'ok' | 'skipped' (too many restored lines, with 'message'), 'total', 'updated', 'restored', 'unchanged', 'drifted'[, 'aligned']}
+    or {'status': 'error', 'message'}.
+    """
     if not os.path.exists(original_vtt_path):
         print(f"Error: VTT file {original_vtt_path} not found.")
-        return
+        return {'status': 'error', 'message': f"{original_vtt_path} not found"}
     if not os.path.exists(fixed_txt_path):
         print(f"Error: Text file {fixed_txt_path} not found.")
-        return
+        return {'status': 'error', 'message': f"{fixed_txt_path} not found"}
 
     basename = os.path.splitext(os.path.basename(original_vtt_path))[0]
     fixed_dir = os.path.dirname(os.path.abspath(fixed_txt_path))
     output_vtt_path = os.path.join(fixed_dir, f"{basename}_fixed.vtt")
     
-    if os.path.exists(output_vtt_path):
+    if os.path.exists(output_vtt_path) and not overwrite:
         print(f"Error: Output file {output_vtt_path} already exists.")
-        return
+        return {'status': 'error', 'message': f"{output_vtt_path} already exists"}
 
     # Infer strip path if not provided
     if not strip_txt_path:
         strip_txt_path = os.path.join(fixed_dir, f"{basename}_strip.txt")
     
-    strip_map = {}
-    if os.path.exists(strip_txt_path):
-        strip_map = parse_tagged_file(strip_txt_path)
-        if strip_map is None: return # Error reading
-    else:
+    if not os.path.exists(strip_txt_path):
         print(f"Error: Strip file {strip_txt_path} not found.")
-        return
+        return {'status': 'error', 'message': f"{strip_txt_path} not found"}
 
-    fixed_map = parse_tagged_file(fixed_txt_path)
-    if fixed_map is None: return
+    # The caption store has both texts if generate_content stored _fixed.txt there (and it was not edited since)
+    store = open_store(store_path(fixed_txt_path), fixed_txt_path, strip_txt_path)
+    if store is not None:
+        print(f"Reading the texts from {store.path}")
+        strip_map = StoreTexts(store, 'original')
+        fixed_map = StoreTexts(store, 'fixed')
+    else:
+        # Both tagged files are read along with the VTT instead of being loaded
+        try:
+            strip_map = TaggedFileReader(strip_txt_path)
+            fixed_map = TaggedFileReader(fixed_txt_path)
+        except OSError as e:
+            print(f"Error reading {e.filename}: {e}")
+            return {'status': 'error', 'message': f"Error reading {e.filename}: {e}"}
 
-    # Read original VTT
-    try:
-        vtt = webvtt.read(original_vtt_path)
-    except Exception as e:
-        print(f"Error reading VTT file: {e}")
-        return
+    # Stream the original VTT into a temp file: only the caption text changes,
+    # timing lines and everything else are copied as they are
+    temp_vtt_path = f"{output_vtt_path}.tmp"
 
-    updated_count = 0
-    restored_count = 0
-    skipped_count = 0
-    
-    # We must match the index logic of to_strip.py
-    # to_strip.py increments index for every non-empty stripped caption
-    original_strip_index = 0
-    
-    for caption in vtt:
-        original_text_stripped = caption.text.strip()
-        
-        if not original_text_stripped:
-            # Skipped in to_strip workflow
-            continue
+    def write_captions(fixed_get, strip_get):
+        # drifted: updated lines with almost nothing in common with their original (shifted by renumbering)
+        counts = {'total': 0, 'updated': 0, 'restored': 0, 'unchanged': 0, 'drifted': 0}
+
+        def rewrite(caption):
+            original_text_stripped = caption.text.strip()
+            
+            if not original_text_stripped:
+                # Skipped in to_strip workflow
+                return None
             
-        original_strip_index += 1
-        tag = f"{original_strip_index:04d}"
-        
-        if tag in fixed_map:
-            # Update with fixed text
-            caption.text = fixed_map[tag]
-            updated_count += 1
-        elif tag in strip_map:
-            # Restore from strip map (original stripped text)
-            print(f"Line {tag} missing in fixed text. Restored from original strip file.")
-            caption.text = strip_map[tag]
-            restored_count += 1
-        else:
+            # We must match the index logic of to_strip.py
+            # to_strip.py increments index for every non-empty stripped caption
+            counts['total'] += 1
+            tag = format_tag(counts['total'])
+            
+            fixed_text = fixed_get(tag)
+            strip_text = strip_get(tag)
+            if fixed_text is not None:
+                # Update with fixed text
+                counts['updated'] += 1
+                if strip_text not in (None, fixed_text) and similarity(ngrams(fixed_text), ngrams(strip_text)) < MIN_SIMILARITY:
+                    counts['drifted'] += 1
+                return fixed_text
+            if strip_text is not None:
+                # Restore from strip map (original stripped text)
+                print(f"Line {tag} missing in fixed text. Restored from original strip file.")
+                counts['restored'] += 1
+                return strip_text
             # Not in fixed, not in strip. 
             # This implies the strip file provided doesn't match the VTT or something is wrong.
-            skipped_count += 1
+            counts['unchanged'] += 1
+            return None
+
+        rewrite_captions(original_vtt_path, temp_vtt_path, rewrite)
+        return counts
+
+    try:
+        counts = write_captions(fixed_map.get, strip_map.get)
+    except Exception as e:
+        print(f"Error reading VTT file: {e}")
+        if os.path.exists(temp_vtt_path):
+            os.remove(temp_vtt_path)
+        return {'status': 'error', 'message': f"Error reading VTT file: {e}"}
+    finally:
+        strip_map.close()
+        fixed_map.close()
+        if store is not None:
+            store.close()
+
+    if counts['restored'] + counts['drifted'] > RESTORED_COUNT_THRESHOLD and REVERT_ALIGN:
+        # The model merged, split or renumbered lines: map the fixed lines back by content instead of by tag
+        print(f"Too many restored or drifted lines ({counts['restored']} + {counts['drifted']} > {RESTORED_COUNT_THRESHOLD}). "
+              "Aligning the fixed text to the strip text...")
+        start_time = time.time()
+        try:
+            aligned_map, stats = align_files(strip_txt_path, fixed_txt_path)
+        except Exception as e:
+            print(f"Error aligning {fixed_txt_path}: {e}")
+            os.remove(temp_vtt_path)
+            return {'status': 'error', 'message': f"Error aligning {fixed_txt_path}: {e}"}
+        print(f"Aligned in {(time.time() - start_time) * 1000:.0f} ms: "
+              + ', '.join(f"{key}: {value}" for key, value in stats.items()))
+        os.remove(temp_vtt_path)
+        try:
+            counts = write_captions(aligned_map.get, parse_tagged_file(strip_txt_path).get)
+        except Exception as e:
+            print(f"Error reading VTT file: {e}")
+            if os.path.exists(temp_vtt_path):
+                os.remove(temp_vtt_path)
+            return {'status': 'error', 'message': f"Error reading VTT file: {e}"}
+        counts['aligned'] = stats
 
-    if restored_count > RESTORED_COUNT_THRESHOLD:
-        print(f"WARNING: Too many restored lines ({restored_count} > {RESTORED_COUNT_THRESHOLD}).skipped:{fixed_txt_path}")
-        return
+    if counts['restored'] > RESTORED_COUNT_THRESHOLD:
+        print(f"WARNING: Too many restored lines ({counts['restored']} > {RESTORED_COUNT_THRESHOLD}).skipped:{fixed_txt_path}")
+        os.remove(temp_vtt_path)
+        return {'status': 'skipped', 'message': f"too many restored lines ({counts['restored']})", **counts}
 
-    vtt.save(output_vtt_path)
+    os.replace(temp_vtt_path, output_vtt_path)
     print(f"Saved to {output_vtt_path}")
-    print(f"Total processed indices: {original_strip_index}")
-    print(f"Updated lines: {updated_count}")
-    print(f"Restored lines: {restored_count}")
-    print(f"Skipped/Unchanged lines: {skipped_count}")
+    print(f"Total processed indices: {counts['total']}")
+    print(f"Updated lines: {counts['updated']}")
+    print(f"Restored lines: {counts['restored']}")
+    print(f"Skipped/Unchanged lines: {counts['unchanged']}")
+    if counts['drifted']:
+        print(f"WARNING: {counts['drifted']} updated lines differ completely from their original (renumbered lines?)")
+    return {'status': 'ok', **counts}
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
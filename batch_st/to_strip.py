@@ -1,11 +1,51 @@
-import webvtt
 import sys
 import os
+import json
+import hashlib
+from contextlib import nullcontext
+
+from vtt_stream import iter_captions
+from caption_store import CAPTION_STORE, CaptionStoreWriter, store_path, format_tag, file_signature
+
+# Bump when existing _strip.txt files have to be extracted again (see pipeline_state.py)
+STATE_VERSION = 1
+
+def state_config():
+    return {'version': STATE_VERSION}
+
+def conf_path(strip_file):
+    """
+    Confidence sidecar of a strip file: {basename}_conf.jsonl, one line per tag.
+    """
+    base = os.path.splitext(strip_file)[0]
+    if base.endswith('_strip'):
+        base = base[:-6]
+    return f"{base}_conf.jsonl"
+
+def load_segments(vtt_file):
+    """
+    Reads the {vtt_base}_segments.jsonl written by to_vtt, keyed by (start, end) timestamps.
+    Returns None if the VTT has no sidecar.
+    """
+    segments_file = f"{os.path.splitext(vtt_file)[0]}_segments.jsonl"
+    if not os.path.exists(segments_file):
+        return None
+    segments = {}
+    with open(segments_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            segments[(record['start'], record['end'])] = record
+    return segments
 
 def to_chunk(vtt_file, txt_file=None):
+    """
+    Writes the tagged text of vtt_file to txt_file (default: {basename}_strip.txt),
+    and the same captions with their timing to the caption store {basename}_captions.bin.
+    Returns {'status': 'ok', 'lines', 'missing_confidence'} or {'status': 'error', 'message'}.
+    """
     if not os.path.exists(vtt_file):
         print(f"Error: File {vtt_file} not found.")
-        return
+        return {'status': 'error', 'message': f"{vtt_file} not found"}
 
     basename = os.path.splitext(os.path.basename(vtt_file))[0]
     
@@ -14,30 +54,71 @@ def to_chunk(vtt_file, txt_file=None):
     else:
         output_file = txt_file
 
-    text_lines = []
-    
-    # Read VTT file
+    # Confidence of each line, from the segments sidecar of to_vtt
+    segments = load_segments(vtt_file)
+    conf_file = conf_path(output_file)
+    count = 0
+    missing = 0
+    # The store records the content of the strip file it was written with, so a rebuilt one is never paired with it
+    digest = hashlib.sha256()
+    size = 0
+
+    # Stream the captions straight into the output (written to temp files, renamed once complete)
+    temp_file = f"{output_file}.tmp"
+    temp_conf_file = f"{conf_file}.tmp"
+    store_file = store_path(output_file)
     try:
-        for caption in webvtt.read(vtt_file):
-            # Clean up text: remove newlines within a caption if necessary, 
-            # but usually just stripping whitespace is enough.
-            text = caption.text.strip()
-            if text:
-                text_lines.append(text)
+        with open(temp_file, 'w', encoding='utf-8') as f, \
+             (open(temp_conf_file, 'w', encoding='utf-8') if segments is not None else nullcontext()) as conf, \
+             (CaptionStoreWriter(store_file, metadata={'vtt': file_signature(vtt_file)}) if CAPTION_STORE else nullcontext()) as store:
+            for caption in iter_captions(vtt_file):
+                # Clean up text: remove newlines within a caption if necessary,
+                # but usually just stripping whitespace is enough.
+                text = caption.text.strip()
+                if not text:
+                    continue
+                # Add line numbers
+                line = f"{format_tag(count + 1)}-{text}"
+                if count:
+                    line = '\n' + line
+                count += 1
+                f.write(line)
+                data = line.encode('utf-8')
+                digest.update(data)
+                size += len(data)
+                if store is not None:
+                    store.add(caption.start_ms, caption.end_ms, {'original': text})
+
+                if conf is not None:
+                    record = segments.get((caption.start, caption.end))
+                    if record is None:
+                        missing += 1
+                        record = {}
+                    conf.write(json.dumps({
+                        'tag': format_tag(count),
+                        'avg_logprob': record.get('avg_logprob'),
+                        'no_speech_prob': record.get('no_speech_prob'),
+                        'compression_ratio': record.get('compression_ratio'),
+                    }) + '\n')
+            if store is not None:
+                store.variant_metadata['original'] = {'source': os.path.basename(output_file), 'size': size, 'sha256': digest.hexdigest()}
     except Exception as e:
         print(f"Error reading VTT file: {e}")
-        return
+        for path in (temp_file, temp_conf_file):
+            if os.path.exists(path):
+                os.remove(path)
+        return {'status': 'error', 'message': f"Error reading VTT file: {e}"}
 
-    # Add line numbers
-    numbered_lines = []
-    for i, line in enumerate(text_lines):
-        numbered_lines.append(f"{i+1:04d}-{line}")
+    os.replace(temp_file, output_file)
+    print(f"Created {output_file} with {count} lines.")
 
-    # Chunking
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(numbered_lines))
+    if segments is not None:
+        os.replace(temp_conf_file, conf_file)
+        print(f"Created {conf_file} ({missing} lines without confidence).")
+    if CAPTION_STORE:
+        print(f"Created {store_file}.")
 
-    print(f"Created {output_file} with {len(numbered_lines)} lines.")
+    return {'status': 'ok', 'lines': count, 'missing_confidence': missing}
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -1,47 +1,370 @@
 import stable_whisper
+from stable_whisper.result import WhisperResult
+from stable_whisper.text_output import sec2vtt
+import numpy as np
 import os
 import sys
+import json
+import hashlib
+import subprocess
 
-def to_vtt(mp3_file, output_file=None):
-    if not os.path.exists(mp3_file):
-        print(f"Error: File {mp3_file} not found.")
-        return
+MODEL_NAME = 'large-v3'
+SAMPLE_RATE = 16000
+
+VAD_PARAMETERS = dict(
+    min_silence_duration_ms=500, # 無音とみなす最短時間 (デフォルトはもっと短い)
+    speech_pad_ms=400, # 音声区間の前後に余白を持たせる（重要）
+    threshold=0.5 # 感度 (0.5前後で調整)
+)
+
+TRANSCRIBE_OPTIONS = dict(
+    language='ja',
+    vad_filter=True,
+    vad_parameters=VAD_PARAMETERS,
+    condition_on_previous_text=False,
+    word_timestamps=False,
+    repetition_penalty=1.1, # 重複を避ける
+    beam_size=5
+)
+
+# What stable-ts' transcribe does on top of faster-whisper (stable_whisper.non_whisper.transcribe_any):
+# silence suppression by loudness, then to_srt_vtt merges captions shorter than MIN_CAPTION_DURATION.
+# Regrouping only applies to word timestamps, which word_timestamps=False does not produce.
+SUPPRESS_SILENCE_OPTIONS = dict(
+    vad=False,
+    q_levels=20,
+    k_size=5,
+    word_level=True,
+    nonspeech_error=0.1,
+    use_word_position=True
+)
+MIN_CAPTION_DURATION = 0.02
+
+# Bump when existing VTTs have to be transcribed again (see pipeline_state.py)
+STATE_VERSION = 1
+
+def state_config(model_name=MODEL_NAME):
+    """
+    Settings that determine a VTT, recorded with it in the pipeline state.
+    model_name is the model that actually transcribed it (batch_to_vtt workers can run different models).
+    """
+    return {
+        'version': STATE_VERSION,
+        'model': model_name,
+        'transcribe': TRANSCRIBE_OPTIONS,
+        'suppress_silence': SUPPRESS_SILENCE_OPTIONS,
+        'min_caption_duration': MIN_CAPTION_DURATION,
+    }
+
+def load_model(model_name=MODEL_NAME, **model_options):
+    """
+    Load the Whisper model.
+    Loading is expensive (multi-GB weights + CUDA/CTranslate2 init),
+    so batch callers should load once and reuse the model for every file.
+
+    model_options are passed to faster_whisper.WhisperModel
+    (device, device_index, compute_type, cpu_threads, num_workers).
+    """
+    return stable_whisper.load_faster_whisper(model_name, **model_options)
+
+def get_audio_duration(audio_file):
+    """
+    Returns the duration of audio_file in seconds using ffprobe, or None if unknown.
+    """
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries', 'format=duration',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        audio_file
+    ]
+    try:
+        cp = subprocess.run(command, capture_output=True, text=True, check=False)
+        return float(cp.stdout.strip())
+    except (OSError, ValueError):
+        return None
+
+def transcribe(model, audio_file, output_file, cache_file=None, model_name=MODEL_NAME):
+    """
+    Transcribes audio_file into output_file through a journal (see transcribe_to_journal),
+    so a rerun after a crash or OOM resumes where the previous run stopped.
+    model_name is the name model was loaded with, recorded in the journal header.
+    """
+    journal_file = journal_path(output_file)
+    audio = load_pcm(audio_file, cache_file)
+    transcribe_to_journal(model, audio, journal_file, header=journal_header(audio_file, model_name))
+    commit_journals([journal_file], output_file, audio)
+    return True
+
+def pcm_cache_path(audio_file, cache_dir):
+    """
+    Cache file for the decoded PCM of audio_file.
+    Size and mtime of the source are part of the name, so a replaced source is decoded again.
+    """
+    st = os.stat(audio_file)
+    basename = os.path.splitext(os.path.basename(audio_file))[0]
+    return os.path.join(cache_dir, f"{basename}.{st.st_size}-{int(st.st_mtime)}.npy")
+
+def load_pcm(audio_file, cache_file=None):
+    """
+    Decodes any ffmpeg-readable source (mp4, mp3, ...) to 16kHz mono float32 PCM.
+    ffmpeg pipes raw PCM straight into memory, so no intermediate audio file is written.
+
+    With cache_file, the PCM is saved there as .npy (temp file + rename)
+    and later calls memory-map it instead of decoding again.
+    """
+    if cache_file and os.path.exists(cache_file):
+        return np.load(cache_file, mmap_mode='r')
+
+    command = [
+        'ffmpeg',
+        '-nostdin',
+        '-v', 'error',
+        '-i', audio_file,
+        '-vn',                   # ビデオなし
+        '-ac', '1',              # チャンネル: 1 (モノラル)
+        '-ar', str(SAMPLE_RATE), # サンプルレート: 16000 Hz (16kHz)
+        '-f', 'f32le',           # float32 PCM
+        '-'                      # 標準出力へ
+    ]
+    cp = subprocess.run(command, capture_output=True, check=False)
+    if cp.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {audio_file}: {cp.stderr.decode('utf-8', errors='replace').strip()}")
+    audio = np.frombuffer(cp.stdout, dtype=np.float32)
+
+    if cache_file:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        temp_file = f"{cache_file}.tmp.npy"
+        np.save(temp_file, audio)
+        os.replace(temp_file, cache_file)
+        del audio
+        return np.load(cache_file, mmap_mode='r')
+    return audio
+
+def split_on_silence(audio, parts):
+    """
+    Cuts audio into at most `parts` spans of roughly equal speech time.
+    Speech regions come from the same VAD (VAD_PARAMETERS) the transcription uses,
+    and every cut is placed in the middle of the silence between two regions,
+    so no speech region is shared by two spans.
+    Returns a list of (start_sample, end_sample) covering the whole audio.
+    """
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+    speech = get_speech_timestamps(audio, VadOptions(**VAD_PARAMETERS))
+    if parts <= 1 or len(speech) < 2:
+        return [(0, len(audio))]
+
+    total_speech = sum(region['end'] - region['start'] for region in speech)
+    target = total_speech / parts
+
+    spans = []
+    span_start = 0
+    speech_so_far = 0
+    for region, next_region in zip(speech, speech[1:]):
+        speech_so_far += region['end'] - region['start']
+        if len(spans) < parts - 1 and speech_so_far >= target * (len(spans) + 1):
+            cut = (region['end'] + next_region['start']) // 2
+            spans.append((span_start, cut))
+            span_start = cut
+    spans.append((span_start, len(audio)))
+    return spans
+
+def journal_path(output_file, span=None):
+    """
+    Journal of a whole file, or of one (start_sample, end_sample) span of it.
+    Span journals are named after their bounds, so a rerun that cuts the audio
+    differently never resumes from a journal of another span.
+    """
+    if span is None:
+        return f"{output_file}.journal"
+    return f"{output_file}.{span[0]}-{span[1]}.journal"
+
+def journal_header(audio_file, model_name=MODEL_NAME):
+    """
+    First record of a journal: the audio file (size, mtime) and a digest of the settings it is transcribed with.
+    A journal with another header is not resumed.
+    """
+    st = os.stat(audio_file)
+    config = json.dumps(state_config(model_name), sort_keys=True)
+    return {
+        'audio': {'size': st.st_size, 'mtime_ns': st.st_mtime_ns},
+        'config': hashlib.sha256(config.encode('utf-8')).hexdigest(),
+    }
+
+def read_journal(journal_file, header=None):
+    """
+    Reads a journal written by transcribe_to_journal.
+    A record cut off by a crash is removed from the file so appending can continue.
+    With header, a journal written for another audio file or other settings (or without a header) is removed.
+    Returns (last_end_seconds or None, complete).
+    """
+    if not os.path.exists(journal_file):
+        return None, False
+
+    last_end = None
+    complete = False
+    valid_size = 0
+    with open(journal_file, 'rb') as f:
+        for number, raw in enumerate(f):
+            if not raw.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                break
+            if number == 0 and header is not None and record.get('header') != header:
+                print(f"Discarding {journal_file}: written for another audio file or settings")
+                break
+            valid_size += len(raw)
+            if 'header' in record:
+                continue
+            if record.get('complete'):
+                complete = True
+            else:
+                last_end = record['end']
+
+    if valid_size == 0:
+        os.remove(journal_file)
+    elif valid_size < os.path.getsize(journal_file):
+        with open(journal_file, 'r+b') as f:
+            f.truncate(valid_size)
+    return last_end, complete
+
+def iter_journal(journal_file):
+    with open(journal_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if not record.get('complete') and 'header' not in record:
+                yield record
+
+def transcribe_to_journal(model, audio, journal_file, start=0, end=None, header=None):
+    """
+    Transcribes audio[start:end] and appends every segment to journal_file
+    (one JSON line, flushed and fsynced) as soon as it is decoded.
+    Segments are not kept in memory.
+    header (see journal_header) is written as the first line of a new journal.
+    If the journal already has segments under the same header, decoding resumes from the end of the last one.
+    Returns the number of segments written by this call.
+    """
+    if end is None:
+        end = len(audio)
+
+    last_end, complete = read_journal(journal_file, header)
+    if complete:
+        return 0
+
+    resume_sample = start
+    if last_end is not None:
+        resume_sample = max(start, min(end, int(last_end * SAMPLE_RATE)))
+        print(f"Resuming {journal_file} from {last_end:.2f} seconds")
+
+    offset = resume_sample / SAMPLE_RATE
+    span_end = end / SAMPLE_RATE
+    count = 0
+
+    with open(journal_file, 'a', encoding='utf-8') as journal:
+        if header is not None and journal.tell() == 0:
+            journal.write(json.dumps({'header': header}) + '\n')
+        if resume_sample < end:
+            # stable-ts keeps faster-whisper's generator based transcribe as transcribe_original,
+            # which yields segments while decoding instead of returning them all at the end
+            segments, _ = model.transcribe_original(
+                np.ascontiguousarray(audio[resume_sample:end], dtype=np.float32),
+                **TRANSCRIBE_OPTIONS
+            )
+            for segment in segments:
+                # Keep every segment inside its own span so neighbouring spans never overlap
+                record = {
+                    'start': min(segment.start + offset, span_end),
+                    'end': min(segment.end + offset, span_end),
+                    'text': segment.text,
+                    # Whisper's confidence of the segment, written to the segments sidecar
+                    'avg_logprob': segment.avg_logprob,
+                    'no_speech_prob': segment.no_speech_prob,
+                    'compression_ratio': segment.compression_ratio,
+                }
+                journal.write(json.dumps(record, ensure_ascii=False) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+                count += 1
+
+        journal.write(json.dumps({'complete': True}) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+    return count
+
+def segments_path(vtt_file):
+    """
+    Confidence sidecar of a VTT: {vtt_base}_segments.jsonl, one line per caption.
+    """
+    return f"{os.path.splitext(vtt_file)[0]}_segments.jsonl"
+
+def commit_journals(journal_files, output_file, audio=None):
+    """
+    Writes the segments of the journals (in order) to output_file as VTT,
+    and their confidence (avg_logprob, no_speech_prob, compression_ratio) to segments_path(output_file).
+    The segments go through the same stable-ts post-processing as model.transcribe + to_srt_vtt:
+    silence suppression against audio (the whole PCM the journals were decoded from; skipped when None)
+    and merging of captions shorter than MIN_CAPTION_DURATION.
+    Both are written to temp files and renamed, so output_file is either complete or absent.
+    The journals are removed once the VTT is in place.
+    Returns the number of captions written.
+    """
+    records = [record for journal_file in journal_files for record in iter_journal(journal_file)]
+    result = WhisperResult(dict(language=TRANSCRIBE_OPTIONS['language'], segments=records), force_order=True)
+    if audio is not None and result.segments:
+        result.adjust_by_silence(np.array(audio, dtype=np.float32), sample_rate=SAMPLE_RATE, **SUPPRESS_SILENCE_OPTIONS)
+        result.set_current_as_orig()
+    # Merge here rather than inside to_srt_vtt, so the sidecar has one line per written caption
+    result.apply_min_dur(MIN_CAPTION_DURATION, inplace=True)
+
+    temp_file = f"{output_file}.tmp"
+    segments_file = segments_path(output_file)
+    temp_segments_file = f"{segments_file}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        f.write(result.to_srt_vtt(word_level=False, min_dur=MIN_CAPTION_DURATION, vtt=True))
+    with open(temp_segments_file, 'w', encoding='utf-8') as segments:
+        for segment in result.segments:
+            # Journals written before the confidence was recorded have no metrics (None)
+            segments.write(json.dumps({
+                'start': sec2vtt(segment.start),
+                'end': sec2vtt(segment.end),
+                'avg_logprob': segment.avg_logprob,
+                'no_speech_prob': segment.no_speech_prob,
+                'compression_ratio': segment.compression_ratio,
+            }) + '\n')
+    os.replace(temp_segments_file, segments_file)
+    os.replace(temp_file, output_file)
+
+    for journal_file in journal_files:
+        os.remove(journal_file)
+    return len(result.segments)
+
+def to_vtt(audio_file, output_file=None, model=None, cache_dir=None):
+    if not os.path.exists(audio_file):
+        print(f"Error: File {audio_file} not found.")
+        return False
 
     if output_file is None:
-        basename = os.path.splitext(os.path.basename(mp3_file))[0]
+        basename = os.path.splitext(os.path.basename(audio_file))[0]
         output_file = f"{basename}.vtt"
 
     if os.path.exists(output_file):
         print(f"スキップ: {output_file} (すでに存在します)")
-        return
-
-    print(f"Processing {mp3_file}")
-
-    model = stable_whisper.load_faster_whisper('large-v3')
-    result = model.transcribe(mp3_file,
-        language='ja',
-        vad_filter=True,
-        vad_parameters=dict(
-            min_silence_duration_ms=500, # 無音とみなす最短時間 (デフォルトはもっと短い)
-            speech_pad_ms=400, # 音声区間の前後に余白を持たせる（重要）
-            threshold=0.5 # 感度 (0.5前後で調整)
-        ),
-        condition_on_previous_text=False,
-        word_timestamps=False,
-        repetition_penalty=1.1, # 重複を避ける
-        beam_size=5
-    )
+        return False
 
-    try:
-        result.to_srt_vtt(output_file, word_level=False)
-    except AttributeError as e:
-        print(f"Failed to find saving methods: {e}")
+    print(f"Processing {audio_file}")
+
+    if model is None:
+        model = load_model()
+    cache_file = pcm_cache_path(audio_file, cache_dir) if cache_dir else None
+    return transcribe(model, audio_file, output_file, cache_file)
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python to_vtt.py <mp3_file> [vtt_file]")
+        print("Usage: python to_vtt.py <audio_or_video_file> [vtt_file]")
     else:
-        mp3_file = sys.argv[1]
+        audio_file = sys.argv[1]
         vtt_file = sys.argv[2] if len(sys.argv) > 2 else None
-        to_vtt(mp3_file, vtt_file)
-
+        to_vtt(audio_file, vtt_file, cache_dir=os.getenv("PCM_CACHE_DIR"))
@@ -0,0 +1,159 @@
+import os
+import re
+import sys
+import time
+
+# "00:01:02.345 --> 00:01:04.000 align:start" (the hours are optional)
+TIMING_PATTERN = re.compile(r"^\s*(\S+)\s+-->\s+(\S+)")
+TIMESTAMP_PATTERN = re.compile(r"^(?:(\d+):)?(\d{2}):(\d{2})[.,](\d{3})$")
+
+def normalize_timestamp(timestamp):
+    """
+    'MM:SS.mmm' or 'H:MM:SS.mmm' -> 'HH:MM:SS.mmm', the form to_vtt writes (and webvtt-py returned).
+    """
+    match = TIMESTAMP_PATTERN.match(timestamp)
+    if not match:
+        return timestamp
+    hours, minutes, seconds, milliseconds = match.groups()
+    return f"{int(hours or 0):02d}:{minutes}:{seconds}.{milliseconds}"
+
+def timestamp_ms(timestamp):
+    """
+    'HH:MM:SS.mmm' (or 'MM:SS.mmm') -> milliseconds.
+    """
+    match = TIMESTAMP_PATTERN.match(timestamp)
+    if not match:
+        raise ValueError(f"Invalid timestamp {timestamp!r}")
+    hours, minutes, seconds, milliseconds = match.groups()
+    return ((int(hours or 0) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(milliseconds)
+
+def format_timestamp_ms(milliseconds):
+    hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
+
+def _line_ending(raw):
+    if raw.endswith('\r\n'):
+        return '\r\n'
+    return '\n' if raw.endswith('\n') else ''
+
+class Cue:
+    """
+    One caption of a VTT. The raw lines are kept so an unchanged cue is written back byte-for-byte.
+    """
+    __slots__ = ('identifier', 'start', 'end', 'lines', 'head', 'body', 'tail')
+
+    def __init__(self, head, body, tail):
+        # head: [identifier line,] timing line / body: text lines / tail: the blank lines after the cue
+        self.head = head
+        self.body = body
+        self.tail = tail
+        timing = head[-1]
+        self.identifier = head[0].rstrip('\r\n') if len(head) > 1 else None
+        match = TIMING_PATTERN.match(timing)
+        self.start = normalize_timestamp(match.group(1))
+        self.end = normalize_timestamp(match.group(2))
+        self.lines = [line.rstrip('\r\n') for line in body]
+
+    @property
+    def start_ms(self):
+        return timestamp_ms(self.start)
+
+    @property
+    def end_ms(self):
+        return timestamp_ms(self.end)
+
+    @property
+    def text(self):
+        return '\n'.join(self.lines)
+
+    def raw(self, text=None):
+        """
+        The cue as written in the file, or with its text replaced by text.
+        The identifier, the timing line (cue settings included) and the separating blank lines are kept as they are.
+        """
+        if text is None:
+            return ''.join(self.head + self.body + self.tail)
+        newline = _line_ending(self.head[-1]) or '\n'
+        return ''.join(self.head) + text + newline + ''.join(self.tail)
+
+def _iter_blocks(f):
+    """
+    Yields (lines, blank lines after them) for every block of the file, reading one line at a time.
+    """
+    block = []
+    blank = []
+    for raw in f:
+        if raw.strip():
+            if blank:
+                yield block, blank
+                block, blank = [], []
+            block.append(raw)
+        else:
+            blank.append(raw)
+    if block or blank:
+        yield block, blank
+
+def _is_cue(block):
+    return any('-->' in line for line in block[:2])
+
+def iter_blocks(f):
+    """
+    Yields ('header' | 'cue' | 'other', item) for a VTT opened with newline='' (so line endings are kept).
+    item is a Cue for 'cue' and the raw text for the header and other blocks (NOTE, STYLE, REGION).
+    Raises ValueError if the file does not start with WEBVTT.
+    """
+    first = True
+    for block, blank in _iter_blocks(f):
+        if first:
+            first = False
+            if not block or not block[0].lstrip('\ufeff').startswith('WEBVTT'):
+                raise ValueError("Not a WebVTT file (missing WEBVTT header)")
+            yield 'header', ''.join(block + blank)
+        elif _is_cue(block):
+            timing_index = 0 if '-->' in block[0] else 1
+            yield 'cue', Cue(block[:timing_index + 1], block[timing_index + 1:], blank)
+        else:
+            yield 'other', ''.join(block + blank)
+
+def iter_captions(vtt_file):
+    """
+    Yields the cues of vtt_file one by one. Only the current cue is held in memory.
+    """
+    with open(vtt_file, 'r', encoding='utf-8', newline='') as f:
+        for kind, item in iter_blocks(f):
+            if kind == 'cue':
+                yield item
+
+def rewrite_captions(vtt_file, output_file, rewrite):
+    """
+    Copies vtt_file to output_file in one pass, replacing the text of each cue with rewrite(cue).
+    rewrite returns None to keep the cue as it is. Everything else (header, NOTE/STYLE blocks,
+    identifiers, timing lines, blank lines) is copied byte-for-byte.
+    Returns the number of cues.
+    """
+    count = 0
+    with open(vtt_file, 'r', encoding='utf-8', newline='') as f, \
+         open(output_file, 'w', encoding='utf-8', newline='') as out:
+        for kind, item in iter_blocks(f):
+            if kind == 'cue':
+                out.write(item.raw(rewrite(item)))
+                count += 1
+            else:
+                out.write(item)
+    return count
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python vtt_stream.py <vtt_file>")
+        print("  Counts the captions of a VTT file without loading it.")
+    else:
+        start_time = time.time()
+        count = 0
+        empty = 0
+        for caption in iter_captions(sys.argv[1]):
+            count += 1
+            empty += not caption.text.strip()
+        print(f"{sys.argv[1]}: {count} captions ({empty} empty) in {time.time() - start_time:.2f} seconds, "
+              f"{os.path.getsize(sys.argv[1]) / 1024 / 1024:.1f} MB")
@@ -0,0 +1,177 @@
+import os
+import sys
+import time
+import threading
+import unicodedata
+
+# SudachiPy is installed with ginza. Without it, readings fall back to kana normalization only.
+try:
+    from sudachipy import dictionary as sudachi_dictionary
+except ImportError:
+    sudachi_dictionary = None
+
+# WORDLIST_FILTER=0 sends the whole wordlist with every chunk
+WORDLIST_FILTER = os.environ.get("WORDLIST_FILTER", "1") != "0"
+# Maximum number of terms sent with one chunk
+WORDLIST_TOP_N = int(os.environ.get("WORDLIST_TOP_N", 300))
+# Readings shorter than this match almost anything, so only their surface is used
+MIN_READING_LENGTH = 3
+# A reading-only match flags a line as suspicious only for readings at least this long
+# that are not a common word themselves (いっかい of 1階 also reads 一回)
+SUSPICIOUS_MIN_READING_LENGTH = int(os.environ.get("SUSPICIOUS_MIN_READING_LENGTH", 4))
+
+def to_hiragana(text):
+    """
+    Converts katakana to hiragana so that 'ロックマン' and 'ろっくまん' compare equal.
+    """
+    return ''.join(chr(ord(c) - 0x60) if 'ァ' <= c <= 'ヶ' else c for c in text)
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text).casefold()
+
+class WordlistIndex:
+    """
+    Index of wordlist.txt built once: each term with its normalized surface and kana reading.
+    select() returns only the terms whose surface or reading occurs in a chunk,
+    so misrecognized homophones (same reading, other characters) still match.
+    """
+
+    def __init__(self, lines):
+        self.header = [line for line in lines if line.startswith('#')]
+        self.terms = [line for line in lines if line.strip() and not line.startswith('#')]
+        self._tokenizer = sudachi_dictionary.Dictionary().create() if sudachi_dictionary else None
+        self._lock = threading.Lock()
+
+        self.entries = []
+        for term in self.terms:
+            surface = normalize(term)
+            reading = self.reading(term)
+            if len(reading) < MIN_READING_LENGTH or reading == surface:
+                reading = None
+            self.entries.append((term, surface, reading))
+        # Terms whose reading-only match makes a line suspicious
+        self.suspects = {term for term, surface, reading in self.entries
+                         if reading and len(reading) >= SUSPICIOUS_MIN_READING_LENGTH
+                         and not self.is_other_word(reading, surface)}
+
+    @classmethod
+    def from_file(cls, wordlist_file):
+        with open(wordlist_file, 'r', encoding='utf-8') as f:
+            return cls([line.rstrip('\n') for line in f])
+
+    def reading(self, text):
+        """
+        Kana (hiragana) reading of text. Without SudachiPy only katakana is converted.
+        """
+        text = normalize(text)
+        if self._tokenizer is None:
+            return to_hiragana(text)
+        # The tokenizer is not thread-safe, and its input size is limited, so go line by line
+        with self._lock:
+            return '\n'.join(
+                to_hiragana(''.join(m.reading_form() or m.surface() for m in self._tokenizer.tokenize(line)))
+                for line in text.split('\n')
+            )
+
+    def is_other_word(self, reading, surface):
+        """
+        True if reading is itself a dictionary word other than surface (いっかい: 一回 for 1階),
+        so it also occurs in lines that need no correction. Always False without SudachiPy.
+        """
+        if self._tokenizer is None:
+            return False
+        with self._lock:
+            morphemes = list(self._tokenizer.tokenize(reading))
+        return (len(morphemes) == 1 and not morphemes[0].is_oov()
+                and normalize(morphemes[0].normalized_form()) != surface)
+
+    def matches(self, text):
+        """
+        Returns (rank, count, length, term) of every term occurring in text.
+        rank is 2 for a surface match and 1 for a reading-only match (a likely misrecognition).
+        """
+        surface_text = normalize(text)
+        reading_text = self.reading(text)
+        surface_bigrams = {surface_text[i:i + 2] for i in range(len(surface_text) - 1)}
+        reading_bigrams = {reading_text[i:i + 2] for i in range(len(reading_text) - 1)}
+
+        scored = []
+        for term, surface, reading in self.entries:
+            count = 0
+            rank = 0
+            if (len(surface) < 2 or surface[:2] in surface_bigrams) and surface in surface_text:
+                count = surface_text.count(surface)
+                rank = 2
+            elif reading and reading[:2] in reading_bigrams and reading in reading_text:
+                count = reading_text.count(reading)
+                rank = 1
+            if rank:
+                scored.append((rank, count, len(term), term))
+        return scored
+
+    def select(self, text, top_n=WORDLIST_TOP_N):
+        """
+        Returns the terms relevant to text, at most top_n.
+        Surface matches rank before reading-only matches, then by occurrence count, then by length.
+        """
+        scored = sorted(self.matches(text), reverse=True)
+        return [term for _, _, _, term in scored[:top_n]]
+
+    def reading_only_terms(self, text):
+        """
+        Terms whose reading occurs in text but not their surface: candidates for a misrecognition.
+        Only terms in suspects (a long reading that is not another word) count.
+        """
+        return [term for rank, _, _, term in self.matches(text) if rank == 1 and term in self.suspects]
+
+    def suspicious_lines(self, lines):
+        """
+        Yields the index of every line with a reading-only term, each line judged on its own
+        (a correct surface on another line does not hide a misrecognition).
+        Same result as reading_only_terms(line) per line, but each line is only checked
+        against the terms whose reading occurs somewhere in lines.
+        """
+        reading_lines = self.reading('\n'.join(lines)).split('\n')
+        reading_text = '\n'.join(reading_lines)
+        candidates = [(surface, reading) for term, surface, reading in self.entries
+                      if term in self.suspects and reading in reading_text]
+        if not candidates:
+            return
+        for index, (line, reading_line) in enumerate(zip(lines, reading_lines)):
+            surface_line = normalize(line)
+            if any(reading in reading_line and surface not in surface_line for surface, reading in candidates):
+                yield index
+
+    def render(self, terms):
+        """
+        Wordlist text in the same layout as wordlist.txt.
+        """
+        return '\n'.join(self.header + list(terms))
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(wordlist_file):
+    """
+    Returns the index of wordlist_file, built once per process.
+    """
+    key = (os.path.abspath(wordlist_file), os.path.getmtime(wordlist_file))
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = WordlistIndex.from_file(wordlist_file)
+        return _indexes[key]
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python wordlist_filter.py <wordlist_file> <text_file> [top_n]")
+    else:
+        start_time = time.time()
+        index = get_index(sys.argv[1])
+        print(f"Indexed {len(index.terms)} terms in {time.time() - start_time:.2f} seconds (SudachiPy: {'yes' if sudachi_dictionary else 'no'})")
+        with open(sys.argv[2], 'r', encoding='utf-8') as f:
+            text = f.read()
+        top_n = int(sys.argv[3]) if len(sys.argv) > 3 else WORDLIST_TOP_N
+        start_time = time.time()
+        terms = index.select(text, top_n)
+        print(f"Selected {len(terms)} terms in {time.time() - start_time:.3f} seconds")
+        print('\n'.join(terms))
@@ -5,6 +5,43 @@ from google import genai
 from google.genai import types
 from google.genai.types import HttpOptions
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'batch_st'))
+from gemini_retry import RetryBudget, call_with_retry, is_timeout
+
+# A request that times out is split in two, down to this many titles
+MIN_SPLIT_TITLES = 50
+
+
+def request_game_titles(client, titles, config, budget):
+    """
+    Sends titles to Gemini and returns one game title per input title.
+    Rate limit and server errors are retried; on a timeout the titles are split in two
+    and each half is requested separately.
+    """
+    can_split = len(titles) >= 2 * MIN_SPLIT_TITLES
+    try:
+        response = call_with_retry(
+            client.models.generate_content,
+            model="gemini-2.5-flash",
+            contents="\n".join(titles),
+            config=config,
+            budget=budget, retry_timeouts=not can_split, label=f"Request ({len(titles)} titles)"
+        )
+    except Exception as e:
+        if can_split and is_timeout(e):
+            middle = len(titles) // 2
+            print(f"Request timed out for {len(titles)} titles. Splitting into {middle} + {len(titles) - middle} titles.")
+            return (request_game_titles(client, titles[:middle], config, budget)
+                    + request_game_titles(client, titles[middle:], config, budget))
+        raise
+
+    game_titles = response.text.strip().split('\n')
+
+    # Verify the count matches
+    if len(game_titles) != len(titles):
+        print(f"Warning: Number of game titles ({len(game_titles)}) doesn't match input titles ({len(titles)})")
+    return game_titles
+
 
 def extract_gametitle(input_file='videos/videos.ndjson', output_file='game_title.txt'):
     """
@@ -110,31 +147,20 @@ def extract_gametitle(input_file='videos/videos.ndjson', output_file='game_title
 出力: 不明
 """
     
-    # Create prompt with all titles
-    prompt = "\n".join(titles)
+    config = types.GenerateContentConfig(
+        temperature=0.3,  # Lower temperature for more consistent extraction
+        top_p=0.95,
+        top_k=64,
+        system_instruction=system_instruction,
+        safety_settings=safety_settings,
+        response_mime_type="text/plain",
+    )
     
     print("Sending request to Gemini API...")
     
     try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                temperature=0.3,  # Lower temperature for more consistent extraction
-                top_p=0.95,
-                top_k=64,
-                system_instruction=system_instruction,
-                safety_settings=safety_settings,
-                response_mime_type="text/plain",
-            )
-        )
-        
-        result_text = response.text
-        game_titles = result_text.strip().split('\n')
-        
-        # Verify the count matches
-        if len(game_titles) != len(titles):
-            print(f"Warning: Number of game titles ({len(game_titles)}) doesn't match input titles ({len(titles)})")
+        # Send all titles at once (split only if the request times out)
+        game_titles = request_game_titles(client, titles, config, RetryBudget())
         
         # Sort and deduplicate the game titles (like sort | uniq)
         unique_game_titles = sorted(set(title.strip() for title in game_titles))
@@ -148,7 +174,7 @@ def extract_gametitle(input_file='videos/videos.ndjson', output_file='game_title
         return True
         
     except Exception as e:
-        if "timeout" in str(e).lower() or "deadline" in str(e).lower():
+        if is_timeout(e):
             print(f"Error: Request timed out: {e}")
             sys.exit(75)
         
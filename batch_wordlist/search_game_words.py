@@ -5,6 +5,9 @@ from google import genai
 from google.genai import types
 from google.genai.types import HttpOptions
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'batch_st'))
+from gemini_retry import RetryBudget, call_with_retry, is_timeout
+
 
 def sanitize_filename(title):
     """
@@ -112,6 +115,8 @@ def search_game_words(input_file='game_title.txt', output_dir='dictionary'):
     
     processed_count = 0
     skipped_count = 0
+    # One retry budget for the whole run, so an exhausted quota does not stall every title in turn
+    retry_budget = RetryBudget()
     
     for i, title in enumerate(game_titles):
         # Create output file path
@@ -130,7 +135,8 @@ def search_game_words(input_file='game_title.txt', output_dir='dictionary'):
 {title}"""
         
         try:
-            response = client.models.generate_content(
+            response = call_with_retry(
+                client.models.generate_content,
                 model="gemini-3-pro-preview",
                 contents=prompt,
                 config=types.GenerateContentConfig(
@@ -141,7 +147,8 @@ def search_game_words(input_file='game_title.txt', output_dir='dictionary'):
                     safety_settings=safety_settings,
                     tools=[google_search_tool],
                     response_mime_type="text/plain",
-                )
+                ),
+                budget=retry_budget, label=f"  {title}"
             )
             
             result_text = response.text
@@ -156,7 +163,7 @@ def search_game_words(input_file='game_title.txt', output_dir='dictionary'):
             processed_count += 1
             
         except Exception as e:
-            if "timeout" in str(e).lower() or "deadline" in str(e).lower():
+            if is_timeout(e):
                 print(f"Error: Request timed out for {title}: {e}")
                 continue
             
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the streaming VTT reader/writer (batch_st/vtt_stream.py) against webvtt-py.
+
+This script:
+1. Writes a synthetic VTT with N captions (default 50000) to a temp directory
+2. Runs to_strip and revert_vtt on it through vtt_stream
+3. Runs the same steps the way the scripts did with webvtt-py (if it is installed)
+4. Prints the time and the peak Python memory (tracemalloc) of each step
+
+Usage: python utility/bench_vtt_stream.py [captions]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'batch_st'))
+
+from to_strip import to_chunk
+from revert_vtt import revert_vtt, parse_tagged_file
+
+try:
+    import webvtt
+except ImportError:
+    webvtt = None
+
+
+def write_synthetic_vtt(path: str, captions: int) -> None:
+    """
+    Writes captions of 2-3 seconds with Japanese text, every 50th caption empty (as Whisper sometimes does).
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("WEBVTT\n\n")
+        for i in range(captions):
+            start = i * 2.5
+            end = start + 2.0
+            text = '' if i % 50 == 49 else f"今日はロックマンの{i}面をクリアしていきたいと思います"
+            f.write(f"{format_seconds(start)} --> {format_seconds(end)}\n{text}\n\n")
+
+
+def format_seconds(seconds: float) -> str:
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
+
+
+def webvtt_to_strip(vtt_file: str, output_file: str) -> None:
+    """
+    to_strip.to_chunk as it was with webvtt-py.
+    """
+    text_lines = []
+    for caption in webvtt.read(vtt_file):
+        text = caption.text.strip()
+        if text:
+            text_lines.append(text)
+    numbered_lines = [f"{i+1:04d}-{line}" for i, line in enumerate(text_lines)]
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(numbered_lines))
+
+
+def webvtt_revert(vtt_file: str, fixed_file: str, output_file: str) -> None:
+    """
+    revert_vtt.revert_vtt as it was with webvtt-py (without the strip file fallback).
+    """
+    fixed_map = parse_tagged_file(fixed_file)
+    vtt = webvtt.read(vtt_file)
+    index = 0
+    for caption in vtt:
+        if not caption.text.strip():
+            continue
+        index += 1
+        tag = f"{index:04d}"
+        if tag in fixed_map:
+            caption.text = fixed_map[tag]
+    vtt.save(output_file)
+
+
+def measure(label: str, outputs: list[str], func, *args) -> None:
+    """
+    Runs func twice: once for the time, once under tracemalloc for the peak memory
+    (tracing slows Python down too much to time it at the same time).
+    outputs are removed before each run, as revert_vtt refuses to overwrite its output.
+    """
+    results = []
+    for trace in (False, True):
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+        if trace:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            func(*args)
+        results.append(time.perf_counter() - start_time)
+        if trace:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    print(f"{label:<28} {results[0]:8.2f} s {peak / 1024 / 1024:10.1f} MB")
+
+
+def main() -> None:
+    captions = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        vtt_file = os.path.join(work_dir, "bench.vtt")
+        strip_file = os.path.join(work_dir, "bench_strip.txt")
+        fixed_file = os.path.join(work_dir, "bench_fixed.txt")
+        write_synthetic_vtt(vtt_file, captions)
+        print(f"{captions} captions, {os.path.getsize(vtt_file) / 1024 / 1024:.1f} MB")
+        print(f"{'step':<28} {'time':>10} {'peak memory':>13}")
+
+        measure("vtt_stream: to_strip", [strip_file], to_chunk, vtt_file, strip_file)
+
+        # The "corrected" text: every 10th line changed, about what Gemini corrects in a real transcript
+        with open(strip_file, 'r', encoding='utf-8') as f, open(fixed_file, 'w', encoding='utf-8') as out:
+            out.write('\n'.join(line.replace('ロックマン', 'ロックマン2') if i % 10 == 0 else line
+                                 for i, line in enumerate(f.read().split('\n'))))
+
+        measure("vtt_stream: revert_vtt", [os.path.join(work_dir, "bench_fixed.vtt")], revert_vtt, vtt_file, fixed_file, strip_file)
+
+        if webvtt is None:
+            print("webvtt-py is not installed: skipped the comparison (pip install -r utility/requirements-bench.txt)")
+            return
+
+        webvtt_strip_file = os.path.join(work_dir, "webvtt_strip.txt")
+        webvtt_vtt_file = os.path.join(work_dir, "webvtt_fixed.vtt")
+        measure("webvtt-py: to_strip", [webvtt_strip_file], webvtt_to_strip, vtt_file, webvtt_strip_file)
+        measure("webvtt-py: revert_vtt", [webvtt_vtt_file], webvtt_revert, vtt_file, fixed_file, webvtt_vtt_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Exercises the Gemini Batch API layer (batch_st/gemini_batch.py) against an in-process stand-in client,
+without network access or an API key.
+
+This script:
+1. submit -> fail -> resubmit -> collect: the stand-in fails some items of the first job,
+   only those are resubmitted and every result is collected
+2. resume: a job left in state.json by an interrupted run is polled again instead of submitted again,
+   and only its items that are still pending are taken from it
+3. batch_generate_content --batch end to end on a synthetic _strip.txt: the failed chunks are resubmitted
+   and _fixed.txt is written
+
+Usage: python utility/check_gemini_batch.py
+"""
+
+import os
+import sys
+import json
+import tempfile
+from types import SimpleNamespace
+
+# Before the modules read them
+WORK_DIR = tempfile.TemporaryDirectory()
+os.environ['BATCH_POLL_SECONDS'] = '0'
+os.environ['GEMINI_CACHE'] = '0'
+os.environ['GEMINI_BATCH_DIR'] = os.path.join(WORK_DIR.name, "batch")
+os.environ['CHUNK_TOKENS'] = '2000'
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'batch_st'))
+
+from gemini_batch import BatchRunner
+
+
+class StandInBatchClient:
+    """
+    Implements the files / batches calls BatchRunner makes. Every item is answered with its prompt
+    (so tagged lines come back as they were sent), except the items whose prompt contains one of fail_markers,
+    which fail in the first fail_rounds jobs. A job reports JOB_STATE_RUNNING once before it succeeds.
+    """
+
+    def __init__(self, fail_markers=(), fail_rounds=1):
+        self.fail_markers = list(fail_markers)
+        self.fail_rounds = fail_rounds
+        self.uploads = {}
+        self.jobs = {}
+        self.submitted = []
+        self.files = SimpleNamespace(upload=self.upload, download=self.download)
+        self.batches = SimpleNamespace(create=self.create, get=self.get)
+
+    def upload(self, file, config=None):
+        name = f"files/{len(self.uploads)}"
+        with open(file, 'r', encoding='utf-8') as f:
+            self.uploads[name] = [json.loads(line) for line in f]
+        return SimpleNamespace(name=name)
+
+    def download(self, file):
+        return self.uploads[file].encode('utf-8')
+
+    def create(self, model, src, config=None):
+        items = self.uploads[src]
+        self.submitted.append([item['key'] for item in items])
+        failing = len(self.submitted) <= self.fail_rounds
+        results = []
+        for item in items:
+            text = item['request']['contents'][0]['parts'][0]['text']
+            if failing and any(marker in text for marker in self.fail_markers):
+                results.append({'key': item['key'], 'error': {'code': 500, 'message': 'stand-in failure'}})
+            else:
+                candidate = {'content': {'parts': [{'text': text}]}, 'finishReason': 'STOP'}
+                results.append({'key': item['key'], 'response': {'candidates': [candidate]}})
+        name = f"batches/{len(self.jobs)}"
+        result_file = f"files/{name}.results"
+        self.uploads[result_file] = '\n'.join(json.dumps(result, ensure_ascii=False) for result in results)
+        self.jobs[name] = {'polls': 0, 'result_file': result_file}
+        return SimpleNamespace(name=name)
+
+    def get(self, name):
+        job = self.jobs[name]
+        job['polls'] += 1
+        state = 'JOB_STATE_RUNNING' if job['polls'] == 1 else 'JOB_STATE_SUCCEEDED'
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=state), dest=SimpleNamespace(file_name=job['result_file']))
+
+
+def make_requests(keys: list) -> dict:
+    return {key: {'contents': [{'role': 'user', 'parts': [{'text': f"0001-{key}"}]}]} for key in keys}
+
+
+def check(label: str, condition: bool) -> bool:
+    print(f"  {'OK' if condition else 'FAILED'}: {label}")
+    return condition
+
+
+def check_resubmit(work_dir: str) -> bool:
+    print("submit -> fail -> resubmit -> collect")
+    client = StandInBatchClient(fail_markers=['b'])
+    collected = {}
+    failed = BatchRunner(client, 'model', work_dir, log=lambda message: None).run(
+        make_requests(['a', 'b', 'c']), lambda key, text: collected.setdefault(key, text) is not None)
+    return all([
+        check("every item collected", sorted(collected) == ['a', 'b', 'c'] and not failed),
+        check("only the failed item resubmitted", client.submitted == [['a', 'b', 'c'], ['b']]),
+        check("state.json removed", not os.path.exists(os.path.join(work_dir, "state.json"))),
+    ])
+
+
+def check_resume(work_dir: str) -> bool:
+    print("resume an interrupted job")
+    client = StandInBatchClient()
+    runner = BatchRunner(client, 'model', work_dir, log=lambda message: None)
+    # An interrupted run submitted a, b, c; b has been answered since (e.g. from the cache), d is new
+    runner.submit(make_requests(['a', 'b', 'c']))
+    collected = {}
+    failed = runner.run(make_requests(['a', 'c', 'd']), lambda key, text: collected.setdefault(key, text) is not None)
+    return all([
+        check("every pending item collected", sorted(collected) == ['a', 'c', 'd'] and not failed),
+        check("the saved job is not submitted again", client.submitted == [['a', 'b', 'c'], ['d']]),
+    ])
+
+
+def check_generate_content(work_dir: str) -> bool:
+    print("batch_generate_content --batch")
+    from batch_generate_content import batch_api_generate_content
+
+    strip_file = os.path.join(work_dir, "bench_strip.txt")
+    with open(strip_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(f"{number:04d}-今日はロックマンの{number}面をクリアしていきたいと思います" for number in range(1, 501)))
+    open(os.path.join(work_dir, "system_instruction.txt"), 'w', encoding='utf-8').close()
+
+    client = StandInBatchClient(fail_markers=['0250-'])
+    statuses = batch_api_generate_content(client, [strip_file], os.path.join(work_dir, "system_instruction.txt"),
+                                          os.path.join(work_dir, "wordlist.txt"))
+    fixed_file = os.path.join(work_dir, "bench_fixed.txt")
+    with open(strip_file, 'r', encoding='utf-8') as f:
+        strip_lines = f.read().split('\n')
+    fixed_lines = []
+    if os.path.exists(fixed_file):
+        with open(fixed_file, 'r', encoding='utf-8') as f:
+            fixed_lines = f.read().split('\n')
+    return all([
+        check("file done", statuses.get(strip_file) == 'done'),
+        check(f"{len(client.submitted[0])} chunks submitted, 1 resubmitted", len(client.submitted) == 2 and len(client.submitted[1]) == 1),
+        check("_fixed.txt has every line", fixed_lines == strip_lines),
+        check("progress sidecar removed", not os.path.exists(os.path.join(work_dir, "bench_fixed.progress.jsonl"))),
+    ])
+
+
+def main() -> None:
+    results = []
+    for scenario in (check_resubmit, check_resume, check_generate_content):
+        with tempfile.TemporaryDirectory() as work_dir:
+            results.append(scenario(work_dir))
+    print("All checks passed." if all(results) else "Some checks FAILED.")
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,27 @@ This script:
 1. Copies *.mp4 files from /mnt/miniutsuro/utsulog-data/videofiles
 2. Destination: VIDEOFILES_DIR environment variable
 3. Skips files that already exist in the destination
+4. Copies through a '.part' temp file that is verified (size, mtime, optionally
+   SHA-256 with --verify-hash) and renamed on completion; an interrupted copy
+   is resumed from its offset on the next run
+5. Runs COPY_WORKERS copies concurrently, capped at COPY_BWLIMIT_MB MB/s in total
+
+With --audio-only, the video is not copied. Each source is read over the share once
+and only its audio track is transcoded (same settings as conv_audio.py) into AUDIOS_DIR.
 """
 
 import os
 import sys
 import glob
+import time
 import shutil
+import hashlib
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'batch_st'))
+from conv_audio import convert_audio
 
 # Configure logging
 logging.basicConfig(
@@ -24,9 +38,104 @@ logger = logging.getLogger(__name__)
 # Source and destination paths
 SOURCE_DIR = '/mnt/miniutsuro/utsulog-data/videofiles'
 DEST_DIR = os.environ.get('VIDEOFILES_DIR', '/app/videofiles')
+AUDIO_DEST_DIR = os.environ.get('AUDIOS_DIR', '/app/audios')
+
+# Copy settings
+COPY_WORKERS = int(os.environ.get('COPY_WORKERS', 2))
+COPY_BWLIMIT_MB = float(os.environ.get('COPY_BWLIMIT_MB', 0))  # total MB/s, 0: unlimited
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all copy threads to cap the total read bandwidth.
+    """
+
+    def __init__(self, bytes_per_second: float):
+        self.rate = bytes_per_second
+        self.allowance = bytes_per_second
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= size
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def file_sha256(path: str) -> str:
+    """Return the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_file(source_file: str, dest_file: str, limiter: RateLimiter, verify_hash: bool = False) -> int:
+    """
+    Copy one file through a temp file (dest_file + '.part') and rename it on completion.
+    
+    A '.part' file left by an interrupted copy is resumed from its current size,
+    unless the source was modified after the partial copy was last written.
+    Size and mtime (and optionally SHA-256) are checked against the source before the rename.
+    
+    Returns:
+        int: number of bytes copied in this call
+    
+    Raises:
+        OSError: on I/O errors or when verification fails
+    """
+    part_file = dest_file + '.part'
+    source_stat = os.stat(source_file)
+    
+    offset = 0
+    if os.path.exists(part_file):
+        part_stat = os.stat(part_file)
+        if part_stat.st_size <= source_stat.st_size and part_stat.st_mtime >= source_stat.st_mtime:
+            offset = part_stat.st_size
+            logger.info(f"Resuming: {os.path.basename(source_file)} from {offset} bytes")
+    
+    copied_bytes = 0
+    with open(source_file, 'rb') as src, open(part_file, 'r+b' if offset else 'wb') as dst:
+        src.seek(offset)
+        dst.seek(offset)
+        dst.truncate()
+        while True:
+            block = src.read(COPY_BLOCK_SIZE)
+            if not block:
+                break
+            limiter.consume(len(block))
+            dst.write(block)
+            copied_bytes += len(block)
+        dst.flush()
+        os.fsync(dst.fileno())
+    
+    # Preserve timestamps like shutil.copy2
+    shutil.copystat(source_file, part_file)
+    
+    part_stat = os.stat(part_file)
+    if part_stat.st_size != source_stat.st_size:
+        raise OSError(f"size mismatch ({part_stat.st_size} != {source_stat.st_size})")
+    if abs(part_stat.st_mtime - source_stat.st_mtime) > 1:
+        raise OSError(f"mtime mismatch ({part_stat.st_mtime} != {source_stat.st_mtime})")
+    if verify_hash and file_sha256(part_file) != file_sha256(source_file):
+        os.remove(part_file)
+        raise OSError("SHA-256 mismatch")
+    
+    os.replace(part_file, dest_file)
+    return copied_bytes
 
 
-def copy_videos(source_dir: str, dest_dir: str, dry_run: bool = False) -> tuple[int, int, int]:
+def copy_videos(source_dir: str, dest_dir: str, dry_run: bool = False,
+                workers: int = 1, bwlimit: float = 0, verify_hash: bool = False) -> tuple[int, int, int, int]:
     """
     Copy MP4 video files from source directory to destination directory.
     
@@ -34,18 +143,22 @@ def copy_videos(source_dir: str, dest_dir: str, dry_run: bool = False) -> tuple[
         source_dir: Source directory path
         dest_dir: Destination directory path
         dry_run: If True, only show what would be done without actually copying
+        workers: Number of concurrent copies
+        bwlimit: Total bandwidth cap in bytes/sec (0: unlimited)
+        verify_hash: If True, also compare SHA-256 of source and copy
     
     Returns:
-        tuple: (copied_count, skipped_count, error_count)
+        tuple: (copied_count, skipped_count, error_count, copied_bytes)
     """
     copied_count = 0
     skipped_count = 0
     error_count = 0
+    copied_bytes = 0
     
     # Check if source directory exists
     if not os.path.isdir(source_dir):
         logger.error(f"Source directory not found: {source_dir}")
-        return copied_count, skipped_count, error_count
+        return copied_count, skipped_count, error_count, copied_bytes
     
     # Create destination directory if it doesn't exist
     if not dry_run:
@@ -57,15 +170,17 @@ def copy_videos(source_dir: str, dest_dir: str, dry_run: bool = False) -> tuple[
     
     if not mp4_files:
         logger.warning(f"No MP4 files found in {source_dir}")
-        return copied_count, skipped_count, error_count
+        return copied_count, skipped_count, error_count, copied_bytes
     
     logger.info(f"Found {len(mp4_files)} MP4 files in {source_dir}")
     
+    jobs = []
     for source_file in sorted(mp4_files):
         basename = os.path.basename(source_file)
         dest_file = os.path.join(dest_dir, basename)
         
         # Skip if file already exists in destination
+        # (only completed copies are renamed to the final name)
         if os.path.exists(dest_file):
             logger.info(f"Skip (exists): {basename}")
             skipped_count += 1
@@ -75,35 +190,122 @@ def copy_videos(source_dir: str, dest_dir: str, dry_run: bool = False) -> tuple[
             logger.info(f"[DRY RUN] Would copy: {basename}")
             copied_count += 1
         else:
+            jobs.append((source_file, dest_file))
+    
+    limiter = RateLimiter(bwlimit)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {}
+        for source_file, dest_file in jobs:
+            logger.info(f"Copying: {os.path.basename(source_file)}")
+            futures[executor.submit(copy_file, source_file, dest_file, limiter, verify_hash)] = source_file
+        
+        for future in as_completed(futures):
+            basename = os.path.basename(futures[future])
             try:
-                logger.info(f"Copying: {basename}")
-                shutil.copy2(source_file, dest_file)
+                copied_bytes += future.result()
                 logger.info(f"Copied: {basename}")
                 copied_count += 1
             except (OSError, IOError) as e:
                 logger.error(f"Error copying {basename}: {e}")
                 error_count += 1
     
-    return copied_count, skipped_count, error_count
+    return copied_count, skipped_count, error_count, copied_bytes
+
+
+def extract_audios(source_dir: str, dest_dir: str, dry_run: bool = False) -> tuple[int, int, int, int]:
+    """
+    Extract the audio track of MP4 files in source directory directly into destination directory as MP3.
+    The video itself is never stored locally.
+    
+    Args:
+        source_dir: Source directory path
+        dest_dir: Destination directory path for MP3 files
+        dry_run: If True, only show what would be done without actually converting
+    
+    Returns:
+        tuple: (extracted_count, skipped_count, error_count, read_bytes)
+    """
+    extracted_count = 0
+    skipped_count = 0
+    error_count = 0
+    read_bytes = 0
+    
+    # Check if source directory exists
+    if not os.path.isdir(source_dir):
+        logger.error(f"Source directory not found: {source_dir}")
+        return extracted_count, skipped_count, error_count, read_bytes
+    
+    # Create destination directory if it doesn't exist
+    if not dry_run:
+        os.makedirs(dest_dir, exist_ok=True)
+    
+    # Find all MP4 files in source directory
+    mp4_pattern = os.path.join(source_dir, '*.mp4')
+    mp4_files = glob.glob(mp4_pattern)
+    
+    if not mp4_files:
+        logger.warning(f"No MP4 files found in {source_dir}")
+        return extracted_count, skipped_count, error_count, read_bytes
+    
+    logger.info(f"Found {len(mp4_files)} MP4 files in {source_dir}")
+    
+    for source_file in sorted(mp4_files):
+        basename = os.path.basename(source_file)
+        dest_file = os.path.join(dest_dir, f"{os.path.splitext(basename)[0]}.mp3")
+        
+        # Skip if audio already exists in destination
+        if os.path.exists(dest_file):
+            logger.info(f"Skip (exists): {os.path.basename(dest_file)}")
+            skipped_count += 1
+            continue
+        
+        if dry_run:
+            logger.info(f"[DRY RUN] Would extract audio: {basename}")
+            extracted_count += 1
+        else:
+            logger.info(f"Extracting audio: {basename}")
+            ok, _, message = convert_audio(source_file, dest_file)
+            if ok:
+                logger.info(f"Extracted: {os.path.basename(dest_file)}")
+                extracted_count += 1
+                read_bytes += os.path.getsize(source_file)
+            else:
+                logger.error(f"Error extracting {basename}: {message}")
+                error_count += 1
+    
+    return extracted_count, skipped_count, error_count, read_bytes
 
 
 def main():
     """Main function."""
     dry_run = '--dry-run' in sys.argv or '-n' in sys.argv
+    audio_only = '--audio-only' in sys.argv
+    verify_hash = '--verify-hash' in sys.argv
     
     if dry_run:
         logger.info("=== DRY RUN MODE (no files will be copied) ===")
     
     logger.info(f"Source: {SOURCE_DIR}")
-    logger.info(f"Destination: {DEST_DIR}")
-    
-    copied, skipped, errors = copy_videos(SOURCE_DIR, DEST_DIR, dry_run=dry_run)
+    start_time = time.time()
+    if audio_only:
+        logger.info(f"Destination (audio only): {AUDIO_DEST_DIR}")
+        copied, skipped, errors, total_bytes = extract_audios(SOURCE_DIR, AUDIO_DEST_DIR, dry_run=dry_run)
+    else:
+        logger.info(f"Destination: {DEST_DIR}")
+        logger.info(f"Workers: {COPY_WORKERS}, Bandwidth limit: {f'{COPY_BWLIMIT_MB} MB/s' if COPY_BWLIMIT_MB > 0 else 'none'}")
+        copied, skipped, errors, total_bytes = copy_videos(
+            SOURCE_DIR, DEST_DIR, dry_run=dry_run,
+            workers=COPY_WORKERS, bwlimit=COPY_BWLIMIT_MB * 1024 * 1024, verify_hash=verify_hash
+        )
+    elapsed = time.time() - start_time
     
     logger.info("=" * 50)
     logger.info("Summary:")
-    logger.info(f"  Copied:  {copied}")
+    logger.info(f"  {'Extracted' if audio_only else 'Copied'}:  {copied}")
     logger.info(f"  Skipped: {skipped}")
     logger.info(f"  Errors:  {errors}")
+    if elapsed > 0:
+        logger.info(f"  Bytes/sec: {total_bytes / elapsed:,.0f} ({total_bytes:,} bytes in {elapsed:.1f}s)")
     
     if errors > 0:
         sys.exit(1)